@@ -0,0 +1,294 @@
+"""
+ADF/XML lead delivery
+
+Renders an ADF document for every new lead from a single pre-built
+string template, groups the documents per store, sends them to the
+store's ADF address over one pooled SMTP connection per store and
+flags the delivered leads in bulk.  A store that fails only fails its
+own leads: they keep sent_adf = 0 with the error in
+adf_email_validation_message and are retried on the next run, while a
+run walks forward by lead id so they never block the other stores.
+"""
+from database import db_session
+from flask_mail import Message
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import text
+from xml.sax.saxutils import escape
+import config
+import datetime
+import time
+
+ADF_BATCH_SIZE = getattr(config, 'ADF_BATCH_SIZE', 2000)
+ADF_CONCURRENCY = getattr(config, 'ADF_CONCURRENCY', 4)
+ADF_DEFAULT_SUBJECT = 'EARL Lead'
+
+ADF_TEMPLATE = (
+    u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    u'<?adf version="1.0"?>\n'
+    u'<adf>\n'
+    u'<prospect status="new">\n'
+    u'<id sequence="1" source="EARL">{lead_id}</id>\n'
+    u'<requestdate>{request_date}</requestdate>\n'
+    u'<vehicle interest="buy" status="used">\n'
+    u'<year>{car_year}</year>\n'
+    u'<make>{car_make}</make>\n'
+    u'<model>{car_model}</model>\n'
+    u'</vehicle>\n'
+    u'<customer>\n'
+    u'<contact>\n'
+    u'<name part="first">{first_name}</name>\n'
+    u'<name part="last">{last_name}</name>\n'
+    u'<email>{email}</email>\n'
+    u'<phone type="voice">{phone}</phone>\n'
+    u'<address>\n'
+    u'<street line="1">{address1}</street>\n'
+    u'<city>{city}</city>\n'
+    u'<regioncode>{state}</regioncode>\n'
+    u'<postalcode>{zip_code}</postalcode>\n'
+    u'</address>\n'
+    u'</contact>\n'
+    u'<comments>Credit Range: {credit_range}</comments>\n'
+    u'</customer>\n'
+    u'<vendor>\n'
+    u'<vendorname>{store_name}</vendorname>\n'
+    u'</vendor>\n'
+    u'<provider>\n'
+    u'<name part="full">EARL</name>\n'
+    u'<service>{campaign_name}</service>\n'
+    u'</provider>\n'
+    u'</prospect>\n'
+    u'</adf>\n'
+)
+
+ADF_FIELDS = ('car_year', 'car_make', 'car_model', 'first_name', 'last_name', 'email', 'phone', 'address1',
+              'city', 'state', 'zip_code', 'credit_range', 'store_name', 'campaign_name')
+
+
+def _xml(value):
+    if value is None:
+        return u''
+    if not isinstance(value, type(u'')):
+        value = u'{}'.format(value)
+    return escape(value)
+
+
+def render_adf(lead):
+    """
+    Render the ADF document for a lead
+    :param lead: row or dict with the ADF_FIELDS, lead_id and created_date
+    :return: unicode xml
+    """
+    get = lead.get if isinstance(lead, dict) else lambda key: getattr(lead, key)
+    created_date = get('created_date') or datetime.datetime.now()
+
+    values = dict((field, _xml(get(field))) for field in ADF_FIELDS)
+    values['lead_id'] = get('lead_id')
+    values['request_date'] = created_date.strftime('%Y-%m-%dT%H:%M:%S')
+
+    return ADF_TEMPLATE.format(**values)
+
+
+def group_by_store(leads):
+    """
+    Group lead rows by their store
+    :param leads:
+    :return: dict store_id -> list of leads
+    """
+    stores = {}
+    for lead in leads:
+        stores.setdefault(lead.store_id, []).append(lead)
+    return stores
+
+
+class ADFDelivery(object):
+    """
+    Deliver new leads to their dealers as ADF/XML emails
+    """
+
+    def __init__(self, mail, session=db_session, batch_size=ADF_BATCH_SIZE, concurrency=ADF_CONCURRENCY):
+        self.mail = mail
+        self.session = session
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+    def fetch_new_leads(self, last_id=0):
+        """
+        Get the next batch of leads waiting for ADF delivery
+        :param last_id: resume after this lead id
+        :return: list
+        """
+        stmt = text("select l.id as lead_id, l.created_date, av.first_name, av.last_name, av.email, "
+                    "coalesce(av.cell_phone, av.home_phone) as phone, av.address1, av.city, av.state, "
+                    "av.zip_code, av.credit_range, av.car_year, av.car_make, av.car_model, "
+                    "s.id as store_id, s.name as store_name, s.adf_email, "
+                    "c.name as campaign_name, c.adf_subject "
+                    "from leads l, appendedvisitors av, visitors v, campaigns c, stores s "
+                    "where av.id = l.appended_visitor_id "
+                    "and v.id = av.visitor "
+                    "and c.id = v.campaign_id "
+                    "and s.id = c.store_id "
+                    "and c.send_adf = 1 "
+                    "and l.sent_adf = 0 "
+                    "and l.lead_optout = 0 "
+                    "and l.id > :last_id "
+                    "and s.adf_email is not NULL "
+                    "and trim(s.adf_email) != '' "
+                    "order by l.id asc "
+                    "limit :limit")
+
+        return self.session.execute(stmt, {'last_id': last_id, 'limit': self.batch_size}).fetchall()
+
+    def send_store(self, leads):
+        """
+        Send one store's leads over a single SMTP connection, errors are
+        kept to the store
+        :param leads: list of lead rows for the same store
+        :return: tuple (list of (lead_id, receipt_id), list of (lead_id, message))
+        """
+        recipients = [addr.strip() for addr in (leads[0].adf_email or '').split(',') if addr.strip()]
+        sent = []
+
+        if not recipients:
+            return sent, [(lead.lead_id, 'No ADF recipients') for lead in leads]
+
+        try:
+            with self.mail.app.app_context():
+                with self.mail.connect() as conn:
+                    for lead in leads:
+                        msg = Message(
+                            lead.adf_subject or ADF_DEFAULT_SUBJECT,
+                            sender=self.mail.app.config['MAIL_DEFAULT_SENDER'],
+                            recipients=recipients,
+                            body=render_adf(lead)
+                        )
+                        conn.send(msg)
+                        sent.append((lead.lead_id, msg.msgId))
+
+        except Exception as err:
+            delivered = set(lead_id for lead_id, receipt_id in sent)
+            return sent, [(lead.lead_id, str(err)[:50]) for lead in leads if lead.lead_id not in delivered]
+
+        return sent, []
+
+    def record_sent(self, sent, failed=None):
+        """
+        Flag the delivered leads and note the failed ones in bulk
+        :param sent: list of (lead_id, receipt_id)
+        :param failed: list of (lead_id, message)
+        :return: None
+        """
+        if not sent and not failed:
+            return
+
+        try:
+            if sent:
+                self.session.execute(
+                    text("update leads set sent_adf = 1, sent_to_dealer = 1, adf_email_receipt_id = :receipt_id, "
+                         "adf_email_validation_message = NULL "
+                         "where id = :id"),
+                    [{'id': lead_id, 'receipt_id': receipt_id} for lead_id, receipt_id in sent]
+                )
+
+            if failed:
+                self.session.execute(
+                    text("update leads set adf_email_validation_message = :message where id = :id"),
+                    [{'id': lead_id, 'message': message} for lead_id, message in failed]
+                )
+
+            self.session.commit()
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def run_batch(self, last_id=0):
+        """
+        Deliver one batch of new leads, stores are sent in parallel
+        :param last_id: resume after this lead id
+        :return: dict counts and the last lead id
+        """
+        leads = self.fetch_new_leads(last_id)
+        stats = {'leads': len(leads), 'stores': 0, 'sent': 0, 'failed': 0, 'last_id': last_id}
+        if not leads:
+            return stats
+        stats['last_id'] = leads[-1].lead_id
+
+        stores = group_by_store(leads)
+        stats['stores'] = len(stores)
+
+        pool = ThreadPool(min(self.concurrency, len(stores)))
+        try:
+            results = pool.map(self.send_store, list(stores.values()))
+        finally:
+            pool.close()
+            pool.join()
+
+        sent = [item for store_sent, store_failed in results for item in store_sent]
+        failed = [item for store_sent, store_failed in results for item in store_failed]
+        self.record_sent(sent, failed)
+        stats['sent'] = len(sent)
+        stats['failed'] = len(failed)
+
+        return stats
+
+    def run(self, max_batches=None):
+        """
+        Deliver batches until there are no new leads left
+        :param max_batches:
+        :return: dict counts
+        """
+        totals = {'batches': 0, 'leads': 0, 'stores': 0, 'sent': 0, 'failed': 0}
+        last_id = 0
+
+        while max_batches is None or totals['batches'] < max_batches:
+            stats = self.run_batch(last_id)
+            if not stats['leads']:
+                break
+
+            last_id = stats['last_id']
+            totals['batches'] += 1
+            for key in ('leads', 'stores', 'sent', 'failed'):
+                totals[key] += stats[key]
+
+        return totals
+
+
+def benchmark(count=20000, stores=50):
+    """
+    Measure ADF rendering and grouping throughput
+    :param count: number of synthetic leads
+    :param stores: number of stores to spread them over
+    :return: float leads per minute
+    """
+    now = datetime.datetime.now()
+    leads = [{
+        'lead_id': i,
+        'created_date': now,
+        'store_id': i % stores,
+        'first_name': 'First{}'.format(i),
+        'last_name': "O'Last & Sons",
+        'email': 'lead{}@example.com'.format(i),
+        'phone': '3215550100',
+        'address1': '{} Main St'.format(i),
+        'city': 'Orlando',
+        'state': 'FL',
+        'zip_code': '32801',
+        'credit_range': '700-749',
+        'car_year': 2015,
+        'car_make': 'Ford',
+        'car_model': 'F-150',
+        'store_name': 'Store {}'.format(i % stores),
+        'campaign_name': 'Campaign <1>',
+    } for i in range(count)]
+
+    started = time.time()
+    grouped = {}
+    for lead in leads:
+        grouped.setdefault(lead['store_id'], []).append(render_adf(lead))
+    elapsed = time.time() - started
+
+    return count / elapsed * 60
+
+
+if __name__ == '__main__':
+    print('ADF render: {:,.0f} leads/minute'.format(benchmark()))
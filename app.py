@@ -3,21 +3,35 @@ from flask_sslify import SSLify
 from flask_login import LoginManager, login_required, login_user, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy, Pagination
 from flask_mail import Mail, Message
+from functools import wraps
 from sqlalchemy import text, and_, exc, func
 from database import db_session
-from models import User, Store, Campaign, CampaignType, Visitor, AppendedVisitor, Lead, StoreDashboard, \
-    CampaignDashboard
+from models import User, Store, Campaign, CampaignType, Lead, StoreDashboard, \
+    CampaignDashboard, DealerGroup
 from forms import UserLoginForm, DailyRecapForm
+from search import search_leads
+from replicas import read_replica, read_session
 from celery import Celery
-from io import BytesIO
+import adf
 import config
 import datetime
+import emailevents
+import geoip
 import hashlib
 import phonenumbers
+import pixel
+import profiler
 import random
+import recap
+import replicas
+import retention
+import rvm
+import scoring
+import threading
 import time
+import trackers
 import os
-import csv
+import workqueue
 
 # app settings
 app = Flask(__name__)
@@ -49,23 +63,44 @@ login_manager.login_message_category = "primary"
 # disable strict slashes
 app.url_map.strict_slashes = False
 
-# Celery config
-app.config['CELERY_BROKER_URL'] = config.CELERY_BROKER_URL
-app.config['CELERY_RESULT_BACKEND'] = config.CELERY_RESULT_BACKEND
-app.config['CELERY_ACCEPT_CONTENT'] = config.CELERY_ACCEPT_CONTENT
-app.config.update(accept_content=['json', 'pickle'])
-# Initialize Celery
-celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
-celery.conf.update(app.config)
+# Initialize Celery, queues and routes live in celeryconfig.py
+celery = Celery(app.name)
+celery.config_from_object('celeryconfig')
 
 # Config mail
 mail = Mail(app)
 
+# on-demand and slow request profiling
+request_profiler = profiler.Profiler(app)
+
+# campaign trend chart point budget
+TREND_POINTS = 500
+
+# leads export layout
+LEAD_CSV_COLUMNS = (
+    ('ID', 'id'),
+    ('Score', 'lead_score'),
+    ('First Name', 'first_name'),
+    ('Last Name', 'last_name'),
+    ('Email', 'email'),
+    ('Phone', 'home_phone'),
+    ('Credit Range', 'credit_range'),
+    ('Auto Year', 'car_year'),
+    ('Auto Make', 'car_make'),
+    ('Auto Model', 'car_model'),
+)
+
+# dealer group dashboard cache, group_id -> (expires, dashboard)
+GROUP_DASHBOARD_CACHE_TTL = getattr(config, 'GROUP_DASHBOARD_CACHE_TTL', 300)
+group_dashboard_cache = {}
+group_dashboard_lock = threading.Lock()
+
 
 # clear all db sessions at the end of each request
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
+    replicas.router.remove()
 
 
 # load the user
@@ -77,6 +112,35 @@ def load_user(id):
         return None
 
 
+def admin_required(f):
+    """
+    Restrict a view to admin users
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not current_user.is_authenticated or not current_user.is_admin:
+            flash('Unauthorized Access.', category='primary')
+            return redirect(url_for('index'))
+        return f(*args, **kwargs)
+    return decorated
+
+
+def store_required(f):
+    """
+    Restrict a view to users tied to a store, group level
+    accounts go to their group dashboard
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not getattr(current_user, 'store_id', None):
+            if getattr(current_user, 'dealer_group_id', None):
+                return redirect(url_for('group_dashboard'))
+            flash('Unauthorized Access.', category='primary')
+            return redirect(url_for('logout') if current_user.is_authenticated else url_for('login'))
+        return f(*args, **kwargs)
+    return decorated
+
+
 # run before each request
 @app.before_request
 def before_request():
@@ -84,13 +148,162 @@ def before_request():
 
 
 # tasks sections, for async functions, etc...
-@celery.task(serializer='pickle')
-def send_async_email(msg):
+@celery.task(time_limit=120, soft_time_limit=90)
+def send_async_email(subject, recipients, body=None, html=None, sender=None):
     """Background task to send an email with Flask-Mail."""
     with app.app_context():
+        msg = Message(
+            subject,
+            sender=sender or app.config['MAIL_DEFAULT_SENDER'],
+            recipients=recipients,
+            body=body,
+            html=html
+        )
         mail.send(msg)
 
 
+@celery.task(time_limit=60 * 60, soft_time_limit=60 * 55)
+def dispatch_rvms(max_batches=None):
+    """Background task to dispatch ringless voicemails for every eligible campaign."""
+    scheduler = rvm.RVMScheduler(rvm.get_client())
+    try:
+        return scheduler.run(max_batches=max_batches)
+    finally:
+        db_session.remove()
+
+
+@celery.task(time_limit=60 * 25, soft_time_limit=60 * 20)
+def deliver_adf_leads(max_batches=None):
+    """Background task to deliver new leads to their dealers as ADF/XML."""
+    delivery = adf.ADFDelivery(mail)
+    try:
+        return delivery.run(max_batches=max_batches)
+    finally:
+        db_session.remove()
+
+
+@celery.task(time_limit=60 * 10, soft_time_limit=60 * 9)
+def process_visitors(batch_size=workqueue.VISITOR_BATCH_SIZE, max_batches=50):
+    """Background task to lease and process batches of unprocessed visitors."""
+    processor = workqueue.get_processor()
+    if processor is None:
+        return {'claimed': 0, 'processed': 0, 'failed': 0}
+
+    totals = {'claimed': 0, 'processed': 0, 'failed': 0}
+    try:
+        for i in range(max_batches):
+            stats = workqueue.process_batch(processor, batch_size=batch_size)
+            for key in totals:
+                totals[key] += stats[key]
+
+            # a short batch means the queue is drained
+            if stats['claimed'] < batch_size:
+                break
+    finally:
+        db_session.remove()
+
+    return totals
+
+
+@celery.task
+def fan_out_visitor_processing(workers=4):
+    """Background task to start parallel visitor processing workers."""
+    for i in range(workers):
+        process_visitors.delay()
+    return workers
+
+
+@celery.task
+def reclaim_visitor_leases():
+    """Background task to release expired visitor leases."""
+    try:
+        return workqueue.VisitorQueue().reclaim_expired()
+    finally:
+        db_session.remove()
+
+
+geoip_enricher = None
+
+
+@celery.task(time_limit=60 * 10, soft_time_limit=60 * 9)
+def enrich_geoip(max_batches=100):
+    """Background task to fill in visitor geo data from the local GeoIP database."""
+    global geoip_enricher
+
+    # one enricher per worker process keeps the mmap and the LRU warm
+    if geoip_enricher is None:
+        geoip_enricher = geoip.GeoIPEnricher()
+
+    try:
+        return geoip_enricher.run(max_batches=max_batches)
+    finally:
+        db_session.remove()
+
+
+@celery.task(time_limit=60 * 5, soft_time_limit=60 * 4)
+def send_daily_recaps(recap_date=None):
+    """Background task to fan the nightly recap emails out per store."""
+    if recap_date is None:
+        recap_date = (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+
+    try:
+        store_ids = recap.get_recap_stores()
+    finally:
+        db_session.remove()
+
+    for store_id in store_ids:
+        send_store_recap.delay(store_id, recap_date)
+
+    return len(store_ids)
+
+
+@celery.task(bind=True, max_retries=2, default_retry_delay=60, time_limit=60 * 5, soft_time_limit=60 * 4)
+def send_store_recap(self, store_id, recap_date):
+    """Background task to email one store its daily recap."""
+    try:
+        delivery = recap.send_store_recap(mail, store_id, datetime.datetime.strptime(recap_date, '%Y-%m-%d'))
+        return {'store_id': store_id, 'status': delivery.status, 'duration_ms': delivery.duration_ms}
+    except Exception as err:
+        raise self.retry(exc=err)
+    finally:
+        db_session.remove()
+
+
+@celery.task(time_limit=60 * 10, soft_time_limit=60 * 9)
+def purge_expired_campaigns():
+    """Background task to purge archived campaigns past retention, re-enqueues itself until done."""
+    try:
+        result = retention.RetentionPurger().run()
+    finally:
+        db_session.remove()
+
+    # resume from the checkpoints, later if the replicas are behind
+    if result['status'] == retention.STATUS_THROTTLED:
+        purge_expired_campaigns.apply_async(countdown=retention.RETENTION_THROTTLE_SECONDS)
+    elif result['status'] == retention.STATUS_PARTIAL:
+        purge_expired_campaigns.apply_async(countdown=5)
+
+    return result
+
+
+@celery.task(time_limit=60 * 10, soft_time_limit=60 * 9)
+def rollup_email_events():
+    """Background task to roll followup email opens and clicks up onto the leads."""
+    try:
+        return emailevents.rollup()
+    finally:
+        db_session.remove()
+
+
+@celery.task(time_limit=60 * 10, soft_time_limit=60 * 9)
+def refresh_lead_scores(full=False):
+    """Background task to score new and changed leads."""
+    try:
+        return scoring.LeadScorer().refresh(full=full)
+    finally:
+        db_session.remove()
+
+
 @celery.task(bind=True)
 def long_task(self):
     """Background task that runs a long function with progress reports."""
@@ -116,12 +329,17 @@ def long_task(self):
 @app.route('/', methods=['GET'])
 @app.route('/index', methods=['GET'])
 @login_required
+@read_replica
 def index():
     """
     The Dashboard View (Default)
     :return: databoxes
     """
 
+    # group level accounts are not tied to a single store
+    if current_user.dealer_group_id and not current_user.store_id:
+        return redirect(url_for('group_dashboard'))
+
     return render_template(
         'index.html',
         current_user=current_user,
@@ -131,8 +349,42 @@ def index():
     )
 
 
+@app.route('/group', methods=['GET'])
+@login_required
+@read_replica
+def group_dashboard():
+    """
+    The Dealer Group Dashboard View
+    :return: databoxes for every store in the group
+    """
+    if not current_user.dealer_group_id:
+        flash('Unauthorized Access.', category='primary')
+        return redirect(url_for('index'))
+
+    try:
+        dealer_group = read_session().query(DealerGroup).filter(
+            DealerGroup.id == current_user.dealer_group_id,
+            DealerGroup.active == 1
+        ).one()
+
+        dashboard = get_group_dashboard(dealer_group.id)
+
+    except exc.SQLAlchemyError as err:
+        flash('Database returned error: {}'.format(str(err)), category='danger')
+        return redirect(url_for('logout'))
+
+    return render_template(
+        'group_dashboard.html',
+        current_user=current_user,
+        dealer_group=dealer_group,
+        dashboard=dashboard,
+        today=get_date()
+    )
+
+
 @app.route('/campaigns', methods=['GET'])
 @login_required
+@store_required
 def campaigns():
     """
     Campaign View
@@ -170,6 +422,8 @@ def campaigns():
 
 @app.route('/campaign/<int:campaign_pk_id>', methods=['GET'])
 @login_required
+@store_required
+@read_replica
 def campaign_detail(campaign_pk_id):
     """
     The Campaign Detail View
@@ -180,7 +434,7 @@ def campaign_detail(campaign_pk_id):
     errors = {}
 
     try:
-        campaign = db_session.query(Campaign).filter(
+        campaign = read_session().query(Campaign).filter(
             Campaign.store_id == current_user.store_id,
             Campaign.id == campaign_pk_id
         ).one()
@@ -189,7 +443,7 @@ def campaign_detail(campaign_pk_id):
 
             # get the campaign dashboard
             try:
-                dashboard = db_session.query(CampaignDashboard).filter(
+                dashboard = read_session().query(CampaignDashboard).filter(
                     CampaignDashboard.campaign_id == campaign.id,
                     CampaignDashboard.store_id == current_user.store_id
                 ).order_by(CampaignDashboard.last_update.desc()).limit(1).one()
@@ -218,8 +472,43 @@ def campaign_detail(campaign_pk_id):
     )
 
 
+@app.route('/campaign/<int:campaign_pk_id>/trends', methods=['GET'])
+@login_required
+@store_required
+@read_replica
+def campaign_trends(campaign_pk_id):
+    """
+    Downsampled campaign dashboard history for the trend charts
+    :param campaign_pk_id:
+    :return: json
+    """
+    days = request.args.get('days', 90, type=int)
+    points = request.args.get('points', TREND_POINTS, type=int)
+    end_date = datetime.datetime.now()
+    start_date = end_date - datetime.timedelta(days=min(max(days, 1), 366))
+
+    try:
+        campaign = read_session().query(Campaign).filter(
+            Campaign.store_id == current_user.store_id,
+            Campaign.id == campaign_pk_id
+        ).first()
+
+        if not campaign:
+            return jsonify(error='Campaign not found.'), 404
+
+        trends = get_campaign_trends(campaign.id, current_user.store_id, start_date, end_date,
+                                     min(max(points, 10), TREND_POINTS))
+
+    except exc.SQLAlchemyError as err:
+        return jsonify(error=str(err)), 500
+
+    return jsonify(trends)
+
+
 @app.route('/campaign/<int:campaign_pk_id>/leads')
 @login_required
+@store_required
+@read_replica
 def get_leads(campaign_pk_id):
     """
     Get the converted leads for the selected campaign
@@ -231,9 +520,10 @@ def get_leads(campaign_pk_id):
     campaign = None
     current_time = datetime.datetime.now()
     results = None
+    sort = request.args.get('sort', 'id')
 
     try:
-        campaign = db_session.query(Campaign).filter(
+        campaign = read_session().query(Campaign).filter(
             Campaign.id == campaign_pk_id,
             Campaign.store_id == current_user.store_id
         ).one()
@@ -243,15 +533,7 @@ def get_leads(campaign_pk_id):
         return redirect(url_for('index'))
 
     if campaign:
-        stmt = text('select v.id, av.first_name, av.last_name, av.email, av.home_phone, av.credit_range, '
-                    'av.car_year, av.car_model, av.car_make '
-                    'from visitors v, appendedvisitors av '
-                    'where v.id = av.visitor '
-                    'and v.campaign_id = {} '
-                    'order by v.id asc'.format(campaign.id))
-
-        results = db_session.query('id', 'first_name', 'last_name', 'email', 'home_phone', 'credit_range',
-                                   'car_make', 'car_year', 'car_model').from_statement(stmt).all()
+        results = get_campaign_leads(campaign.id, sort)
 
         if results:
             lead_count = len(results)
@@ -263,12 +545,45 @@ def get_leads(campaign_pk_id):
         campaign=campaign,
         results=results,
         lead_count=lead_count,
+        sort=sort,
         store_name=get_store_name(current_user.store_id)
     )
 
 
+@app.route('/campaign/<int:campaign_pk_id>/leads/export', methods=['GET'])
+@login_required
+@store_required
+@read_replica
+def export_leads(campaign_pk_id):
+    """
+    Export the converted leads for the selected campaign
+    :param campaign_pk_id:
+    :return: csv
+    """
+    sort = request.args.get('sort', 'id')
+
+    try:
+        campaign = read_session().query(Campaign).filter(
+            Campaign.id == campaign_pk_id,
+            Campaign.store_id == current_user.store_id
+        ).one()
+
+        results = get_campaign_leads(campaign.id, sort)
+
+    except exc.SQLAlchemyError as err:
+        flash('Database returned error: {}'.format(str(err)), category='danger')
+        return redirect(url_for('index'))
+
+    csv_content = make_response(recap.build_csv(results, LEAD_CSV_COLUMNS))
+    csv_content.headers['Content-Disposition'] = 'attachment; filename=Leads-{}.csv'.format(campaign.job_number)
+    csv_content.headers['Content-Type'] = 'text/csv'
+    return csv_content
+
+
 @app.route('/campaign/<int:campaign_pk_id>/emails')
 @login_required
+@store_required
+@read_replica
 def get_emails(campaign_pk_id):
     """
     Get the emails sent to prospects for the selected campaign
@@ -279,10 +594,12 @@ def get_emails(campaign_pk_id):
     current_time = datetime.datetime.now()
     results = None
     email_sent_count = 0
+    open_rate = 0.0
+    click_rate = 0.0
     campaign = None
 
     try:
-        campaign = db_session.query(Campaign).filter(
+        campaign = read_session().query(Campaign).filter(
             Campaign.id == campaign_pk_id,
             Campaign.store_id == current_user.store_id
         ).one()
@@ -293,20 +610,24 @@ def get_emails(campaign_pk_id):
 
     if campaign:
         stmt = ("select v.id, av.first_name, av.last_name, av.email, av.home_phone, l.followup_email_sent_date, "
-                "l.followup_email_receipt_id, l.followup_email_status "
+                "l.followup_email_receipt_id, l.followup_email_status, l.email_opens, l.email_clicks "
                 "from visitors v, appendedvisitors av, leads l "
                 "where v.id = av.visitor "
+                "and l.appended_visitor_id = av.id "
                 "and v.campaign_id = {} "
                 "and l.followup_email_status = 'SENT' "
                 "and l.followup_email_receipt_id is not NULL "
                 "and l.followup_email_sent_date is not NULL "
                 "order by v.id asc".format(campaign.id))
 
-        results = db_session.query('id', 'first_name', 'last_name', 'email', 'home_phone', 'followup_email_sent_date',
-                                   'followup_email_receipt_id', 'followup_email_status').from_statement(stmt).all()
+        results = read_session().query('id', 'first_name', 'last_name', 'email', 'home_phone', 'followup_email_sent_date',
+                                   'followup_email_receipt_id', 'followup_email_status', 'email_opens',
+                                   'email_clicks').from_statement(stmt).all()
 
         if results:
             email_sent_count = len(results)
+            open_rate = float(len([result for result in results if result.email_opens])) / email_sent_count * 100
+            click_rate = float(len([result for result in results if result.email_clicks])) / email_sent_count * 100
 
     return render_template(
         'followup_emails.html',
@@ -314,12 +635,16 @@ def get_emails(campaign_pk_id):
         current_user=current_user,
         campaign=campaign,
         results=results,
-        email_sent_count=email_sent_count
+        email_sent_count=email_sent_count,
+        open_rate=open_rate,
+        click_rate=click_rate
     )
 
 
 @app.route('/campaign/<int:campaign_pk_id>/rvms')
 @login_required
+@store_required
+@read_replica
 def get_rvms(campaign_pk_id):
     """
     Get the list of Ringless Voicemails for the selected campaign
@@ -330,7 +655,7 @@ def get_rvms(campaign_pk_id):
     campaign = None
 
     try:
-        campaign = db_session.query(Campaign).filter(
+        campaign = read_session().query(Campaign).filter(
             Campaign.id == campaign_pk_id,
             Campaign.store_id == current_user.store_id
         ).one()
@@ -344,12 +669,13 @@ def get_rvms(campaign_pk_id):
                 'l.rvm_sent '
                 'from visitors v, appendedvisitors av, leads l '
                 'where v.id = av.visitor '
+                'and l.appended_visitor_id = av.id '
                 'and v.campaign_id = {} '
                 'and l.rvm_sent = 1 '
                 'and l.rvm_date is not NULL '
                 'order by v.id asc'.format(campaign.id))
 
-        results = db_session.query('id', 'first_name', 'last_name', 'email', 'home_phone', 'rvm_status', 'rvm_date',
+        results = read_session().query('id', 'first_name', 'last_name', 'email', 'home_phone', 'rvm_status', 'rvm_date',
                                    'rvm_message', 'rvm_sent').from_statement(stmt).all()
 
         if results:
@@ -366,8 +692,43 @@ def get_rvms(campaign_pk_id):
     )
 
 
+@app.route('/search', methods=['GET'])
+@login_required
+@store_required
+@read_replica
+def search():
+    """
+    Search the store's visitors and leads by last name, email or phone
+    :return: list
+    """
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    results = []
+    has_next = False
+
+    if query:
+        try:
+            results, has_next = search_leads(current_user.store_id, query, page=page, session=read_session())
+
+        except exc.SQLAlchemyError as err:
+            flash('Database returned error: {}'.format(str(err)), category='danger')
+            return redirect(url_for('index'))
+
+    return render_template(
+        'search.html',
+        current_user=current_user,
+        store_name=get_store_name(current_user.store_id),
+        today=get_date(),
+        query=query,
+        page=page,
+        has_next=has_next,
+        results=results
+    )
+
+
 @app.route('/reports', methods=['GET'])
 @login_required
+@store_required
 def reports():
     """
     The Campaign Report View
@@ -383,6 +744,8 @@ def reports():
 
 @app.route('/reports/daily-recap-report', methods=['GET', 'POST'])
 @login_required
+@store_required
+@read_replica
 def daily_recap_report():
     """
     Return the daily recap report for the store, by date
@@ -404,24 +767,12 @@ def daily_recap_report():
             start_date = datetime.datetime.strptime(recap_date + ' 00:00:00', '%m/%d/%Y %H:%M:%S')
             end_date = datetime.datetime.strptime(recap_date + ' 23:59:59', '%m/%d/%Y %H:%M:%S')
 
-            # raw sql statement for daily recap report
-            stmt = text("select av.created_date, av.first_name, av.last_name, av.address1, av.address2, av.city, "
-                        "av.state, av.zip_code, av.zip_4, av.email, av.cell_phone, av.credit_range, av.car_year, "
-                        "av.car_make, av.car_model "
-                        "from visitors v, appendedvisitors av "
-                        "where v.id = av.visitor "
-                        "and v.campaign_id = {} "                            
-                        "and ( v.created_date between '{}' and '{}' ) "
-                        "order by av.last_name, av.first_name asc".format(campaign_id, start_date, end_date))
-
             # dump the query results to variable
-            results = db_session.query('created_date', 'first_name', 'last_name', 'address1', 'address2',
-                                       'city', 'state', 'zip_code', 'zip_4', 'email', 'cell_phone', 'credit_range',
-                                       'car_year', 'car_make', 'car_model').from_statement(stmt).all()
+            results = recap.get_daily_recap(campaign_id, start_date, end_date, session=read_session())
 
             if results:
                 results_count = len(results)
-                campaign_name = db_session.query(Campaign.name).filter(
+                campaign_name = read_session().query(Campaign.name).filter(
                     Campaign.id == campaign_id
                 ).one()
 
@@ -442,12 +793,14 @@ def daily_recap_report():
 
 
 @app.route('/reports/daily-recap-report/export', methods=['GET'])
+@login_required
+@store_required
+@read_replica
 def export_daily_recap_report():
     """
     Export the campaign daily recap report
     :return: csv
     """
-    rows = []
     start_date = None
     end_date = None
     campaign_id = None
@@ -469,7 +822,7 @@ def export_daily_recap_report():
 
                     try:
 
-                        campaign = db_session.query(Campaign).filter(
+                        campaign = read_session().query(Campaign).filter(
                             Campaign.id == campaign_id,
                             Campaign.store_id == current_user.store_id
                         ).first()
@@ -478,62 +831,12 @@ def export_daily_recap_report():
 
                             # get the daily recap report data for output
                             # execute the query and set the results
-                            results = Visitor.query.join(AppendedVisitor, Visitor.id == AppendedVisitor.visitor) \
-                                .add_columns(AppendedVisitor.created_date, AppendedVisitor.first_name,
-                                             AppendedVisitor.last_name,
-                                             AppendedVisitor.address1, AppendedVisitor.city, AppendedVisitor.state,
-                                             AppendedVisitor.zip_code, AppendedVisitor.email, AppendedVisitor.cell_phone,
-                                             AppendedVisitor.credit_range, AppendedVisitor.car_year,
-                                             AppendedVisitor.car_make,
-                                             AppendedVisitor.car_model) \
-                                .filter(
-                                Visitor.campaign_id == campaign_id,
-                                Visitor.created_date.between(start_date, end_date)
-                            ).all()
+                            results = recap.get_daily_recap(campaign_id, start_date, end_date,
+                                                            session=read_session())
 
                             if results:
-                                for result in results:
-                                    row = []
-                                    row.append(result.created_date)
-                                    row.append(result.first_name)
-                                    row.append(result.last_name)
-                                    row.append(result.address1)
-                                    row.append(result.city)
-                                    row.append(result.state)
-                                    row.append(result.zip_code)
-                                    row.append(result.email)
-                                    row.append(result.cell_phone)
-                                    row.append(result.credit_range)
-                                    row.append(result.car_year)
-                                    row.append(result.car_make)
-                                    row.append(result.car_model)
-                                    rows.append(row)
-
-                                # set the header row
-                                bi = BytesIO()
-                                row_heading = []
-                                row_heading.append('Created Date')
-                                row_heading.append('First Name')
-                                row_heading.append('Last Name')
-                                row_heading.append('Address')
-                                row_heading.append('City')
-                                row_heading.append('State')
-                                row_heading.append('ZipCode')
-                                row_heading.append('Email')
-                                row_heading.append('Phone')
-                                row_heading.append('Credit Range')
-                                row_heading.append('Auto Year')
-                                row_heading.append('Auto Make')
-                                row_heading.append('Auto Model')
-
-                                writer = csv.writer(bi)
-                                writer.writerow(row_heading)
-
-                                for row in rows:
-                                    writer.writerow(row)
-
                                 # set the csv content and make the response
-                                csv_content = make_response(bi.getvalue().strip('\r\n'))
+                                csv_content = make_response(recap.build_recap_csv(results))
 
                                 # set response headers and name the file
                                 csv_content.headers['Content-Disposition'] = 'attachment; ' \
@@ -590,14 +893,9 @@ def send_email(to, subject, **kwargs):
     :param kwargs:
     :return: celery async task id
     """
-    msg = Message(
-        subject,
-        sender=app.config['MAIL_DEFAULT_SENDER'],
-        recipients=[to, ]
-    )
-    msg.body = "EARL Dealer Demo UI Test"
-    # msg.html = render_template(template + '.html', **kwargs)
-    send_async_email.delay(msg)
+    body = "EARL Dealer Demo UI Test"
+    # html = render_template(template + '.html', **kwargs)
+    return send_async_email.delay(subject, [to, ], body=body)
 
 
 @app.route('/longtask', methods=['POST'])
@@ -607,6 +905,146 @@ def longtask():
                                                   task_id=task.id)}
 
 
+@app.route('/pixel.gif', methods=['GET'])
+def tracking_pixel():
+    """
+    Record a tracking pixel hit and return the 1x1 GIF
+    :return: image/gif
+    """
+    campaign_id = request.args.get('cid', type=int)
+
+    if campaign_id:
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        pixel.record_hit(
+            campaign_id,
+            forwarded_for.split(',')[0].strip() if forwarded_for else request.remote_addr,
+            request.headers.get('User-Agent'),
+            open_hash=request.args.get('oh'),
+            campaign_hash=request.args.get('ch'),
+            send_hash=request.args.get('sh')
+        )
+
+    resp = Response(pixel.PIXEL_GIF, mimetype='image/gif')
+    resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    resp.headers['Pragma'] = 'no-cache'
+    resp.headers['Expires'] = '0'
+    return resp
+
+
+@app.route('/t/o/<token>.gif', methods=['GET'])
+def email_open(token):
+    """
+    Record a followup email open and return the 1x1 GIF
+    :param token: signed open token
+    :return: image/gif
+    """
+    tracked = emailevents.load_token(token, emailevents.EVENT_OPEN)
+
+    if tracked:
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        emailevents.record_event(
+            tracked[0],
+            emailevents.EVENT_OPEN,
+            forwarded_for.split(',')[0].strip() if forwarded_for else request.remote_addr,
+            request.headers.get('User-Agent')
+        )
+
+    resp = Response(pixel.PIXEL_GIF, mimetype='image/gif')
+    resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    resp.headers['Pragma'] = 'no-cache'
+    resp.headers['Expires'] = '0'
+    return resp
+
+
+@app.route('/t/c/<token>', methods=['GET'])
+def email_click(token):
+    """
+    Record a followup email click and redirect to the signed url
+    :param token: signed click token
+    :return: redirect
+    """
+    tracked = emailevents.load_token(token, emailevents.EVENT_CLICK)
+
+    if not tracked:
+        return render_template('404.html'), 404
+
+    lead_id, url = tracked
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    emailevents.record_event(
+        lead_id,
+        emailevents.EVENT_CLICK,
+        forwarded_for.split(',')[0].strip() if forwarded_for else request.remote_addr,
+        request.headers.get('User-Agent'),
+        url=url
+    )
+
+    return redirect(url, 302)
+
+
+@app.route('/admin/trackers', methods=['GET'])
+@login_required
+@admin_required
+def tracker_utilization():
+    """
+    Per PixelTracker utilization
+    :return: json
+    """
+    try:
+        return jsonify(trackers=trackers.utilization())
+    except exc.SQLAlchemyError as err:
+        return jsonify(error=str(err)), 500
+
+
+@app.route('/admin/trackers/rebalance', methods=['POST'])
+@login_required
+@admin_required
+def tracker_rebalance():
+    """
+    Rebalance campaigns across the PixelTrackers
+    :return: json moves and utilization
+    """
+    threshold = request.form.get('threshold', trackers.TRACKER_REBALANCE_THRESHOLD, type=float)
+
+    try:
+        moves, utilization = trackers.rebalance(threshold=threshold)
+    except exc.SQLAlchemyError as err:
+        return jsonify(error=str(err)), 500
+
+    return jsonify(
+        moves=[{'campaign_id': campaign_id, 'from': source_id, 'to': target_id}
+               for campaign_id, source_id, target_id in moves],
+        trackers=utilization
+    )
+
+
+@app.route('/admin/campaign/<int:campaign_pk_id>/assign-tracker', methods=['POST'])
+@login_required
+@admin_required
+def tracker_assign(campaign_pk_id):
+    """
+    Place a campaign on the PixelTracker with the most headroom
+    :param campaign_pk_id:
+    :return: json
+    """
+    try:
+        tracker_id = trackers.assign_campaign(campaign_pk_id)
+    except exc.SQLAlchemyError as err:
+        return jsonify(error=str(err)), 500
+
+    return jsonify(campaign_id=campaign_pk_id, pixeltracker_id=tracker_id)
+
+
+@app.route('/admin/report-cache', methods=['GET'])
+@login_required
+@admin_required
+def report_cache_stats():
+    """
+    Closed-day recap cache hit rate for this worker
+    :return: json
+    """
+    return jsonify(recap.cache.stats())
+
+
 @app.route('/login', methods=['GET'])
 def login_redirect():
     """
@@ -682,7 +1120,7 @@ def get_dashboard():
 
     try:
         # get one dashboard, most recent first
-        dashboard = db_session.query(StoreDashboard).filter(
+        dashboard = read_session().query(StoreDashboard).filter(
             StoreDashboard.store_id == current_user.store_id
         ).order_by(StoreDashboard.last_update.desc()).limit(1).one()
 
@@ -694,6 +1132,164 @@ def get_dashboard():
     return dashboard
 
 
+def get_campaign_trends(campaign_pk_id, store_pk_id, start_date, end_date, points=TREND_POINTS):
+    """
+    Downsample the campaign dashboard history to a fixed point budget.
+    The totals are running counters, so each time bucket keeps its max;
+    one range scan over (campaign_id, last_update) does the grouping.
+    :param campaign_pk_id:
+    :param store_pk_id:
+    :param start_date:
+    :param end_date:
+    :param points: maximum points returned
+    :return: dict series
+    """
+    span = (end_date - start_date).total_seconds()
+    bucket_seconds = max(int(span // points) + 1, 1)
+
+    stmt = text("select floor(unix_timestamp(cd.last_update) / :bucket) as bucket, "
+                "max(cd.last_update) as last_update, max(cd.total_visitors) as total_visitors, "
+                "max(cd.total_appends) as total_appends, max(cd.total_followup_emails) as total_followup_emails, "
+                "max(cd.total_rvms) as total_rvms "
+                "from campaign_dashboard cd "
+                "where cd.campaign_id = :campaign_id "
+                "and cd.store_id = :store_id "
+                "and cd.last_update between :start_date and :end_date "
+                "group by bucket "
+                "order by bucket asc")
+
+    rows = read_session().execute(stmt, {
+        'bucket': bucket_seconds,
+        'campaign_id': campaign_pk_id,
+        'store_id': store_pk_id,
+        'start_date': start_date,
+        'end_date': end_date
+    }).fetchall()
+
+    return {
+        'bucket_seconds': bucket_seconds,
+        'labels': [row.last_update.strftime('%Y-%m-%d %H:%M') for row in rows],
+        'visitors': [row.total_visitors or 0 for row in rows],
+        'appends': [row.total_appends or 0 for row in rows],
+        'emails': [row.total_followup_emails or 0 for row in rows],
+        'rvms': [row.total_rvms or 0 for row in rows]
+    }
+
+
+def get_group_dashboard(group_pk_id):
+    """
+    Roll up the latest store and campaign dashboards for
+    every store in the dealer group.  Each rollup is a single
+    grouped statement over all stores, cached for
+    GROUP_DASHBOARD_CACHE_TTL seconds.
+    :param group_pk_id:
+    :return: dict totals, stores
+    """
+    now = time.time()
+
+    with group_dashboard_lock:
+        cached = group_dashboard_cache.get(group_pk_id)
+        if cached and cached[0] > now:
+            return cached[1]
+
+    # latest store dashboard row per store in the group
+    store_stmt = text("select s.id as store_id, s.name as store_name, sd.total_campaigns, sd.active_campaigns, "
+                      "sd.total_global_visitors, sd.total_unique_visitors, sd.total_us_visitors, sd.total_appends, "
+                      "sd.total_sent_to_dealer, sd.total_sent_followup_emails, sd.total_rvms_sent, "
+                      "sd.global_append_rate, sd.unique_append_rate, sd.us_append_rate, sd.last_update "
+                      "from stores s "
+                      "join (select d.store_id, max(d.last_update) as last_update "
+                      "      from store_dashboard d, stores gs "
+                      "      where gs.id = d.store_id and gs.dealer_group_id = :group_id "
+                      "      group by d.store_id) latest on latest.store_id = s.id "
+                      "join store_dashboard sd on sd.store_id = latest.store_id "
+                      "and sd.last_update = latest.last_update "
+                      "where s.dealer_group_id = :group_id "
+                      "and s.archived = 0 "
+                      "order by s.name asc")
+
+    # latest campaign dashboard row per active campaign, summed per store
+    campaign_stmt = text("select cd.store_id, count(cd.campaign_id) as campaigns, "
+                         "sum(cd.total_visitors) as total_visitors, sum(cd.total_appends) as total_appends, "
+                         "sum(cd.total_rtns) as total_rtns, sum(cd.total_followup_emails) as total_followup_emails, "
+                         "sum(cd.total_rvms) as total_rvms "
+                         "from campaign_dashboard cd "
+                         "join (select d.campaign_id, max(d.last_update) as last_update "
+                         "      from campaign_dashboard d, campaigns c, stores s "
+                         "      where c.id = d.campaign_id and s.id = c.store_id "
+                         "      and s.dealer_group_id = :group_id "
+                         "      and c.status = 'ACTIVE' and c.archived = 0 "
+                         "      group by d.campaign_id) latest on latest.campaign_id = cd.campaign_id "
+                         "and latest.last_update = cd.last_update "
+                         "group by cd.store_id")
+
+    store_rows = read_session().execute(store_stmt, {'group_id': group_pk_id}).fetchall()
+    campaign_rows = read_session().execute(campaign_stmt, {'group_id': group_pk_id}).fetchall()
+    campaign_totals = dict((row.store_id, row) for row in campaign_rows)
+
+    count_fields = ('total_campaigns', 'active_campaigns', 'total_global_visitors', 'total_unique_visitors',
+                    'total_us_visitors', 'total_appends', 'total_sent_to_dealer', 'total_sent_followup_emails',
+                    'total_rvms_sent')
+    totals = dict((field, 0) for field in count_fields)
+    weighted_rates = {'global_append_rate': 0.0, 'unique_append_rate': 0.0, 'us_append_rate': 0.0}
+    stores = []
+
+    for row in store_rows:
+        for field in count_fields:
+            totals[field] += row[field] or 0
+
+        # weight each store's rate by the visitors it was computed over
+        weighted_rates['global_append_rate'] += (row.global_append_rate or 0) * (row.total_global_visitors or 0)
+        weighted_rates['unique_append_rate'] += (row.unique_append_rate or 0) * (row.total_unique_visitors or 0)
+        weighted_rates['us_append_rate'] += (row.us_append_rate or 0) * (row.total_us_visitors or 0)
+
+        stores.append({
+            'store': row,
+            'campaigns': campaign_totals.get(row.store_id)
+        })
+
+    totals['global_append_rate'] = _safe_rate(weighted_rates['global_append_rate'], totals['total_global_visitors'])
+    totals['unique_append_rate'] = _safe_rate(weighted_rates['unique_append_rate'], totals['total_unique_visitors'])
+    totals['us_append_rate'] = _safe_rate(weighted_rates['us_append_rate'], totals['total_us_visitors'])
+    totals['store_count'] = len(stores)
+
+    dashboard = {'totals': totals, 'stores': stores}
+
+    with group_dashboard_lock:
+        group_dashboard_cache[group_pk_id] = (now + GROUP_DASHBOARD_CACHE_TTL, dashboard)
+
+    return dashboard
+
+
+def _safe_rate(weighted_sum, weight):
+    if not weight:
+        return 0.0
+    return round(float(weighted_sum) / weight, 2)
+
+
+def get_campaign_leads(campaign_pk_id, sort='id'):
+    """
+    Get the converted leads for the campaign, best score first when
+    sorted by score (served by ix_visitors_campaign_score)
+    :param campaign_pk_id:
+    :param sort: id or score
+    :return: list
+    """
+    order_by = 'v.lead_score desc, v.id asc' if sort == 'score' else 'v.id asc'
+
+    stmt = text('select v.id, v.lead_score, av.first_name, av.last_name, av.email, av.home_phone, '
+                'av.credit_range, av.car_year, av.car_model, av.car_make '
+                'from visitors v, appendedvisitors av '
+                'where v.id = av.visitor '
+                'and v.campaign_id = :campaign_id '
+                'order by {}'.format(order_by))
+
+    return read_session().query('id', 'lead_score', 'first_name', 'last_name', 'email', 'home_phone',
+                                'credit_range', 'car_make', 'car_year', 'car_model').from_statement(stmt).params(
+        campaign_id=campaign_pk_id
+    ).all()
+
+
 def get_active_campaigns(store_pk_id):
     """
     Get a list of active store campaigns
@@ -702,7 +1298,7 @@ def get_active_campaigns(store_pk_id):
     """
 
     # get a list of active store campaigns
-    campaigns = db_session.query(Campaign).filter(
+    campaigns = read_session().query(Campaign).filter(
         Campaign.store_id == store_pk_id,
         Campaign.status == 'ACTIVE'
     ).order_by(Campaign.created_date.desc()).all()
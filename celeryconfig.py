@@ -0,0 +1,152 @@
+"""
+Celery configuration for the EARL Dealer FrontEnd
+
+Tasks are routed to named queues so that long running report and
+aggregation jobs can never starve transactional email.  Each queue is
+consumed by its own worker, started with the matching profile:
+
+    CELERY_WORKER_PROFILE=mail celery -A app.celery worker -Q mail -n mail@%h
+    CELERY_WORKER_PROFILE=reports celery -A app.celery worker -Q reports -n reports@%h
+    CELERY_WORKER_PROFILE=aggregation celery -A app.celery worker -Q aggregation -n aggregation@%h
+
+Set CELERY_MEMORY_BROKER=1 to run against the in-memory broker and
+result backend (tests and per-queue throughput benchmarks).
+"""
+from celery.schedules import crontab
+from datetime import timedelta
+from kombu import Exchange, Queue
+import config
+import os
+
+# broker and results
+BROKER_URL = config.CELERY_BROKER_URL
+CELERY_RESULT_BACKEND = config.CELERY_RESULT_BACKEND
+CELERY_TASK_RESULT_EXPIRES = 60 * 60 * 6
+
+# serialization, no more pickle
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json', 'msgpack']
+
+# queues and routing
+default_exchange = Exchange('default', type='direct')
+
+CELERY_DEFAULT_QUEUE = 'default'
+CELERY_DEFAULT_EXCHANGE = 'default'
+CELERY_DEFAULT_ROUTING_KEY = 'default'
+
+CELERY_QUEUES = (
+    Queue('default', default_exchange, routing_key='default'),
+    Queue('mail', default_exchange, routing_key='mail'),
+    Queue('reports', default_exchange, routing_key='reports'),
+    Queue('aggregation', default_exchange, routing_key='aggregation'),
+)
+
+CELERY_ROUTES = {
+    'app.send_async_email': {'queue': 'mail', 'routing_key': 'mail'},
+    'app.long_task': {'queue': 'reports', 'routing_key': 'reports'},
+    'app.dispatch_rvms': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.deliver_adf_leads': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.process_visitors': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.fan_out_visitor_processing': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.reclaim_visitor_leases': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.enrich_geoip': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.refresh_lead_scores': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.rollup_email_events': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.purge_expired_campaigns': {'queue': 'aggregation', 'routing_key': 'aggregation'},
+    'app.send_daily_recaps': {'queue': 'reports', 'routing_key': 'reports'},
+    'app.send_store_recap': {'queue': 'reports', 'routing_key': 'reports'},
+}
+
+# periodic tasks, run with: celery -A app.celery beat
+CELERYBEAT_SCHEDULE = {
+    'fan-out-visitor-processing': {
+        'task': 'app.fan_out_visitor_processing',
+        'schedule': timedelta(minutes=1),
+        'kwargs': {'workers': 4},
+    },
+    'reclaim-visitor-leases': {
+        'task': 'app.reclaim_visitor_leases',
+        'schedule': timedelta(minutes=5),
+    },
+    'enrich-geoip': {
+        'task': 'app.enrich_geoip',
+        'schedule': timedelta(minutes=1),
+    },
+    # claimed leads are leased for RVM_LEASE_SECONDS (90 minutes), longer than
+    # the task's 60 minute limit, so overlapping runs never share a lead
+    'dispatch-rvms': {
+        'task': 'app.dispatch_rvms',
+        'schedule': timedelta(minutes=15),
+        'options': {'expires': 60 * 10},
+    },
+    # ADF leads are not leased: the message expiry plus the task's hard
+    # time limit stay under the interval so two runs never overlap
+    'deliver-adf-leads': {
+        'task': 'app.deliver_adf_leads',
+        'schedule': timedelta(minutes=30),
+        'options': {'expires': 60 * 5},
+    },
+    'refresh-lead-scores': {
+        'task': 'app.refresh_lead_scores',
+        'schedule': timedelta(minutes=10),
+    },
+    'rollup-email-events': {
+        'task': 'app.rollup_email_events',
+        'schedule': timedelta(minutes=5),
+    },
+    # yesterday's recap to every active store, the reports workers bound the db concurrency
+    'send-daily-recaps': {
+        'task': 'app.send_daily_recaps',
+        'schedule': crontab(hour=5, minute=0),
+    },
+    # retention purge, re-enqueues itself from its checkpoints until done
+    'purge-expired-campaigns': {
+        'task': 'app.purge_expired_campaigns',
+        'schedule': crontab(hour=2, minute=0),
+    },
+}
+
+# global task limits, tasks may override with their own time_limit
+CELERYD_TASK_TIME_LIMIT = 60 * 30
+CELERYD_TASK_SOFT_TIME_LIMIT = 60 * 25
+CELERY_ACKS_LATE = True
+CELERYD_PREFETCH_MULTIPLIER = 1
+CELERYD_MAX_TASKS_PER_CHILD = 1000
+
+# worker concurrency profiles, one per queue
+WORKER_PROFILES = {
+    # many short network bound tasks, prefetch a few at a time
+    'mail': {
+        'CELERYD_CONCURRENCY': 16,
+        'CELERYD_PREFETCH_MULTIPLIER': 4,
+        'CELERYD_TASK_TIME_LIMIT': 120,
+        'CELERYD_TASK_SOFT_TIME_LIMIT': 90,
+    },
+    # few long database bound tasks, never hold more than one
+    'reports': {
+        'CELERYD_CONCURRENCY': 4,
+        'CELERYD_PREFETCH_MULTIPLIER': 1,
+        'CELERYD_TASK_TIME_LIMIT': 60 * 30,
+        'CELERYD_TASK_SOFT_TIME_LIMIT': 60 * 25,
+    },
+    'aggregation': {
+        'CELERYD_CONCURRENCY': 4,
+        'CELERYD_PREFETCH_MULTIPLIER': 1,
+        'CELERYD_TASK_TIME_LIMIT': 60 * 60,
+        'CELERYD_TASK_SOFT_TIME_LIMIT': 60 * 55,
+    },
+    'default': {
+        'CELERYD_CONCURRENCY': 4,
+        'CELERYD_PREFETCH_MULTIPLIER': 1,
+    },
+}
+
+worker_profile = os.environ.get('CELERY_WORKER_PROFILE')
+if worker_profile:
+    globals().update(WORKER_PROFILES[worker_profile])
+
+# local in-memory broker for tests and benchmarks
+if os.environ.get('CELERY_MEMORY_BROKER'):
+    BROKER_URL = 'memory://'
+    CELERY_RESULT_BACKEND = 'cache+memory://'
@@ -0,0 +1,215 @@
+"""
+Followup email open and click tracking
+
+Followup emails carry a signed token per lead: an open pixel at
+/t/o/<token>.gif and click links through /t/c/<token>, where the click
+token also signs the destination url so the redirect cannot be abused.
+The followup email sender lives outside this app; it passes every body
+through track_html(lead_id, html) before sending, which rewrites the
+links and adds the pixel against EMAIL_TRACKING_BASE_URL.
+Events are buffered in process (pixel.BatchBuffer) and appended to a
+MongoDB collection with insert_many.  rollup() periodically recomputes
+the open and click counts of every lead with new events onto the leads
+table, so the emails view never reads the raw events.
+
+MONGO_URI = 'mongomock://localhost' runs against mongomock for tests.
+"""
+from database import db_session
+from itsdangerous import URLSafeSerializer, BadSignature
+from pixel import BatchBuffer
+from sqlalchemy import text
+from xml.sax.saxutils import unescape
+import collections
+import config
+import datetime
+import os
+import re
+
+MONGO_URI = getattr(config, 'MONGO_URI', 'mongodb://localhost:27017')
+MONGO_DATABASE = getattr(config, 'MONGO_DATABASE', 'earl')
+EMAIL_EVENTS_COLLECTION = getattr(config, 'EMAIL_EVENTS_COLLECTION', 'email_events')
+EMAIL_EVENT_FLUSH_INTERVAL_MS = getattr(config, 'EMAIL_EVENT_FLUSH_INTERVAL_MS', 1000)
+EMAIL_EVENT_FLUSH_EVENTS = getattr(config, 'EMAIL_EVENT_FLUSH_EVENTS', 500)
+EMAIL_ROLLUP_CHUNK_SIZE = getattr(config, 'EMAIL_ROLLUP_CHUNK_SIZE', 1000)
+# events reach the store up to a flush interval late, re-read this much overlap
+EMAIL_ROLLUP_GRACE_SECONDS = getattr(config, 'EMAIL_ROLLUP_GRACE_SECONDS', 300)
+# public scheme and host of this app, the tracking urls must be absolute
+EMAIL_TRACKING_BASE_URL = getattr(config, 'EMAIL_TRACKING_BASE_URL', '')
+
+ROLLUP_STATE_COLLECTION = 'email_rollups'
+
+EVENT_OPEN = 'open'
+EVENT_CLICK = 'click'
+
+LINK_PATTERN = re.compile(r'''(<a\b[^>]*?\bhref\s*=\s*)(["'])(https?://[^"']+)\2''', re.IGNORECASE)
+
+Event = collections.namedtuple('Event', ['lead_id', 'type', 'ts', 'ip', 'user_agent', 'url'])
+
+serializer = URLSafeSerializer(config.SECRET_KEY, salt='email-tracking')
+
+
+def open_token(lead_pk_id):
+    return serializer.dumps([EVENT_OPEN, int(lead_pk_id)])
+
+
+def click_token(lead_pk_id, url):
+    return serializer.dumps([EVENT_CLICK, int(lead_pk_id), url])
+
+
+def open_url(lead_pk_id, base_url=EMAIL_TRACKING_BASE_URL):
+    return '{}/t/o/{}.gif'.format(base_url.rstrip('/'), open_token(lead_pk_id))
+
+
+def click_url(lead_pk_id, url, base_url=EMAIL_TRACKING_BASE_URL):
+    return '{}/t/c/{}'.format(base_url.rstrip('/'), click_token(lead_pk_id, url))
+
+
+def track_html(lead_pk_id, html, base_url=EMAIL_TRACKING_BASE_URL):
+    """
+    Add tracking to a followup email body: http(s) links go through the
+    click redirect and the open pixel is added at the end of the body
+    :param lead_pk_id:
+    :param html:
+    :param base_url:
+    :return: str html
+    """
+    html = LINK_PATTERN.sub(lambda match: '{0}{1}{2}{1}'.format(
+        match.group(1), match.group(2), click_url(lead_pk_id, unescape(match.group(3)), base_url)
+    ), html)
+
+    pixel = '<img src="{}" width="1" height="1" alt="" style="display:none">'.format(open_url(lead_pk_id, base_url))
+    end = html.lower().rfind('</body>')
+    if end == -1:
+        return html + pixel
+    return html[:end] + pixel + html[end:]
+
+
+def load_token(token, kind):
+    """
+    Verify a tracking token
+    :param token:
+    :param kind: EVENT_OPEN or EVENT_CLICK
+    :return: tuple (lead id, url or None) or None when invalid
+    """
+    try:
+        payload = serializer.loads(token)
+    except BadSignature:
+        return None
+
+    if not payload or payload[0] != kind:
+        return None
+    if kind == EVENT_CLICK:
+        return payload[1], payload[2]
+    return payload[1], None
+
+
+class EventStore(object):
+    """
+    Append-only MongoDB event collection, one client per process
+    """
+
+    def __init__(self, uri=MONGO_URI, database=MONGO_DATABASE, collection=EMAIL_EVENTS_COLLECTION):
+        self.uri = uri
+        self.database = database
+        self.collection_name = collection
+        self.pid = None
+        self.collection = None
+
+    def get_collection(self):
+        # MongoClient is not fork safe, celery and uwsgi workers each open their own
+        if self.pid != os.getpid():
+            uri = self.uri
+            if uri.startswith('mongomock://'):
+                from mongomock import MongoClient
+                uri = uri.replace('mongomock://', 'mongodb://', 1)
+            else:
+                from pymongo import MongoClient
+
+            collection = MongoClient(uri, connect=False)[self.database][self.collection_name]
+            collection.create_index([('lead_id', 1), ('type', 1)])
+            collection.create_index([('ts', 1)])
+            self.collection = collection
+            self.pid = os.getpid()
+        return self.collection
+
+    def __call__(self, events):
+        self.get_collection().insert_many([event._asdict() for event in events], ordered=False)
+
+
+event_store = EventStore()
+event_buffer = BatchBuffer(event_store, max_items=EMAIL_EVENT_FLUSH_EVENTS,
+                           interval_ms=EMAIL_EVENT_FLUSH_INTERVAL_MS)
+
+
+def record_event(lead_pk_id, kind, ip, user_agent, url=None):
+    """
+    Buffer an open or click
+    :return: None
+    """
+    event_buffer.add(Event(int(lead_pk_id), kind, datetime.datetime.now(), (ip or '')[:45],
+                           (user_agent or '')[:255], url))
+
+
+def lead_counts(collection, lead_ids):
+    """
+    Open and click totals for the leads from the raw events
+    :param collection:
+    :param lead_ids:
+    :return: dict lead id -> dict
+    """
+    counts = dict((lead_id, {'id': lead_id, 'opens': 0, 'clicks': 0, 'opened': None, 'clicked': None})
+                  for lead_id in lead_ids)
+
+    for row in collection.aggregate([
+        {'$match': {'lead_id': {'$in': list(lead_ids)}}},
+        {'$group': {'_id': {'lead_id': '$lead_id', 'type': '$type'}, 'count': {'$sum': 1}, 'first': {'$min': '$ts'}}}
+    ]):
+        lead = counts[row['_id']['lead_id']]
+        if row['_id']['type'] == EVENT_OPEN:
+            lead['opens'], lead['opened'] = row['count'], row['first']
+        elif row['_id']['type'] == EVENT_CLICK:
+            lead['clicks'], lead['clicked'] = row['count'], row['first']
+
+    return counts
+
+
+def rollup(store=event_store, session=db_session, chunk_size=EMAIL_ROLLUP_CHUNK_SIZE,
+           grace_seconds=EMAIL_ROLLUP_GRACE_SECONDS):
+    """
+    Recompute the email counts of every lead with events since the last
+    rollup.  Totals are absolute, so overlapping or repeated runs are safe.
+    :param store:
+    :param session:
+    :param chunk_size:
+    :param grace_seconds:
+    :return: int leads updated
+    """
+    collection = store.get_collection()
+    state_collection = collection.database[ROLLUP_STATE_COLLECTION]
+    started = datetime.datetime.now()
+
+    state = state_collection.find_one({'_id': EMAIL_EVENTS_COLLECTION})
+    match = {}
+    if state:
+        match['ts'] = {'$gte': state['since'] - datetime.timedelta(seconds=grace_seconds)}
+
+    lead_ids = sorted(row['_id'] for row in collection.aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$lead_id'}}
+    ]))
+
+    stmt = text("update leads set email_opens = :opens, email_clicks = :clicks, "
+                "email_opened_date = :opened, email_clicked_date = :clicked "
+                "where id = :id")
+
+    for start in range(0, len(lead_ids), chunk_size):
+        counts = lead_counts(collection, lead_ids[start:start + chunk_size])
+        try:
+            session.execute(stmt, list(counts.values()))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    state_collection.replace_one({'_id': EMAIL_EVENTS_COLLECTION}, {'since': started}, upsert=True)
+    return len(lead_ids)
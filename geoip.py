@@ -0,0 +1,216 @@
+"""
+Local GeoIP enrichment
+
+Looks visitor IPs up in a local MaxMind (GeoIP2/GeoLite2 City) database
+opened with mmap, so there is no network call and the OS page cache is
+shared across worker processes.  Results are cached per IP in a bounded
+LRU and written back with executemany updates.
+
+Enrichment is independent of the visitor work queue: it picks every
+visitor without a country code (ix_visitors_geo_pending), processed or
+not, and its updates only fill rows that still have no country code, so
+they never overwrite geo data a processor wrote in the meantime.
+"""
+from database import db_session
+from sqlalchemy import text
+import collections
+import config
+import maxminddb
+import threading
+
+GEOIP_DATABASE = getattr(config, 'GEOIP_DATABASE', '/usr/share/GeoIP/GeoLite2-City.mmdb')
+GEOIP_CACHE_SIZE = getattr(config, 'GEOIP_CACHE_SIZE', 100000)
+GEOIP_BATCH_SIZE = getattr(config, 'GEOIP_BATCH_SIZE', 2000)
+
+# visitors with no match are marked so they are not looked up again
+GEOIP_UNKNOWN = '--'
+
+GEO_COLUMNS = ('country_code', 'country_name', 'city', 'region', 'region_name', 'postal_code', 'dma_code',
+               'metro_code', 'latitude', 'longitude', 'time_zone')
+
+
+class LRUCache(object):
+    """
+    Bounded least recently used cache
+    """
+
+    def __init__(self, size=GEOIP_CACHE_SIZE):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _name(record, key):
+    return (record.get(key) or {}).get('names', {}).get('en')
+
+
+def geo_fields(record):
+    """
+    Map a GeoIP2 City record onto the visitor geo columns
+    :param record: dict or None
+    :return: dict
+    """
+    if not record:
+        fields = dict((column, None) for column in GEO_COLUMNS)
+        fields['country_code'] = GEOIP_UNKNOWN
+        return fields
+
+    location = record.get('location') or {}
+    subdivision = (record.get('subdivisions') or [{}])[0]
+    metro_code = location.get('metro_code')
+    latitude = location.get('latitude')
+    longitude = location.get('longitude')
+
+    return {
+        'country_code': (record.get('country') or {}).get('iso_code') or GEOIP_UNKNOWN,
+        'country_name': _name(record, 'country'),
+        'city': _name(record, 'city'),
+        'region': subdivision.get('iso_code'),
+        'region_name': subdivision.get('names', {}).get('en'),
+        'postal_code': ((record.get('postal') or {}).get('code') or '')[:5] or None,
+        'dma_code': str(metro_code) if metro_code else None,
+        'metro_code': str(metro_code) if metro_code else None,
+        'latitude': str(latitude) if latitude is not None else None,
+        'longitude': str(longitude) if longitude is not None else None,
+        'time_zone': location.get('time_zone')
+    }
+
+
+class GeoIPEnricher(object):
+    """
+    Enrich visitors from the local GeoIP database
+    """
+
+    def __init__(self, path=GEOIP_DATABASE, cache_size=GEOIP_CACHE_SIZE, session=db_session):
+        self.reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+        self.cache = LRUCache(cache_size)
+        self.session = session
+
+    def lookup(self, ip):
+        """
+        Geo fields for an IP
+        :param ip:
+        :return: dict
+        """
+        if not ip:
+            # marked unknown too, or they would stay in the pending range
+            return geo_fields(None)
+
+        fields = self.cache.get(ip)
+        if fields is None:
+            try:
+                record = self.reader.get(ip)
+            except ValueError:
+                record = None
+            fields = geo_fields(record)
+            self.cache.put(ip, fields)
+        return fields
+
+    def enrich_batch(self, last_id=0, batch_size=GEOIP_BATCH_SIZE):
+        """
+        Enrich the next batch of visitors without geo data
+        :param last_id: resume after this visitor id
+        :param batch_size:
+        :return: tuple (rows enriched, last visitor id)
+        """
+        rows = self.session.execute(
+            text("select id, ip from visitors "
+                 "where country_code is NULL "
+                 "and id > :last_id "
+                 "order by id asc "
+                 "limit :limit"),
+            {'last_id': last_id, 'limit': batch_size}
+        ).fetchall()
+
+        if not rows:
+            return 0, last_id
+
+        updates = []
+        for row in rows:
+            fields = dict(self.lookup(row.ip))
+            fields['id'] = row.id
+            updates.append(fields)
+
+        try:
+            self.session.execute(
+                text("update visitors set {} where id = :id and country_code is NULL".format(
+                    ', '.join('{0} = :{0}'.format(column) for column in GEO_COLUMNS))),
+                updates
+            )
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        return len(updates), rows[-1].id
+
+    def run(self, batch_size=GEOIP_BATCH_SIZE, max_batches=None):
+        """
+        Enrich batches until there is nothing left
+        :param batch_size:
+        :param max_batches:
+        :return: dict counts
+        """
+        stats = {'batches': 0, 'enriched': 0}
+        last_id = 0
+
+        while max_batches is None or stats['batches'] < max_batches:
+            count, last_id = self.enrich_batch(last_id, batch_size)
+            if not count:
+                break
+            stats['batches'] += 1
+            stats['enriched'] += count
+
+        stats['cache_hits'] = self.cache.hits
+        stats['cache_misses'] = self.cache.misses
+        return stats
+
+
+def benchmark(path=GEOIP_DATABASE, lookups=500000, distinct=50000):
+    """
+    Measure lookups per minute on one core
+    :param path:
+    :param lookups:
+    :param distinct: distinct ips, repeats exercise the LRU
+    :return: float lookups per minute
+    """
+    import random
+    import time
+
+    enricher = GeoIPEnricher(path, session=None)
+    ips = ['{}.{}.{}.{}'.format(random.randint(1, 223), random.randint(0, 255), random.randint(0, 255),
+                                random.randint(1, 254)) for i in range(distinct)]
+
+    started = time.time()
+    for i in range(lookups):
+        enricher.lookup(ips[i % distinct])
+    elapsed = time.time() - started
+
+    return lookups / elapsed * 60
+
+
+if __name__ == '__main__':
+    print('GeoIP lookups: {:,.0f}/minute'.format(benchmark()))
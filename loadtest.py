@@ -0,0 +1,63 @@
+"""
+Concurrent request benchmark
+
+Compare the sync workers against the gevent serving mode:
+
+    python app.py                            # sync, port 8880
+    EARL_GEVENT=1 python wsgi.py             # gevent, port 8880
+    python loadtest.py http://localhost:8880/reports --concurrency 50 --requests 2000 --cookie 'session=...'
+"""
+from multiprocessing.pool import ThreadPool
+import argparse
+import requests
+import time
+
+
+def run(url, concurrency=50, total=1000, cookie=None):
+    """
+    Fire total GET requests at url, concurrency at a time
+    :return: dict throughput and latency percentiles
+    """
+    headers = {'Cookie': cookie} if cookie else {}
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def fetch(i):
+        started = time.time()
+        try:
+            ok = session.get(url, headers=headers, allow_redirects=False, timeout=60).status_code < 400
+        except requests.RequestException:
+            ok = False
+        return time.time() - started, ok
+
+    pool = ThreadPool(concurrency)
+    started = time.time()
+    try:
+        results = pool.map(fetch, range(total))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+
+    latencies = sorted(latency for latency, ok in results)
+    return {
+        'requests': total,
+        'errors': sum(1 for latency, ok in results if not ok),
+        'seconds': round(elapsed, 2),
+        'requests_per_second': round(total / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent request benchmark')
+    parser.add_argument('url')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--cookie', default=None)
+    args = parser.parse_args()
+
+    for key, value in sorted(run(args.url, args.concurrency, args.requests, args.cookie).items()):
+        print('{}: {}'.format(key, value))
@@ -0,0 +1,26 @@
+-- Dealer groups: group level accounts that roll up every store in the group.
+
+CREATE TABLE dealer_groups (
+    id INT NOT NULL AUTO_INCREMENT,
+    name VARCHAR(255) NOT NULL,
+    active TINYINT(1) DEFAULT 1,
+    created_date DATETIME NULL,
+    PRIMARY KEY (id),
+    UNIQUE KEY uq_dealer_groups_name (name)
+);
+
+ALTER TABLE stores
+    ADD COLUMN dealer_group_id INT NULL,
+    ADD KEY ix_stores_dealer_group_id (dealer_group_id),
+    ADD CONSTRAINT fk_stores_dealer_group FOREIGN KEY (dealer_group_id) REFERENCES dealer_groups (id);
+
+ALTER TABLE dealer_users
+    ADD COLUMN dealer_group_id INT NULL,
+    ADD CONSTRAINT fk_dealer_users_dealer_group FOREIGN KEY (dealer_group_id) REFERENCES dealer_groups (id);
+
+-- latest snapshot lookups (order by last_update desc limit 1, and max(last_update) group by)
+ALTER TABLE store_dashboard
+    ADD KEY ix_store_dashboard_store_last_update (store_id, last_update);
+
+ALTER TABLE campaign_dashboard
+    ADD KEY ix_campaign_dashboard_campaign_last_update (campaign_id, last_update);
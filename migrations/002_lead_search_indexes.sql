@@ -0,0 +1,20 @@
+-- Prefix search over appended visitors by last name, email and phone.
+-- The default case-insensitive collation lets `like 'prefix%'` use the
+-- last_name and email indexes directly.  Phone numbers are matched on
+-- stored generated columns holding the digits only.
+
+ALTER TABLE appendedvisitors
+    ADD COLUMN home_phone_digits VARCHAR(15) AS (
+        REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(home_phone, '-', ''), '(', ''), ')', ''), ' ', ''), '.', ''), '+', '')
+    ) STORED,
+    ADD COLUMN cell_phone_digits VARCHAR(15) AS (
+        REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(REPLACE(cell_phone, '-', ''), '(', ''), ')', ''), ' ', ''), '.', ''), '+', '')
+    ) STORED,
+    ADD KEY ix_appendedvisitors_last_name (last_name, first_name),
+    ADD KEY ix_appendedvisitors_email (email),
+    ADD KEY ix_appendedvisitors_home_phone_digits (home_phone_digits),
+    ADD KEY ix_appendedvisitors_cell_phone_digits (cell_phone_digits),
+    ADD KEY ix_appendedvisitors_visitor (visitor);
+
+ALTER TABLE leads
+    ADD KEY ix_leads_appended_visitor_id (appended_visitor_id);
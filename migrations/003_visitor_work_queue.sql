@@ -0,0 +1,6 @@
+-- Visitor work queue claims: processed = 0 and locked = 0, ordered by id.
+-- InnoDB secondary indexes carry the primary key, so this index serves
+-- the ordered claim scan and the expired lease sweep.
+
+ALTER TABLE visitors
+    ADD KEY ix_visitors_queue (processed, locked, status);
@@ -0,0 +1,14 @@
+-- Pixel hit ingestion looks visitors up by (campaign, ip, open hash) and
+-- adds to the lowest matching id.  The key is deliberately not unique:
+-- existing duplicates are left as they are (their appended visitors and
+-- leads stay on their own rows) and nothing has to be merged or backfilled.
+--
+-- Cutover for the PixelTracker hosts: they can keep inserting visitor
+-- rows while campaigns move to /pixel.gif, no insert is ever rejected.
+-- Move one tracker at a time by pointing its pixel URL at
+-- /pixel.gif?cid=<campaign_id>&oh=<open_hash>&ch=<campaign_hash>&sh=<send_hash>;
+-- from then on its hits add onto the rows it created before.
+
+ALTER TABLE visitors
+    ADD KEY ix_visitors_campaign_ip_open (campaign_id, ip, open_hash),
+    ALGORITHM=INPLACE, LOCK=NONE;
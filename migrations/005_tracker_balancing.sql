@@ -0,0 +1,8 @@
+-- Admin users for the PixelTracker balancing and other operator views.
+
+ALTER TABLE dealer_users
+    ADD COLUMN is_admin TINYINT(1) DEFAULT 0;
+
+-- recent visitor volume per campaign
+ALTER TABLE visitors
+    ADD KEY ix_visitors_campaign_created (campaign_id, created_date);
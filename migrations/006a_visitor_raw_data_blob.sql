@@ -0,0 +1,8 @@
+-- Visitor.raw_data is stored zlib compressed (models.CompressedText).
+-- TEXT -> MEDIUMBLOB keeps the existing bytes, which stay readable
+-- uncompressed until 006b_compress_visitor_raw_data.py rewrites them.
+-- This rebuilds the visitors table, run it with an online schema change
+-- tool on production.
+
+ALTER TABLE visitors
+    MODIFY raw_data MEDIUMBLOB NULL;
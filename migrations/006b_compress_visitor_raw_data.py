@@ -0,0 +1,82 @@
+"""
+Backfill: compress existing Visitor.raw_data values in primary key
+ordered chunks.  Safe to stop and re-run, compressed rows are skipped.
+
+    python migrations/006b_compress_visitor_raw_data.py --chunk-size 1000 --pause 0.1
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db_session
+from models import CompressedText
+from sqlalchemy import text, bindparam, LargeBinary
+import argparse
+import time
+import zlib
+
+
+def compress_raw_data(chunk_size=1000, pause=0.1, start_id=0, session=db_session):
+    """
+    Compress the raw_data of every visitor after start_id
+    :param chunk_size:
+    :param pause: seconds to sleep between chunks
+    :param start_id:
+    :param session:
+    :return: dict counts
+    """
+    select_stmt = text("select id, raw_data from visitors "
+                       "where id > :last_id "
+                       "order by id asc "
+                       "limit :limit")
+    update_stmt = text("update visitors set raw_data = :raw_data where id = :id").bindparams(
+        bindparam('raw_data', type_=LargeBinary)
+    )
+
+    stats = {'last_id': start_id, 'scanned': 0, 'compressed': 0, 'bytes_before': 0, 'bytes_after': 0}
+
+    while True:
+        rows = session.execute(select_stmt, {'last_id': stats['last_id'], 'limit': chunk_size}).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            value = row.raw_data
+            if value is None:
+                continue
+            if isinstance(value, type(u'')):
+                value = value.encode('utf-8')
+            value = bytes(value)
+            if value.startswith(CompressedText.prefix):
+                continue
+
+            compressed = CompressedText.prefix + zlib.compress(value, 6)
+            updates.append({'id': row.id, 'raw_data': compressed})
+            stats['bytes_before'] += len(value)
+            stats['bytes_after'] += len(compressed)
+
+        if updates:
+            session.execute(update_stmt, updates)
+        session.commit()
+
+        stats['scanned'] += len(rows)
+        stats['compressed'] += len(updates)
+        stats['last_id'] = rows[-1].id
+        print('visitors through id {last_id}: {scanned} scanned, {compressed} compressed, '
+              '{bytes_before} -> {bytes_after} bytes'.format(**stats))
+
+        if pause:
+            time.sleep(pause)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compress existing Visitor.raw_data values')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0.1)
+    parser.add_argument('--start-id', type=int, default=0)
+    args = parser.parse_args()
+
+    compress_raw_data(chunk_size=args.chunk_size, pause=args.pause, start_id=args.start_id)
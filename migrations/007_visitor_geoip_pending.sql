@@ -0,0 +1,7 @@
+-- Local GeoIP enrichment scans visitors without a country code by id,
+-- whether or not the work queue has processed them.  InnoDB secondary
+-- indexes carry the primary key, so the NULL range is read in id order.
+
+ALTER TABLE visitors
+    ADD KEY ix_visitors_geo_pending (country_code),
+    ALGORITHM=INPLACE, LOCK=NONE;
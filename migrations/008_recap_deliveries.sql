@@ -0,0 +1,17 @@
+-- Nightly daily recap email runs, one row per store per run with its timing.
+
+CREATE TABLE recap_deliveries (
+    id INT NOT NULL AUTO_INCREMENT,
+    store_id INT NOT NULL,
+    recap_date DATETIME NOT NULL,
+    started_date DATETIME NOT NULL,
+    finished_date DATETIME NULL,
+    duration_ms INT NULL,
+    campaign_count INT DEFAULT 0,
+    row_count INT DEFAULT 0,
+    status VARCHAR(20) NOT NULL,
+    message VARCHAR(255) NULL,
+    PRIMARY KEY (id),
+    KEY ix_recap_deliveries_recap_date_store (recap_date, store_id),
+    CONSTRAINT fk_recap_deliveries_store FOREIGN KEY (store_id) REFERENCES stores (id)
+);
@@ -0,0 +1,22 @@
+-- Retention purge progress, one row per archived campaign past retention.
+-- last_visitor_id is committed with each chunk so a purge resumes where it stopped.
+
+CREATE TABLE retention_checkpoints (
+    id INT NOT NULL AUTO_INCREMENT,
+    campaign_id INT NOT NULL,
+    mode VARCHAR(20) NOT NULL,
+    last_visitor_id INT NOT NULL DEFAULT 0,
+    visitors_done INT NOT NULL DEFAULT 0,
+    appended_done INT NOT NULL DEFAULT 0,
+    leads_done INT NOT NULL DEFAULT 0,
+    started_date DATETIME NOT NULL,
+    updated_date DATETIME NULL,
+    finished_date DATETIME NULL,
+    lease_expires DATETIME NULL,
+    PRIMARY KEY (id),
+    UNIQUE KEY uq_retention_checkpoints_campaign (campaign_id),
+    CONSTRAINT fk_retention_checkpoints_campaign FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+);
+
+-- Chunks walk one campaign's visitors in primary key order on the
+-- visitors.campaign_id foreign key index, which InnoDB extends with the id.
@@ -0,0 +1,8 @@
+-- Followup email open and click totals, rolled up from the email_events
+-- MongoDB collection by the rollup_email_events task.
+
+ALTER TABLE leads
+    ADD COLUMN email_opens INT NOT NULL DEFAULT 0,
+    ADD COLUMN email_clicks INT NOT NULL DEFAULT 0,
+    ADD COLUMN email_opened_date DATETIME NULL,
+    ADD COLUMN email_clicked_date DATETIME NULL;
@@ -0,0 +1,8 @@
+-- Lead scores from the refresh_lead_scores task, the composite index
+-- serves the leads list and export sorted by score within a campaign.
+
+ALTER TABLE visitors
+    ADD COLUMN lead_score INT NULL,
+    ADD COLUMN score_updated DATETIME NULL,
+    ADD KEY ix_visitors_campaign_score (campaign_id, lead_score),
+    ALGORITHM=INPLACE, LOCK=NONE;
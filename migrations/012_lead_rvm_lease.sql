@@ -0,0 +1,5 @@
+-- RVM leases: claimed leads are QUEUED with rvm_date as the lease start,
+-- the sweep for leases a dead worker left behind reads this index.
+
+ALTER TABLE leads
+    ADD KEY ix_leads_rvm_status_date (rvm_status, rvm_date);
@@ -0,0 +1,8 @@
+-- score_updated is NULL-ed on every visit and append, refresh_lead_scores
+-- reads the NULL range of ix_visitors_score_updated and the recency sweep
+-- range scans recent visitors on ix_visitors_last_visit.
+
+ALTER TABLE visitors
+    ADD KEY ix_visitors_score_updated (score_updated),
+    ADD KEY ix_visitors_last_visit (last_visit),
+    ALGORITHM=INPLACE, LOCK=NONE;
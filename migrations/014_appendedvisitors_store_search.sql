@@ -0,0 +1,20 @@
+-- Store scoped lead search.  appendedvisitors gets its visitor's store_id,
+-- filled by a trigger for the rows the append providers insert, so every
+-- search branch is one (store_id, field) range scan that stops at the page.
+-- Existing rows are filled by 015_backfill_appendedvisitors_store_id.py;
+-- until it finishes, older rows are missing from search results.
+
+ALTER TABLE appendedvisitors
+    ADD COLUMN store_id INT NULL,
+    ADD KEY ix_appendedvisitors_store_last_name (store_id, last_name),
+    ADD KEY ix_appendedvisitors_store_email (store_id, email),
+    ADD KEY ix_appendedvisitors_store_home_phone (store_id, home_phone_digits),
+    ADD KEY ix_appendedvisitors_store_cell_phone (store_id, cell_phone_digits),
+    DROP KEY ix_appendedvisitors_last_name,
+    DROP KEY ix_appendedvisitors_email,
+    DROP KEY ix_appendedvisitors_home_phone_digits,
+    DROP KEY ix_appendedvisitors_cell_phone_digits,
+    ALGORITHM=INPLACE, LOCK=NONE;
+
+CREATE TRIGGER trg_appendedvisitors_store_id BEFORE INSERT ON appendedvisitors
+    FOR EACH ROW SET NEW.store_id = COALESCE(NEW.store_id, (SELECT store_id FROM visitors WHERE id = NEW.visitor));
@@ -0,0 +1,64 @@
+"""
+Backfill: copy each visitor's store_id onto its existing appended
+visitors in primary key ordered chunks.  Safe to stop and re-run, rows
+that already have a store_id are skipped.
+
+    python migrations/015_backfill_appendedvisitors_store_id.py --chunk-size 1000 --pause 0.1
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db_session
+from sqlalchemy import text
+import argparse
+import time
+
+
+def backfill_store_id(chunk_size=1000, pause=0.1, start_id=0, session=db_session):
+    """
+    Fill appendedvisitors.store_id for every row after start_id
+    :param chunk_size:
+    :param pause: seconds to sleep between chunks
+    :param start_id:
+    :param session:
+    :return: dict counts
+    """
+    select_stmt = text("select id from appendedvisitors "
+                       "where id > :last_id "
+                       "order by id asc "
+                       "limit :limit")
+    update_stmt = text("update appendedvisitors "
+                       "set store_id = (select v.store_id from visitors v where v.id = appendedvisitors.visitor) "
+                       "where id between :first_id and :last_id "
+                       "and store_id is NULL")
+
+    stats = {'last_id': start_id, 'scanned': 0, 'updated': 0}
+
+    while True:
+        rows = session.execute(select_stmt, {'last_id': stats['last_id'], 'limit': chunk_size}).fetchall()
+        if not rows:
+            break
+
+        result = session.execute(update_stmt, {'first_id': rows[0].id, 'last_id': rows[-1].id})
+        session.commit()
+
+        stats['scanned'] += len(rows)
+        stats['updated'] += result.rowcount
+        stats['last_id'] = rows[-1].id
+        print('appendedvisitors through id {last_id}: {scanned} scanned, {updated} updated'.format(**stats))
+
+        if pause:
+            time.sleep(pause)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy visitors.store_id onto existing appended visitors')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0.1)
+    parser.add_argument('--start-id', type=int, default=0)
+    args = parser.parse_args()
+
+    backfill_store_id(chunk_size=args.chunk_size, pause=args.pause, start_id=args.start_id)
@@ -1,8 +1,40 @@
 from database import Base
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Text, Float, Index, FetchedValue, \
+    LargeBinary
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy.types import TypeDecorator
 from werkzeug.security import generate_password_hash, check_password_hash
+import zlib
+
+
+class CompressedText(TypeDecorator):
+    """
+    Text stored zlib compressed in a binary column.  Values written
+    before the column was compressed have no prefix and are read as-is.
+    """
+    impl = LargeBinary
+    prefix = b'z1:'
+    # stateless, safe for SQLAlchemy's statement cache
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, type(u'')):
+            value = value.encode('utf-8')
+        return self.prefix + zlib.compress(value, 6)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, type(u'')):
+            value = value.encode('utf-8')
+        if value.startswith(self.prefix):
+            value = zlib.decompress(value[len(self.prefix):])
+        return value.decode('utf-8')
+
+
 # Define application Bases
 
 
@@ -19,6 +51,9 @@ class User(Base):
     store_id = Column(Integer, ForeignKey('stores.id'))
     store_name = relationship("Store")
     store_emp_id = Column(String(50))
+    dealer_group_id = Column(Integer, ForeignKey('dealer_groups.id'), nullable=True)
+    dealer_group = relationship("DealerGroup")
+    is_admin = Column(Boolean, default=0)
 
     def __init__(self, username, password):
         self.username = username
@@ -52,6 +87,15 @@ class User(Base):
 
 class Visitor(Base):
     __tablename__ = 'visitors'
+    __table_args__ = (
+        Index('ix_visitors_queue', 'processed', 'locked', 'status'),
+        Index('ix_visitors_campaign_ip_open', 'campaign_id', 'ip', 'open_hash'),
+        Index('ix_visitors_campaign_created', 'campaign_id', 'created_date'),
+        Index('ix_visitors_geo_pending', 'country_code'),
+        Index('ix_visitors_campaign_score', 'campaign_id', 'lead_score'),
+        Index('ix_visitors_score_updated', 'score_updated'),
+        Index('ix_visitors_last_visit', 'last_visit'),
+    )
     id = Column(Integer, primary_key=True)
     campaign_id = Column(Integer, ForeignKey('campaigns.id'), nullable=False)
     store_id = Column(Integer, ForeignKey('stores.id'))
@@ -66,7 +110,7 @@ class Visitor(Base):
     send_hash = Column(String(255))
     num_visits = Column(Integer)
     last_visit = Column(DateTime)
-    raw_data = Column(Text)
+    raw_data = deferred(Column(CompressedText))
     processed = Column(Boolean, default=False)
     campaign = relationship("Campaign")
     store = relationship("Store")
@@ -88,6 +132,8 @@ class Visitor(Base):
     last_retry = Column(DateTime)
     status = Column(String(10))
     locked = Column(Boolean, default=0)
+    lead_score = Column(Integer)
+    score_updated = Column(DateTime)
 
     def __repr__(self):
         return 'From {} on {} for {}'.format(
@@ -108,8 +154,16 @@ class Visitor(Base):
 
 class AppendedVisitor(Base):
     __tablename__ = 'appendedvisitors'
+    __table_args__ = (
+        Index('ix_appendedvisitors_store_last_name', 'store_id', 'last_name'),
+        Index('ix_appendedvisitors_store_email', 'store_id', 'email'),
+        Index('ix_appendedvisitors_store_home_phone', 'store_id', 'home_phone_digits'),
+        Index('ix_appendedvisitors_store_cell_phone', 'store_id', 'cell_phone_digits'),
+    )
     id = Column(Integer, primary_key=True)
-    visitor = Column(Integer, ForeignKey('visitors.id'))
+    visitor = Column(Integer, ForeignKey('visitors.id'), index=True)
+    # copied from the visitor by an insert trigger, scopes the search indexes
+    store_id = Column(Integer)
     visitor_relation = relationship("Visitor")
     created_date = Column(DateTime, onupdate=datetime.now)
     first_name = Column(String(255))
@@ -117,6 +171,9 @@ class AppendedVisitor(Base):
     email = Column(String(255))
     home_phone = Column(String(15))
     cell_phone = Column(String(15))
+    # generated by the database, digits only for phone prefix search
+    home_phone_digits = Column(String(15), server_default=FetchedValue(), server_onupdate=FetchedValue())
+    cell_phone_digits = Column(String(15), server_default=FetchedValue(), server_onupdate=FetchedValue())
     address1 = Column(String(255))
     address2 = Column(String(255))
     city = Column(String(255))
@@ -138,8 +195,11 @@ class AppendedVisitor(Base):
 
 class Lead(Base):
     __tablename__ = 'leads'
+    __table_args__ = (
+        Index('ix_leads_rvm_status_date', 'rvm_status', 'rvm_date'),
+    )
     id = Column(Integer, primary_key=True)
-    appended_visitor_id = Column(Integer, ForeignKey('appendedvisitors.id'), nullable=False)
+    appended_visitor_id = Column(Integer, ForeignKey('appendedvisitors.id'), nullable=False, index=True)
     appended_visitor = relationship("AppendedVisitor")
     created_date = Column(DateTime, onupdate=datetime.now)
     email_verified = Column(Boolean, default=False)
@@ -161,6 +221,10 @@ class Lead(Base):
     followup_email_sent_date = Column(DateTime)
     followup_email_receipt_id = Column(String(255), nullable=True, default='NOID')
     followup_email_status = Column(String(20), nullable=True, default='NOTSENT')
+    email_opens = Column(Integer, default=0, nullable=False)
+    email_clicks = Column(Integer, default=0, nullable=False)
+    email_opened_date = Column(DateTime)
+    email_clicked_date = Column(DateTime)
 
     def __repr__(self):
         return '{}'.format(
@@ -191,6 +255,8 @@ class Store(Base):
     archived = Column(Boolean(), default=0)
     archived_by = Column(String(50), nullable=True)
     archived_date = Column(DateTime, nullable=True)
+    dealer_group_id = Column(Integer, ForeignKey('dealer_groups.id'), nullable=True, index=True)
+    dealer_group = relationship('DealerGroup')
 
     def __repr__(self):
         return '{}'.format(
@@ -201,6 +267,19 @@ class Store(Base):
         return int(self.id)
 
 
+class DealerGroup(Base):
+    __tablename__ = 'dealer_groups'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), unique=True, nullable=False)
+    active = Column(Boolean, default=1)
+    created_date = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return '{}'.format(
+            self.name
+        )
+
+
 class CampaignType(Base):
     __tablename__ = 'campaigntypes'
     id = Column(Integer, primary_key=True)
@@ -284,6 +363,9 @@ class Contact(Base):
 
 class StoreDashboard(Base):
     __tablename__ = 'store_dashboard'
+    __table_args__ = (
+        Index('ix_store_dashboard_store_last_update', 'store_id', 'last_update'),
+    )
     id = Column(Integer, primary_key=True)
     store_id = Column(Integer, ForeignKey('stores.id'))
     total_campaigns = Column(Integer, default=0, nullable=False)
@@ -306,6 +388,9 @@ class StoreDashboard(Base):
 
 class CampaignDashboard(Base):
     __tablename__ = 'campaign_dashboard'
+    __table_args__ = (
+        Index('ix_campaign_dashboard_campaign_last_update', 'campaign_id', 'last_update'),
+    )
     id = Column(Integer, primary_key=True)
     store_id = Column(Integer, ForeignKey('stores.id'), nullable=False)
     store_name = relationship("Store")
@@ -325,3 +410,51 @@ class CampaignDashboard(Base):
             self.campaign_name,
             str(self.last_update)
         )
+
+
+class RecapDelivery(Base):
+    __tablename__ = 'recap_deliveries'
+    __table_args__ = (
+        Index('ix_recap_deliveries_recap_date_store', 'recap_date', 'store_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    store_id = Column(Integer, ForeignKey('stores.id'), nullable=False)
+    store = relationship("Store")
+    recap_date = Column(DateTime, nullable=False)
+    started_date = Column(DateTime, nullable=False)
+    finished_date = Column(DateTime)
+    duration_ms = Column(Integer)
+    campaign_count = Column(Integer, default=0)
+    row_count = Column(Integer, default=0)
+    status = Column(String(20), nullable=False)
+    message = Column(String(255))
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.store,
+            str(self.recap_date),
+            self.status
+        )
+
+
+class RetentionCheckpoint(Base):
+    __tablename__ = 'retention_checkpoints'
+    id = Column(Integer, primary_key=True)
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), unique=True, nullable=False)
+    campaign = relationship("Campaign")
+    mode = Column(String(20), nullable=False)
+    last_visitor_id = Column(Integer, default=0, nullable=False)
+    visitors_done = Column(Integer, default=0, nullable=False)
+    appended_done = Column(Integer, default=0, nullable=False)
+    leads_done = Column(Integer, default=0, nullable=False)
+    started_date = Column(DateTime, default=datetime.now, nullable=False)
+    updated_date = Column(DateTime, onupdate=datetime.now)
+    finished_date = Column(DateTime)
+    lease_expires = Column(DateTime)
+
+    def __repr__(self):
+        return '{} {} {}'.format(
+            self.campaign_id,
+            self.mode,
+            self.last_visitor_id
+        )
@@ -0,0 +1,320 @@
+"""
+Tracking pixel ingestion
+
+The pixel view answers immediately with a cached 1x1 GIF and only
+appends the hit to an in-process ring buffer.  A background thread
+flushes the buffer every PIXEL_FLUSH_INTERVAL_MS or PIXEL_FLUSH_HITS
+hits: hits are coalesced per (campaign, ip, open hash), the visitors
+already recorded for a chunk are looked up in one query on
+ix_visitors_campaign_ip_open, their visit counts are bumped by id and
+the rest go in as one multi-row INSERT.
+
+The key is not unique.  PixelTracker hosts still insert their own
+visitor rows and old data holds duplicates, so hits add onto the lowest
+id of a (campaign, ip, open hash) and nothing is merged or rejected.
+Two workers flushing the first hits of one new visitor at the same
+moment can both insert it, the same as the PixelTracker hosts do.
+"""
+from database import db_session
+from sqlalchemy import text
+import atexit
+import base64
+import collections
+import config
+import datetime
+import logging
+import os
+import threading
+
+PIXEL_FLUSH_INTERVAL_MS = getattr(config, 'PIXEL_FLUSH_INTERVAL_MS', 250)
+PIXEL_FLUSH_HITS = getattr(config, 'PIXEL_FLUSH_HITS', 500)
+PIXEL_BUFFER_CAPACITY = getattr(config, 'PIXEL_BUFFER_CAPACITY', 100000)
+
+PIXEL_GIF = base64.b64decode(b'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+log = logging.getLogger(__name__)
+
+Hit = collections.namedtuple('Hit', ['campaign_id', 'ip', 'user_agent', 'open_hash', 'campaign_hash', 'send_hash',
+                                     'visit_date'])
+
+HIT_COLUMNS = ('campaign_id', 'store_id', 'created_date', 'ip', 'user_agent', 'open_hash', 'campaign_hash',
+               'send_hash', 'num_visits', 'last_visit', 'processed', 'appended', 'locked')
+
+VISIT_UPDATE = {
+    'mysql': ("update visitors set num_visits = coalesce(num_visits, 0) + :num_visits, "
+              "last_visit = greatest(coalesce(last_visit, :last_visit), :last_visit), "
+              "score_updated = NULL "
+              "where id = :id"),
+    'sqlite': ("update visitors set num_visits = coalesce(num_visits, 0) + :num_visits, "
+               "last_visit = max(coalesce(last_visit, :last_visit), :last_visit), "
+               "score_updated = NULL "
+               "where id = :id"),
+}
+
+
+class BatchBuffer(object):
+    """
+    Bounded ring buffer drained in batches by a background thread.
+    When the buffer is full the oldest items are dropped, the request
+    path never blocks on the database.
+    """
+
+    def __init__(self, flush, max_items=PIXEL_FLUSH_HITS, interval_ms=PIXEL_FLUSH_INTERVAL_MS,
+                 capacity=PIXEL_BUFFER_CAPACITY):
+        self.flush = flush
+        self.max_items = max_items
+        self.interval = interval_ms / 1000.0
+        self.items = collections.deque(maxlen=capacity)
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stats = {'added': 0, 'flushed': 0, 'dropped': 0, 'errors': 0}
+
+    def add(self, item):
+        """
+        Queue an item, never blocks
+        :param item:
+        :return: None
+        """
+        if self.pid != os.getpid():
+            self._start()
+
+        if len(self.items) == self.items.maxlen:
+            self.stats['dropped'] += 1
+
+        self.items.append(item)
+        self.stats['added'] += 1
+
+        if len(self.items) >= self.max_items:
+            self.event.set()
+
+    def drain(self):
+        """
+        Remove everything currently buffered
+        :return: list
+        """
+        batch = []
+        try:
+            for i in range(len(self.items)):
+                batch.append(self.items.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def flush_now(self):
+        """
+        Flush everything currently buffered
+        :return: int items flushed
+        """
+        with self.lock:
+            batch = self.drain()
+            if not batch:
+                return 0
+
+            try:
+                self.flush(batch)
+                self.stats['flushed'] += len(batch)
+            except Exception:
+                self.stats['errors'] += 1
+                self.stats['dropped'] += len(batch)
+                log.exception('Failed to flush %s buffered items', len(batch))
+
+            return len(batch)
+
+    def _start(self):
+        # (re)start the flush thread in this process, forked workers inherit no threads
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='batch-buffer-flush')
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.flush_now)
+
+    def _run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            self.flush_now()
+
+
+class HitWriter(object):
+    """
+    Write buffered pixel hits to the visitors table
+    """
+
+    def __init__(self, bind=None):
+        self.bind = bind
+        self.campaign_stores = {}
+
+    def get_bind(self):
+        return self.bind or db_session.get_bind()
+
+    def coalesce(self, hits):
+        """
+        Collapse repeat hits from the same visitor into one row
+        :param hits:
+        :return: list of dicts
+        """
+        rows = collections.OrderedDict()
+        for hit in hits:
+            key = (hit.campaign_id, hit.ip, hit.open_hash)
+            row = rows.get(key)
+            if row is None:
+                rows[key] = {
+                    'campaign_id': hit.campaign_id,
+                    'created_date': hit.visit_date,
+                    'ip': hit.ip,
+                    'user_agent': hit.user_agent,
+                    'open_hash': hit.open_hash,
+                    'campaign_hash': hit.campaign_hash,
+                    'send_hash': hit.send_hash,
+                    'num_visits': 1,
+                    'last_visit': hit.visit_date,
+                    'processed': 0,
+                    'appended': 0,
+                    'locked': 0
+                }
+            else:
+                row['num_visits'] += 1
+                row['last_visit'] = max(row['last_visit'], hit.visit_date)
+        return list(rows.values())
+
+    def resolve_stores(self, conn, rows):
+        """
+        Fill in store_id from the cached campaign -> store map,
+        rows for unknown campaigns are dropped
+        :param conn:
+        :param rows:
+        :return: list of dicts
+        """
+        missing = set(row['campaign_id'] for row in rows) - set(self.campaign_stores)
+        if missing:
+            stmt = text("select id, store_id from campaigns where id in ({})".format(
+                ', '.join(str(int(campaign_id)) for campaign_id in missing)))
+            for campaign_id, store_id in conn.execute(stmt):
+                self.campaign_stores[campaign_id] = store_id
+
+        resolved = []
+        for row in rows:
+            store_id = self.campaign_stores.get(row['campaign_id'])
+            if store_id is not None:
+                row['store_id'] = store_id
+                resolved.append(row)
+        return resolved
+
+    def existing(self, conn, rows):
+        """
+        Visitors already recorded for the rows, legacy rows with a NULL
+        open hash match the empty hash
+        :param conn:
+        :param rows:
+        :return: dict (campaign_id, ip, open_hash) -> lowest visitor id
+        """
+        values = []
+        params = {}
+        for i, key in enumerate(set((row['campaign_id'], row['ip']) for row in rows)):
+            values.append('(:campaign_id_{0}, :ip_{0})'.format(i))
+            params['campaign_id_{}'.format(i)], params['ip_{}'.format(i)] = key
+
+        ids = {}
+        stmt = text('select id, campaign_id, ip, open_hash from visitors '
+                    'where (campaign_id, ip) in ({}) '
+                    'order by id asc'.format(', '.join(values)))
+        for visitor_id, campaign_id, ip, open_hash in conn.execute(stmt, params):
+            ids.setdefault((campaign_id, ip, open_hash or ''), visitor_id)
+        return ids
+
+    def __call__(self, hits):
+        bind = self.get_bind()
+        update = text(VISIT_UPDATE[bind.dialect.name])
+
+        with bind.begin() as conn:
+            rows = self.resolve_stores(conn, self.coalesce(hits))
+
+            for start in range(0, len(rows), PIXEL_FLUSH_HITS):
+                chunk = rows[start:start + PIXEL_FLUSH_HITS]
+                ids = self.existing(conn, chunk)
+
+                visits = []
+                values = []
+                params = {}
+                for row in chunk:
+                    visitor_id = ids.get((row['campaign_id'], row['ip'], row['open_hash']))
+                    if visitor_id is not None:
+                        visits.append({'id': visitor_id, 'num_visits': row['num_visits'],
+                                       'last_visit': row['last_visit']})
+                        continue
+
+                    i = len(values)
+                    values.append('({})'.format(', '.join(':{}_{}'.format(column, i) for column in HIT_COLUMNS)))
+                    for column in HIT_COLUMNS:
+                        params['{}_{}'.format(column, i)] = row[column]
+
+                if visits:
+                    conn.execute(update, visits)
+                if values:
+                    conn.execute(text('insert into visitors ({}) values {}'.format(
+                        ', '.join(HIT_COLUMNS), ', '.join(values))), params)
+
+
+hit_buffer = BatchBuffer(HitWriter())
+
+
+def record_hit(campaign_id, ip, user_agent, open_hash=None, campaign_hash=None, send_hash=None):
+    """
+    Buffer a pixel hit
+    :return: None
+    """
+    hit_buffer.add(Hit(
+        campaign_id,
+        (ip or '')[:15],
+        (user_agent or '')[:255],
+        (open_hash or '')[:255],
+        (campaign_hash or '')[:255],
+        (send_hash or '')[:255],
+        datetime.datetime.now()
+    ))
+
+
+def benchmark(hits=200000, campaigns=20, visitors=50000):
+    """
+    Measure sustained ingestion through the buffer into SQLite
+    :param hits:
+    :param campaigns:
+    :param visitors: distinct ips to spread the hits over
+    :return: float hits per second
+    """
+    from models import Campaign, Visitor
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+    import time
+
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Campaign.__table__.create(engine)
+    Visitor.__table__.create(engine)
+    engine.execute(text("insert into campaigns (id, store_id, name, job_number, type, status, start_date, end_date, "
+                        "radius, client_id, rvm_limit) values (:id, 1, :name, :id, 1, 'ACTIVE', "
+                        "'2018-01-01', '2018-12-31', 50, 'bench', 10000)"),
+                   [{'id': i, 'name': 'Campaign {}'.format(i)} for i in range(1, campaigns + 1)])
+
+    buffer = BatchBuffer(HitWriter(bind=engine))
+    now = datetime.datetime.now()
+
+    started = time.time()
+    for i in range(hits):
+        buffer.add(Hit(i % campaigns + 1, '10.0.{}.{}'.format(i % visitors // 256, i % 256), 'bench/1.0',
+                       'o{}'.format(i % visitors), 'c', 's', now))
+    while buffer.items:
+        buffer.flush_now()
+    elapsed = time.time() - started
+
+    total = engine.execute(text('select sum(num_visits) from visitors')).scalar()
+    assert total == hits - buffer.stats['dropped'], (total, buffer.stats)
+
+    return hits / elapsed
+
+
+if __name__ == '__main__':
+    print('Pixel ingestion: {:,.0f} hits/second'.format(benchmark()))
@@ -0,0 +1,311 @@
+"""
+Request profiling
+
+An admin can profile a single request by adding ?_profile=1 or the
+X-Earl-Profile header; that request runs under cProfile and is stack
+sampled from the start.  Any other request that is still running after
+PROFILE_SLOW_SECONDS is stack sampled by a watchdog thread until it
+finishes.  Wall time is split into SQL (cursor execute events),
+template rendering (Flask template signals) and Python.
+
+Each capture writes to PROFILE_DIR:
+  <name>.folded  stack samples, input for flamegraph.pl / speedscope
+  <name>.prof    cProfile stats, explicit captures only
+  <name>.json    timing split and request details
+Only the newest PROFILE_MAX_FILES files are kept.
+
+Slow request sampling is off by default (PROFILE_SLOW_SECONDS = 0).
+Then a request without the flag only pays for the flag check, no
+capture is allocated and the SQL and template hooks return at once.
+The watchdog thread is started lazily in each process by the first
+capture that needs it, explicit or slow, so forked workers each sample
+their own threads.  Under gevent (EARL_GEVENT) there is no watchdog and
+explicit captures only have the cProfile stats.
+"""
+from flask import request
+from flask.signals import before_render_template, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import cProfile
+import collections
+import config
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+PROFILE_DIR = getattr(config, 'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'earl-profiles'))
+PROFILE_MAX_FILES = getattr(config, 'PROFILE_MAX_FILES', 300)
+PROFILE_SLOW_SECONDS = getattr(config, 'PROFILE_SLOW_SECONDS', 0)
+PROFILE_SAMPLE_INTERVAL = getattr(config, 'PROFILE_SAMPLE_INTERVAL', 0.01)
+PROFILE_PARAM = '_profile'
+PROFILE_HEADER = 'X-Earl-Profile'
+
+state = threading.local()
+
+
+class Capture(object):
+    """
+    Timings and stack samples for one request
+    """
+
+    def __init__(self, endpoint, threshold, explicit=False):
+        self.endpoint = endpoint or 'unknown'
+        self.threshold = threshold
+        self.explicit = explicit
+        self.started = time.time()
+        self.elapsed = None
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.sql_started = None
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_started = None
+        self.template_sql_time = 0.0
+        self.samples = collections.Counter()
+        self.sample_split = collections.Counter()
+        self.profile = cProfile.Profile() if explicit else None
+
+    def section(self):
+        if self.sql_started is not None:
+            return 'sql'
+        if self.template_depth:
+            return 'template'
+        return 'python'
+
+    def summary(self):
+        python_time = max(self.elapsed - self.sql_time - self.template_time, 0.0)
+        return {
+            'endpoint': self.endpoint,
+            'method': request.method,
+            'path': request.full_path,
+            'explicit': self.explicit,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            'elapsed_ms': int(self.elapsed * 1000),
+            'sql_ms': int(self.sql_time * 1000),
+            'sql_queries': self.sql_count,
+            'template_ms': int(self.template_time * 1000),
+            'python_ms': int(python_time * 1000),
+            'samples': sum(self.samples.values()),
+            'sample_split': dict(self.sample_split)
+        }
+
+
+def fold_stack(frame):
+    """
+    Collapse a frame and its callers into a folded stack line
+    :param frame:
+    :return: str outermost call first, separated by ;
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class Watchdog(threading.Thread):
+    """
+    Sample the stacks of requests that are over their threshold
+    """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, name='profiler-watchdog')
+        self.daemon = True
+        self.interval = interval
+        self.captures = {}
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            due = [(ident, capture) for ident, capture in list(self.captures.items())
+                   if now - capture.started >= capture.threshold]
+            if not due:
+                continue
+
+            frames = sys._current_frames()
+            for ident, capture in due:
+                frame = frames.get(ident)
+                if frame is not None:
+                    capture.samples[fold_stack(frame)] += 1
+                    capture.sample_split[capture.section()] += 1
+
+
+class Profiler(object):
+    """
+    Flask extension, see the module docstring
+    """
+
+    def __init__(self, app=None, directory=PROFILE_DIR, slow_seconds=PROFILE_SLOW_SECONDS,
+                 max_files=PROFILE_MAX_FILES):
+        self.directory = directory
+        self.slow_seconds = slow_seconds
+        self.max_files = max_files
+        # gevent runs every request on one thread, per thread sampling
+        # would only ever see the hub, so only cProfile captures there
+        self.sampling = not os.environ.get('EARL_GEVENT')
+        self.slow = bool(slow_seconds) and self.sampling
+        self.watchdog = None
+        self.lock = threading.Lock()
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        before_render_template.connect(self.template_started, app, weak=False)
+        template_rendered.connect(self.template_finished, app, weak=False)
+        event.listen(Engine, 'before_cursor_execute', self.sql_started)
+        event.listen(Engine, 'after_cursor_execute', self.sql_finished)
+
+    def requested(self):
+        if PROFILE_PARAM not in request.args and PROFILE_HEADER not in request.headers:
+            return False
+        return current_user.is_authenticated and current_user.is_admin
+
+    def _start(self):
+        # (re)start the watchdog in this process, forked workers inherit no threads
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.watchdog = Watchdog()
+            self.watchdog.start()
+            self.pid = os.getpid()
+
+    def before_request(self):
+        explicit = self.requested()
+        if not explicit and not self.slow:
+            return
+
+        capture = Capture(request.endpoint, 0 if explicit else self.slow_seconds, explicit)
+        state.capture = capture
+        if self.sampling:
+            if self.pid != os.getpid():
+                self._start()
+            self.watchdog.captures[threading.current_thread().ident] = capture
+        if capture.profile is not None:
+            capture.profile.enable()
+
+    def after_request(self, response):
+        name = self.finish()
+        if name:
+            response.headers['X-Earl-Profile-Capture'] = name
+        return response
+
+    def teardown_request(self, exception=None):
+        self.finish()
+
+    def finish(self):
+        """
+        Stop the capture for this request and write it if it has anything
+        :return: str capture name or None
+        """
+        capture = getattr(state, 'capture', None)
+        if capture is None:
+            return None
+
+        state.capture = None
+        if self.watchdog is not None:
+            self.watchdog.captures.pop(threading.current_thread().ident, None)
+        if capture.profile is not None:
+            capture.profile.disable()
+
+        capture.elapsed = time.time() - capture.started
+        if not capture.explicit and not capture.samples:
+            return None
+
+        try:
+            return self.write(capture)
+        except (IOError, OSError):
+            return None
+
+    def write(self, capture):
+        """
+        Write the capture files and rotate the directory
+        :param capture:
+        :return: str capture name
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+
+        name = '{}-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(capture.started)),
+                                 capture.endpoint.replace('.', '_'), uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+
+        with open(path + '.folded', 'w') as f:
+            for stack, count in capture.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+        if capture.profile is not None:
+            capture.profile.dump_stats(path + '.prof')
+
+        with open(path + '.json', 'w') as f:
+            json.dump(capture.summary(), f, indent=2, sort_keys=True)
+
+        self.rotate()
+        return name
+
+    def rotate(self):
+        """
+        Keep the newest max_files files
+        :return: int files removed
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+            except OSError:
+                continue
+
+        entries.sort(reverse=True)
+        removed = 0
+        for mtime, name in entries[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def template_started(self, sender, template, context, **extra):
+        capture = getattr(state, 'capture', None)
+        if capture is None:
+            return
+        if not capture.template_depth:
+            capture.template_started = time.time()
+            capture.template_sql_time = capture.sql_time
+        capture.template_depth += 1
+
+    def template_finished(self, sender, template, context, **extra):
+        capture = getattr(state, 'capture', None)
+        if capture is None or not capture.template_depth:
+            return
+        capture.template_depth -= 1
+        if not capture.template_depth:
+            # lazy loads inside the template are already counted as SQL
+            elapsed = time.time() - capture.template_started
+            capture.template_time += elapsed - (capture.sql_time - capture.template_sql_time)
+
+    def sql_started(self, conn, cursor, statement, parameters, context, executemany):
+        capture = getattr(state, 'capture', None)
+        if capture is not None:
+            capture.sql_started = time.time()
+
+    def sql_finished(self, conn, cursor, statement, parameters, context, executemany):
+        capture = getattr(state, 'capture', None)
+        if capture is not None and capture.sql_started is not None:
+            capture.sql_time += time.time() - capture.sql_started
+            capture.sql_count += 1
+            capture.sql_started = None
@@ -0,0 +1,281 @@
+"""
+Daily recap report
+
+The recap query and CSV layout shared by the daily recap view, its
+export and the nightly recap email delivery.
+"""
+from database import db_session
+from flask_mail import Message
+from models import Campaign, Store, RecapDelivery, RetentionCheckpoint
+from reportcache import ReportCache
+from sqlalchemy import text
+import config
+import csv
+import datetime
+import logging
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+RECAP_COLUMNS = ('created_date', 'first_name', 'last_name', 'address1', 'address2', 'city', 'state', 'zip_code',
+                 'zip_4', 'email', 'cell_phone', 'credit_range', 'car_year', 'car_make', 'car_model')
+
+RECAP_CSV_COLUMNS = (
+    ('Created Date', 'created_date'),
+    ('First Name', 'first_name'),
+    ('Last Name', 'last_name'),
+    ('Address', 'address1'),
+    ('City', 'city'),
+    ('State', 'state'),
+    ('ZipCode', 'zip_code'),
+    ('Email', 'email'),
+    ('Phone', 'cell_phone'),
+    ('Credit Range', 'credit_range'),
+    ('Auto Year', 'car_year'),
+    ('Auto Make', 'car_make'),
+    ('Auto Model', 'car_model'),
+)
+
+# appended visitors land a little after their visit, so a day is only
+# treated as closed once it has been over for this long
+REPORT_CACHE_SETTLE_HOURS = getattr(config, 'REPORT_CACHE_SETTLE_HOURS', 2)
+
+cache = ReportCache(RECAP_COLUMNS)
+
+log = logging.getLogger(__name__)
+
+
+def day_range(recap_date):
+    """
+    First and last second of the recap day
+    :param recap_date: date or datetime
+    :return: tuple (start_date, end_date)
+    """
+    start_date = datetime.datetime(recap_date.year, recap_date.month, recap_date.day)
+    end_date = start_date + datetime.timedelta(hours=23, minutes=59, seconds=59)
+    return start_date, end_date
+
+
+def closed_day(start_date, end_date, now=None):
+    """
+    The recap day when the dates cover exactly one day that is over
+    :param start_date:
+    :param end_date:
+    :param now:
+    :return: date or None
+    """
+    now = now or datetime.datetime.now()
+    if (start_date, end_date) != day_range(start_date):
+        return None
+    if end_date + datetime.timedelta(hours=REPORT_CACHE_SETTLE_HOURS) >= now:
+        return None
+    return start_date.date()
+
+
+def cacheable(campaign_pk_id, session=db_session):
+    """
+    Archived campaigns are purged by retention on the workers, which
+    cannot reach the web hosts' cache, so they are never cached
+    :param campaign_pk_id:
+    :param session:
+    :return: bool
+    """
+    row = session.query(Campaign.archived, RetentionCheckpoint.id).outerjoin(
+        RetentionCheckpoint, RetentionCheckpoint.campaign_id == Campaign.id
+    ).filter(Campaign.id == campaign_pk_id).first()
+    return row is not None and not row[0] and row[1] is None
+
+
+def get_daily_recap(campaign_pk_id, start_date, end_date, session=db_session):
+    """
+    Get the appended visitors for the campaign between the dates,
+    closed days of live campaigns are served from the report cache
+    :param campaign_pk_id:
+    :param start_date:
+    :param end_date:
+    :param session:
+    :return: list
+    """
+    day = closed_day(start_date, end_date)
+    if day is None:
+        return query_daily_recap(campaign_pk_id, start_date, end_date, session)
+
+    if not cacheable(campaign_pk_id, session):
+        # drop whatever this host cached before the campaign was archived
+        cache.invalidate(campaign_pk_id)
+        return query_daily_recap(campaign_pk_id, start_date, end_date, session)
+
+    results = cache.get(campaign_pk_id, day)
+    if results is None:
+        results = query_daily_recap(campaign_pk_id, start_date, end_date, session)
+        try:
+            cache.put(campaign_pk_id, day, results)
+        except (IOError, OSError):
+            pass
+
+    return results
+
+
+def query_daily_recap(campaign_pk_id, start_date, end_date, session=db_session):
+    """
+    Get the appended visitors for the campaign between the dates
+    :param campaign_pk_id:
+    :param start_date:
+    :param end_date:
+    :param session:
+    :return: list
+    """
+    stmt = text("select av.created_date, av.first_name, av.last_name, av.address1, av.address2, av.city, "
+                "av.state, av.zip_code, av.zip_4, av.email, av.cell_phone, av.credit_range, av.car_year, "
+                "av.car_make, av.car_model "
+                "from visitors v, appendedvisitors av "
+                "where v.id = av.visitor "
+                "and v.campaign_id = :campaign_id "
+                "and ( v.created_date between :start_date and :end_date ) "
+                "order by av.last_name, av.first_name asc")
+
+    return session.query(*RECAP_COLUMNS).from_statement(stmt).params(
+        campaign_id=campaign_pk_id,
+        start_date=start_date,
+        end_date=end_date
+    ).all()
+
+
+def build_csv(results, columns):
+    """
+    Render rows as CSV
+    :param results:
+    :param columns: sequence of (heading, attribute)
+    :return: str csv
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([heading for heading, column in columns])
+
+    for result in results:
+        writer.writerow([getattr(result, column) for heading, column in columns])
+
+    return buf.getvalue().strip('\r\n')
+
+
+def build_recap_csv(results):
+    """
+    Render recap rows as CSV
+    :param results:
+    :return: str csv
+    """
+    return build_csv(results, RECAP_CSV_COLUMNS)
+
+
+def send_store_recap(mail, store_pk_id, recap_date, session=db_session):
+    """
+    Email a store its recap for every active campaign, one CSV
+    attachment per campaign, and record how long it took.  Raises only
+    when the mail was not sent; once it has gone out a failure to save
+    the delivery record is logged instead, so a retry cannot send the
+    recap twice
+    :param mail: Flask-Mail instance
+    :param store_pk_id:
+    :param recap_date: date
+    :param session:
+    :return: RecapDelivery
+    """
+    started = time.time()
+    delivery = RecapDelivery(
+        store_id=store_pk_id,
+        recap_date=datetime.datetime(recap_date.year, recap_date.month, recap_date.day),
+        started_date=datetime.datetime.now(),
+        campaign_count=0,
+        row_count=0,
+        status='STARTED'
+    )
+
+    try:
+        store = session.query(Store).filter(Store.id == store_pk_id).one()
+        campaigns = session.query(Campaign).filter(
+            Campaign.store_id == store_pk_id,
+            Campaign.status == 'ACTIVE',
+            Campaign.archived == 0
+        ).order_by(Campaign.name.asc()).all()
+
+        start_date, end_date = day_range(recap_date)
+        report_date = start_date.strftime('%m-%d-%Y')
+
+        msg = Message(
+            'Daily Recap Report {} - {}'.format(report_date, store.name),
+            sender=mail.app.config['MAIL_DEFAULT_SENDER'],
+            recipients=[store.reporting_email, ]
+        )
+
+        lines = []
+        for campaign in campaigns:
+            results = get_daily_recap(campaign.id, start_date, end_date, session=session)
+            lines.append('{}: {} new visitors'.format(campaign.name, len(results)))
+            delivery.campaign_count += 1
+            delivery.row_count += len(results)
+
+            if results:
+                msg.attach(
+                    'Daily-Recap-Report-{}-{}.csv'.format(campaign.job_number, report_date),
+                    'text/csv',
+                    build_recap_csv(results)
+                )
+
+        msg.body = 'Daily Recap Report for {} on {}\n\n{}'.format(
+            store.name, report_date, '\n'.join(lines) or 'No active campaigns.')
+
+        with mail.app.app_context():
+            mail.send(msg)
+
+    except Exception as err:
+        session.rollback()
+        delivery.status = 'FAILED'
+        delivery.message = str(err)[:255]
+        record_delivery(delivery, started, session)
+        raise
+
+    delivery.status = 'SENT'
+    record_delivery(delivery, started, session)
+
+    return delivery
+
+
+def record_delivery(delivery, started, session=db_session):
+    """
+    Save the delivery record, logging rather than raising on failure
+    :param delivery: RecapDelivery
+    :param started: time.time() the delivery started
+    :param session:
+    :return: bool saved
+    """
+    delivery.finished_date = datetime.datetime.now()
+    delivery.duration_ms = int((time.time() - started) * 1000)
+
+    try:
+        session.add(delivery)
+        session.commit()
+    except Exception:
+        session.rollback()
+        log.exception('Failed to record the %s recap delivery for store %s', delivery.status, delivery.store_id)
+        return False
+
+    return True
+
+
+def get_recap_stores(session=db_session):
+    """
+    Get the ids of the active stores that receive the recap
+    :param session:
+    :return: list store ids
+    """
+    rows = session.query(Store.id).filter(
+        Store.status == 'Active',
+        Store.archived == 0,
+        Store.reporting_email != None,  # noqa: E711
+        Store.reporting_email != ''
+    ).order_by(Store.id.asc()).all()
+
+    return [row.id for row in rows]
@@ -0,0 +1,120 @@
+"""
+Read replica routing
+
+Views opt in with @read_replica and then run their read-only queries
+through read_session().  Replicas are picked round-robin; a replica
+whose newest store_dashboard.last_update trails the primary by more
+than REPLICA_MAX_LAG_SECONDS is skipped, and when no replica is fresh
+the primary session is used.
+"""
+from database import db_session
+from flask import g
+from functools import wraps
+from models import StoreDashboard
+from sqlalchemy import create_engine, exc, func
+from sqlalchemy.orm import scoped_session, sessionmaker
+import config
+import itertools
+import threading
+import time
+
+SQLALCHEMY_REPLICA_URIS = getattr(config, 'SQLALCHEMY_REPLICA_URIS', [])
+REPLICA_MAX_LAG_SECONDS = getattr(config, 'REPLICA_MAX_LAG_SECONDS', 120)
+REPLICA_LAG_CHECK_SECONDS = getattr(config, 'REPLICA_LAG_CHECK_SECONDS', 15)
+
+
+class ReplicaRouter(object):
+    """
+    Round-robin over the replicas that are fresh enough
+    """
+
+    def __init__(self, uris, primary=db_session, max_lag=REPLICA_MAX_LAG_SECONDS,
+                 check_interval=REPLICA_LAG_CHECK_SECONDS):
+        self.primary = primary
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.sessions = [scoped_session(sessionmaker(autocommit=False, autoflush=False,
+                                                     bind=create_engine(uri, pool_recycle=3600)))
+                         for uri in uris]
+        self.order = itertools.cycle(range(len(self.sessions)))
+        self.lock = threading.Lock()
+        self.checked = {}
+
+    def last_update(self, session):
+        return session.query(func.max(StoreDashboard.last_update)).scalar()
+
+    def lag(self, index):
+        """
+        Seconds the replica trails the primary, None if unreachable
+        :param index:
+        :return: float or None
+        """
+        replica = self.sessions[index]
+        try:
+            replica_update = self.last_update(replica)
+            primary_update = self.last_update(self.primary)
+        except exc.SQLAlchemyError:
+            replica.rollback()
+            return None
+        finally:
+            replica.remove()
+
+        if primary_update is None:
+            return 0.0
+        if replica_update is None:
+            return None
+        return max((primary_update - replica_update).total_seconds(), 0.0)
+
+    def is_fresh(self, index):
+        """
+        Cached lag check
+        :param index:
+        :return: bool
+        """
+        now = time.time()
+        checked = self.checked.get(index)
+        if checked and checked[0] > now:
+            return checked[1]
+
+        lag = self.lag(index)
+        fresh = lag is not None and lag <= self.max_lag
+        self.checked[index] = (now + self.check_interval, fresh)
+        return fresh
+
+    def get_session(self):
+        """
+        Pick the next fresh replica, or the primary
+        :return: session
+        """
+        for i in range(len(self.sessions)):
+            with self.lock:
+                index = next(self.order)
+            if self.is_fresh(index):
+                return self.sessions[index]
+        return self.primary
+
+    def remove(self):
+        for session in self.sessions:
+            session.remove()
+
+
+router = ReplicaRouter(SQLALCHEMY_REPLICA_URIS)
+
+
+def read_replica(f):
+    """
+    Route the view's read_session() queries to a replica
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.read_session = router.get_session()
+        return f(*args, **kwargs)
+    return decorated
+
+
+def read_session():
+    """
+    The session for read-only queries in this request
+    :return: session
+    """
+    return getattr(g, 'read_session', None) or db_session
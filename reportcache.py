@@ -0,0 +1,162 @@
+"""
+Closed-day report result cache
+
+A recap for a day that is over never changes, so its rows are kept on
+local disk as zlib compressed JSON, one file per (campaign_id, date).
+Files are written atomically and evicted least recently used first
+once the directory grows past REPORT_CACHE_MAX_BYTES.
+"""
+import collections
+import config
+import datetime
+import glob
+import json
+import os
+import tempfile
+import threading
+import zlib
+
+REPORT_CACHE_DIR = getattr(config, 'REPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'earl-report-cache'))
+REPORT_CACHE_MAX_BYTES = getattr(config, 'REPORT_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class ReportCache(object):
+    """
+    Size bounded on-disk cache of recap rows
+    """
+
+    def __init__(self, columns, directory=REPORT_CACHE_DIR, max_bytes=REPORT_CACHE_MAX_BYTES):
+        self.columns = columns
+        self.row_type = collections.namedtuple('CachedRow', columns)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, campaign_pk_id, day):
+        return os.path.join(self.directory, '{}_{}.recap.z'.format(int(campaign_pk_id), day.strftime('%Y%m%d')))
+
+    def get(self, campaign_pk_id, day):
+        """
+        Cached rows for the campaign and day
+        :param campaign_pk_id:
+        :param day: date
+        :return: list or None on a miss
+        """
+        path = self.path(campaign_pk_id, day)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            rows = json.loads(zlib.decompress(data).decode('utf-8'))
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, zlib.error):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return [self.row_type(*self._load(row)) for row in rows]
+
+    def put(self, campaign_pk_id, day, results):
+        """
+        Store the rows for the campaign and day
+        :param campaign_pk_id:
+        :param day: date
+        :param results: rows with the cache columns as attributes
+        :return: None
+        """
+        rows = [self._dump([getattr(result, column) for column in self.columns]) for result in results]
+        data = zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'), 6)
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, self.path(campaign_pk_id, day))
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+            if self.size is None or self.size > self.max_bytes:
+                self.evict()
+
+    def invalidate(self, campaign_pk_id):
+        """
+        Remove every cached day of the campaign
+        :param campaign_pk_id:
+        :return: int files removed
+        """
+        removed = 0
+        for path in glob.glob(os.path.join(self.directory, '{}_*.recap.z'.format(int(campaign_pk_id)))):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+
+        with self.lock:
+            # recounted on the next put
+            self.size = None
+        return removed
+
+    def evict(self):
+        """
+        Remove the least recently used files until under max_bytes
+        :return: int files removed
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.recap.z'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        removed = 0
+
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        self.size = total
+        return removed
+
+    def stats(self):
+        """
+        Hit rate and size, hits and misses are per process
+        :return: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(float(self.hits) / lookups, 4) if lookups else 0.0,
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'directory': self.directory
+        }
+
+    def _dump(self, values):
+        return [value.strftime(DATE_FORMAT) if isinstance(value, datetime.datetime) else value for value in values]
+
+    def _load(self, values):
+        return [datetime.datetime.strptime(value, DATE_FORMAT) if column == 'created_date' and value else value
+                for column, value in zip(self.columns, values)]
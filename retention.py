@@ -0,0 +1,279 @@
+"""
+Data retention for archived campaigns
+
+Campaigns archived more than RETENTION_DAYS ago have their visitors,
+appended visitors and leads deleted (RETENTION_MODE = 'delete') or
+stripped of personal data (RETENTION_MODE = 'anonymize').  Work is done
+one chunk of visitor ids at a time, in primary key order, each chunk in
+its own short transaction together with its retention_checkpoints row,
+so a purge can stop anywhere and resume exactly where it left off.
+
+Chunks pause between each other and the purge backs off whenever the
+read replicas trail the primary by more than RETENTION_MAX_LAG_SECONDS.
+The recap report cache never holds archived campaigns (recap.cacheable),
+so purged or anonymized rows are not served from any web host's cache.
+"""
+from database import db_session
+from models import Campaign, Visitor, AppendedVisitor, Lead, RetentionCheckpoint
+from sqlalchemy import and_, or_
+import config
+import datetime
+import replicas
+import time
+
+RETENTION_DAYS = getattr(config, 'RETENTION_DAYS', 365)
+RETENTION_MODE = getattr(config, 'RETENTION_MODE', 'delete')
+RETENTION_CHUNK_SIZE = getattr(config, 'RETENTION_CHUNK_SIZE', 500)
+RETENTION_PAUSE_SECONDS = getattr(config, 'RETENTION_PAUSE_SECONDS', 0.2)
+RETENTION_MAX_LAG_SECONDS = getattr(config, 'RETENTION_MAX_LAG_SECONDS', 30)
+RETENTION_LAG_CHECK_CHUNKS = getattr(config, 'RETENTION_LAG_CHECK_CHUNKS', 10)
+RETENTION_THROTTLE_SECONDS = getattr(config, 'RETENTION_THROTTLE_SECONDS', 300)
+RETENTION_TIME_BUDGET = getattr(config, 'RETENTION_TIME_BUDGET', 60 * 8)
+RETENTION_LEASE_SECONDS = getattr(config, 'RETENTION_LEASE_SECONDS', 60 * 15)
+
+MODES = ('delete', 'anonymize')
+
+STATUS_DONE = 'done'
+STATUS_PARTIAL = 'partial'
+STATUS_THROTTLED = 'throttled'
+
+# geo, credit and vehicle columns are kept so old campaign totals still add up
+ANONYMIZED_APPENDED = {
+    'first_name': None,
+    'last_name': None,
+    'email': None,
+    'home_phone': None,
+    'cell_phone': None,
+    'address1': None,
+    'address2': None,
+    'zip_4': None
+}
+
+ANONYMIZED_VISITOR = {
+    'ip': None,
+    'user_agent': None,
+    'client_id': None,
+    'raw_data': None,
+    'longitude': None,
+    'latitude': None
+}
+
+
+def replica_lag(router=None):
+    """
+    Worst lag across the read replicas, unreachable replicas are ignored
+    :param router:
+    :return: float seconds
+    """
+    router = router or replicas.router
+    lags = [router.lag(index) for index in range(len(router.sessions))]
+    return max([lag for lag in lags if lag is not None] or [0.0])
+
+
+class RetentionPurger(object):
+    """
+    Resumable chunked purge of archived campaigns
+    """
+
+    def __init__(self, session=db_session, days=RETENTION_DAYS, mode=RETENTION_MODE,
+                 chunk_size=RETENTION_CHUNK_SIZE, pause=RETENTION_PAUSE_SECONDS,
+                 max_lag=RETENTION_MAX_LAG_SECONDS, lag=replica_lag):
+        if mode not in MODES:
+            raise ValueError('Unknown retention mode: {}'.format(mode))
+        self.session = session
+        self.days = days
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.max_lag = max_lag
+        self.lag = lag
+
+    def open_checkpoints(self, now=None):
+        """
+        Add a checkpoint for every archived campaign past retention
+        :param now:
+        :return: int checkpoints added
+        """
+        now = now or datetime.datetime.now()
+        cutoff = now - datetime.timedelta(days=self.days)
+
+        campaign_ids = [row.id for row in self.session.query(Campaign.id).outerjoin(
+            RetentionCheckpoint, RetentionCheckpoint.campaign_id == Campaign.id
+        ).filter(
+            Campaign.archived == 1,
+            Campaign.archived_date != None,  # noqa: E711
+            Campaign.archived_date < cutoff,
+            RetentionCheckpoint.id == None  # noqa: E711
+        ).order_by(Campaign.id.asc()).all()]
+
+        try:
+            for campaign_id in campaign_ids:
+                self.session.add(RetentionCheckpoint(
+                    campaign_id=campaign_id,
+                    mode=self.mode,
+                    last_visitor_id=0,
+                    visitors_done=0,
+                    appended_done=0,
+                    leads_done=0,
+                    started_date=now
+                ))
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        return len(campaign_ids)
+
+    def claim(self, now=None):
+        """
+        Lease the next unfinished checkpoint nobody else is working on
+        :param now:
+        :return: RetentionCheckpoint or None
+        """
+        now = now or datetime.datetime.now()
+        free = and_(
+            RetentionCheckpoint.finished_date == None,  # noqa: E711
+            or_(RetentionCheckpoint.lease_expires == None,  # noqa: E711
+                RetentionCheckpoint.lease_expires < now)
+        )
+
+        try:
+            for row in self.session.query(RetentionCheckpoint.id).filter(free).order_by(
+                    RetentionCheckpoint.id.asc()).all():
+                # guarded update, the first worker to flip the lease wins
+                result = self.session.execute(
+                    RetentionCheckpoint.__table__.update().where(and_(
+                        RetentionCheckpoint.id == row.id,
+                        free
+                    )).values(lease_expires=now + datetime.timedelta(seconds=RETENTION_LEASE_SECONDS))
+                )
+                self.session.commit()
+                if result.rowcount == 1:
+                    return self.session.query(RetentionCheckpoint).get(row.id)
+        except Exception:
+            self.session.rollback()
+            raise
+
+        return None
+
+    def release(self, checkpoint):
+        checkpoint.lease_expires = None
+        self.session.commit()
+
+    def next_chunk(self, checkpoint):
+        """
+        Next visitor ids of the campaign after the checkpoint
+        :param checkpoint:
+        :return: list visitor ids
+        """
+        return [row.id for row in self.session.query(Visitor.id).filter(
+            Visitor.campaign_id == checkpoint.campaign_id,
+            Visitor.id > checkpoint.last_visitor_id
+        ).order_by(Visitor.id.asc()).limit(self.chunk_size).all()]
+
+    def purge_chunk(self, checkpoint, visitor_ids):
+        """
+        Delete or anonymize one chunk and advance the checkpoint in the
+        same transaction
+        :param checkpoint:
+        :param visitor_ids:
+        :return: None
+        """
+        try:
+            if checkpoint.mode == 'delete':
+                appended_ids = [row.id for row in self.session.query(AppendedVisitor.id).filter(
+                    AppendedVisitor.visitor.in_(visitor_ids)
+                ).all()]
+
+                if appended_ids:
+                    checkpoint.leads_done += self.session.query(Lead).filter(
+                        Lead.appended_visitor_id.in_(appended_ids)
+                    ).delete(synchronize_session=False)
+                    checkpoint.appended_done += self.session.query(AppendedVisitor).filter(
+                        AppendedVisitor.id.in_(appended_ids)
+                    ).delete(synchronize_session=False)
+
+                checkpoint.visitors_done += self.session.query(Visitor).filter(
+                    Visitor.id.in_(visitor_ids)
+                ).delete(synchronize_session=False)
+
+            else:
+                checkpoint.appended_done += self.session.query(AppendedVisitor).filter(
+                    AppendedVisitor.visitor.in_(visitor_ids)
+                ).update(ANONYMIZED_APPENDED, synchronize_session=False)
+                checkpoint.visitors_done += self.session.query(Visitor).filter(
+                    Visitor.id.in_(visitor_ids)
+                ).update(ANONYMIZED_VISITOR, synchronize_session=False)
+
+            checkpoint.last_visitor_id = visitor_ids[-1]
+            self.session.commit()
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def purge_campaign(self, checkpoint, deadline):
+        """
+        Work through a campaign until it is done, the deadline passes or
+        the replicas fall behind
+        :param checkpoint:
+        :param deadline: time.time() to stop at
+        :return: str status
+        """
+        chunks = 0
+
+        while True:
+            if time.time() >= deadline:
+                return STATUS_PARTIAL
+
+            if chunks and chunks % RETENTION_LAG_CHECK_CHUNKS == 0 and self.lag() > self.max_lag:
+                return STATUS_THROTTLED
+
+            visitor_ids = self.next_chunk(checkpoint)
+            if not visitor_ids:
+                checkpoint.finished_date = datetime.datetime.now()
+                self.session.commit()
+                return STATUS_DONE
+
+            self.purge_chunk(checkpoint, visitor_ids)
+            chunks += 1
+
+            if self.pause:
+                time.sleep(self.pause)
+
+    def run(self, time_budget=RETENTION_TIME_BUDGET):
+        """
+        Purge campaigns until there are none left or the time budget is
+        spent
+        :param time_budget: seconds
+        :return: dict status and counts
+        """
+        deadline = time.time() + time_budget
+        stats = {'status': STATUS_DONE, 'campaigns': 0, 'visitors': 0, 'appended': 0, 'leads': 0}
+
+        if self.lag() > self.max_lag:
+            stats['status'] = STATUS_THROTTLED
+            return stats
+
+        self.open_checkpoints()
+
+        while True:
+            checkpoint = self.claim()
+            if checkpoint is None:
+                return stats
+
+            before = (checkpoint.visitors_done, checkpoint.appended_done, checkpoint.leads_done)
+            try:
+                status = self.purge_campaign(checkpoint, deadline)
+            finally:
+                self.release(checkpoint)
+
+            stats['visitors'] += checkpoint.visitors_done - before[0]
+            stats['appended'] += checkpoint.appended_done - before[1]
+            stats['leads'] += checkpoint.leads_done - before[2]
+
+            if status != STATUS_DONE:
+                stats['status'] = status
+                return stats
+
+            stats['campaigns'] += 1
@@ -0,0 +1,370 @@
+"""
+Ringless voicemail dispatch
+
+Picks eligible leads for every campaign with send_rvm enabled, reserves
+send slots against Campaign.rvm_limit under a row lock, calls the RVM
+provider through a bounded thread pool and writes the results back with
+bulk executemany updates.  Claimed leads are QUEUED with rvm_date as the
+lease start; leads a dead worker left QUEUED for RVM_LEASE_SECONDS are
+released together with their send slots.
+"""
+from database import db_session
+from models import Campaign
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import text
+import config
+import datetime
+import phonenumbers
+import requests
+import threading
+import time
+
+RVM_BATCH_SIZE = getattr(config, 'RVM_BATCH_SIZE', 500)
+RVM_CONCURRENCY = getattr(config, 'RVM_CONCURRENCY', 8)
+# longer than the dispatch task time limit, a live worker never loses its leads
+RVM_LEASE_SECONDS = getattr(config, 'RVM_LEASE_SECONDS', 60 * 90)
+
+
+class RVMClient(object):
+    """
+    Base RVM provider client
+    """
+
+    def send(self, rvm_campaign_id, phone, lead_id):
+        """
+        Drop a voicemail for the lead
+        :param rvm_campaign_id:
+        :param phone: E.164 phone number
+        :param lead_id:
+        :return: tuple (status, message)
+        """
+        raise NotImplementedError
+
+
+class HttpRVMClient(RVMClient):
+    """
+    RVM provider client, one pooled HTTP session shared by all threads
+    """
+
+    def __init__(self, api_url, api_key, timeout=10):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=RVM_CONCURRENCY)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send(self, rvm_campaign_id, phone, lead_id):
+        try:
+            resp = self.session.post(
+                self.api_url,
+                json={
+                    'api_key': self.api_key,
+                    'campaign_id': rvm_campaign_id,
+                    'phone': phone,
+                    'reference': lead_id
+                },
+                timeout=self.timeout
+            )
+            resp.raise_for_status()
+            return 'SENT', str(resp.json().get('message', 'OK'))[:50]
+
+        except (requests.RequestException, ValueError) as err:
+            return 'FAILED', str(err)[:50]
+
+
+class FakeRVMClient(RVMClient):
+    """
+    Local RVM client for tests, records every send
+    """
+
+    def __init__(self, latency=0, fail_phones=None):
+        self.latency = latency
+        self.fail_phones = set(fail_phones or [])
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, rvm_campaign_id, phone, lead_id):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.sent.append((rvm_campaign_id, phone, lead_id))
+
+        if phone in self.fail_phones:
+            return 'FAILED', 'Invalid number'
+        return 'SENT', 'OK'
+
+
+def get_client():
+    """
+    Build the configured RVM provider client
+    :return: RVMClient
+    """
+    api_url = getattr(config, 'RVM_API_URL', None)
+    if not api_url:
+        raise RuntimeError('RVM_API_URL is not configured.')
+
+    return HttpRVMClient(api_url, config.RVM_API_KEY)
+
+
+def format_phone(number):
+    """
+    Normalize a US phone number to E.164
+    :param number:
+    :return: str or None
+    """
+    try:
+        parsed = phonenumbers.parse(number, 'US')
+    except phonenumbers.NumberParseException:
+        return None
+
+    if not phonenumbers.is_valid_number(parsed):
+        return None
+
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+
+class RVMScheduler(object):
+    """
+    Dispatch ringless voicemails in batches, honoring rvm_limit
+    """
+
+    def __init__(self, client, session=db_session, batch_size=RVM_BATCH_SIZE, concurrency=RVM_CONCURRENCY):
+        self.client = client
+        self.session = session
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+    def eligible_campaigns(self):
+        """
+        Get the campaigns with RVMs enabled and sends remaining
+        :return: list campaign ids
+        """
+        rows = self.session.query(Campaign.id).filter(
+            Campaign.send_rvm == 1,
+            Campaign.status == 'ACTIVE',
+            Campaign.archived == 0,
+            Campaign.rvm_campaign_id > 0,
+            Campaign.rvm_send_count < Campaign.rvm_limit
+        ).all()
+
+        return [row.id for row in rows]
+
+    def claim_batch(self, campaign_id):
+        """
+        Reserve send slots and claim a batch of leads for the campaign.
+        The campaign row stays locked until commit, so concurrent
+        schedulers can never claim past rvm_limit or claim a lead twice.
+        :param campaign_id:
+        :return: tuple (rvm_campaign_id, list of (lead_id, phone), int rows claimed)
+        """
+        try:
+            campaign = self.session.query(Campaign).filter(
+                Campaign.id == campaign_id
+            ).with_for_update().one()
+
+            remaining = (campaign.rvm_limit or 0) - (campaign.rvm_send_count or 0)
+            if remaining <= 0 or not campaign.send_rvm:
+                self.session.commit()
+                return campaign.rvm_campaign_id, [], 0
+
+            stmt = text("select l.id, av.cell_phone, av.home_phone "
+                        "from leads l, appendedvisitors av, visitors v "
+                        "where av.id = l.appended_visitor_id "
+                        "and v.id = av.visitor "
+                        "and v.campaign_id = :campaign_id "
+                        "and l.rvm_sent = 0 "
+                        "and l.rvm_status is NULL "
+                        "and l.lead_optout = 0 "
+                        "order by l.id asc "
+                        "limit :limit")
+
+            rows = self.session.execute(stmt, {
+                'campaign_id': campaign_id,
+                'limit': min(self.batch_size, remaining)
+            }).fetchall()
+
+            leads = []
+            invalid = []
+            for row in rows:
+                phone = format_phone(row.cell_phone or row.home_phone or '')
+                if phone:
+                    leads.append((row.id, phone))
+                else:
+                    invalid.append({'id': row.id, 'status': 'INVALID', 'message': 'No valid phone number'})
+
+            if leads:
+                self.session.execute(
+                    text("update leads set rvm_status = 'QUEUED', rvm_date = :now where id = :id"),
+                    [{'id': lead_id, 'now': datetime.datetime.now()} for lead_id, phone in leads]
+                )
+                self.session.execute(
+                    text("update campaigns set rvm_send_count = rvm_send_count + :count where id = :id"),
+                    {'count': len(leads), 'id': campaign_id}
+                )
+
+            if invalid:
+                self.session.execute(
+                    text("update leads set rvm_status = :status, rvm_message = :message where id = :id"),
+                    invalid
+                )
+
+            self.session.commit()
+            return campaign.rvm_campaign_id, leads, len(rows)
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def send_batch(self, rvm_campaign_id, leads):
+        """
+        Call the provider for each lead through the bounded pool
+        :param rvm_campaign_id:
+        :param leads: list of (lead_id, phone)
+        :return: list of (lead_id, status, message)
+        """
+        def send(lead):
+            lead_id, phone = lead
+            status, message = self.client.send(rvm_campaign_id, phone, lead_id)
+            return lead_id, status, message
+
+        pool = ThreadPool(self.concurrency)
+        try:
+            return pool.map(send, leads)
+        finally:
+            pool.close()
+            pool.join()
+
+    def record_results(self, campaign_id, results):
+        """
+        Write the send results back in bulk and release the
+        reserved slots of any failed sends
+        :param campaign_id:
+        :param results: list of (lead_id, status, message)
+        :return: int sent count
+        """
+        now = datetime.datetime.now()
+        sent = [{'id': lead_id, 'status': status, 'message': message, 'rvm_date': now}
+                for lead_id, status, message in results if status == 'SENT']
+        failed = [{'id': lead_id, 'status': status, 'message': message}
+                  for lead_id, status, message in results if status != 'SENT']
+
+        try:
+            if sent:
+                self.session.execute(
+                    text("update leads set rvm_sent = 1, rvm_date = :rvm_date, rvm_status = :status, "
+                         "rvm_message = :message where id = :id"),
+                    sent
+                )
+
+            if failed:
+                # only leads still QUEUED hold a slot, reclaimed ones were released already
+                released = self.session.execute(
+                    text("update leads set rvm_status = :status, rvm_message = :message "
+                         "where id = :id and rvm_status = 'QUEUED'"),
+                    failed
+                ).rowcount
+                if released:
+                    self.session.execute(
+                        text("update campaigns set rvm_send_count = rvm_send_count - :count where id = :id"),
+                        {'count': released, 'id': campaign_id}
+                    )
+
+            self.session.commit()
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+        return len(sent)
+
+    def dispatch_campaign(self, campaign_id, max_batches=None):
+        """
+        Dispatch batches for one campaign until the limit is reached
+        or there are no eligible leads left
+        :param campaign_id:
+        :param max_batches:
+        :return: dict counts
+        """
+        stats = {'campaign_id': campaign_id, 'batches': 0, 'sent': 0, 'failed': 0}
+
+        while max_batches is None or stats['batches'] < max_batches:
+            rvm_campaign_id, leads, claimed = self.claim_batch(campaign_id)
+            if not claimed:
+                break
+
+            # a batch of only invalid phones is marked INVALID, move on to the next
+            if not leads:
+                continue
+
+            results = self.send_batch(rvm_campaign_id, leads)
+            sent = self.record_results(campaign_id, results)
+
+            stats['batches'] += 1
+            stats['sent'] += sent
+            stats['failed'] += len(results) - sent
+
+        return stats
+
+    def reclaim_expired(self, now=None):
+        """
+        Release leads left QUEUED past the lease and give their send
+        slots back to the campaign
+        :param now:
+        :return: int leads released
+        """
+        now = now or datetime.datetime.now()
+        cutoff = now - datetime.timedelta(seconds=RVM_LEASE_SECONDS)
+
+        rows = self.session.execute(
+            text("select l.id, v.campaign_id "
+                 "from leads l, appendedvisitors av, visitors v "
+                 "where l.rvm_status = 'QUEUED' "
+                 "and l.rvm_date < :cutoff "
+                 "and av.id = l.appended_visitor_id "
+                 "and v.id = av.visitor"),
+            {'cutoff': cutoff}
+        ).fetchall()
+        self.session.commit()
+
+        campaigns = {}
+        for row in rows:
+            campaigns.setdefault(row.campaign_id, []).append({'id': row.id})
+
+        released = 0
+        for campaign_id, leads in campaigns.items():
+            try:
+                # same lock order as claim_batch
+                self.session.query(Campaign).filter(Campaign.id == campaign_id).with_for_update().one()
+
+                count = self.session.execute(
+                    text("update leads set rvm_status = NULL, rvm_date = NULL "
+                         "where id = :id and rvm_status = 'QUEUED'"),
+                    leads
+                ).rowcount
+                if count:
+                    self.session.execute(
+                        text("update campaigns set rvm_send_count = rvm_send_count - :count where id = :id"),
+                        {'count': count, 'id': campaign_id}
+                    )
+
+                self.session.commit()
+                released += count
+
+            except Exception:
+                self.session.rollback()
+                raise
+
+        return released
+
+    def run(self, max_batches=None):
+        """
+        Release expired leases, then dispatch every eligible campaign
+        :param max_batches: per campaign
+        :return: list of dict counts
+        """
+        self.reclaim_expired()
+        return [self.dispatch_campaign(campaign_id, max_batches=max_batches)
+                for campaign_id in self.eligible_campaigns()]
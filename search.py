@@ -0,0 +1,109 @@
+"""
+Lead search
+
+Prefix search over a store's appended visitors by last name, email
+and phone.  appendedvisitors carries its visitor's store_id, so each
+field is searched by its own (store_id, field) index range scan that
+stops after the page being fetched, and the branches are combined with
+a union.  Results are ordered by the value that matched the prefix,
+then id: every branch reads its index in that same order, so the union
+always holds the true first rows of the merged result.  A visitor
+matching more than one branch is kept once under its lowest matched
+value.
+"""
+from database import db_session
+from sqlalchemy import text
+import re
+
+SEARCH_PER_PAGE = 25
+SEARCH_MIN_LENGTH = 2
+
+# ! rather than backslash, the same in MySQL and SQLite string literals
+LIKE_ESCAPE = '!'
+
+SEARCH_BRANCH = ("select * from ("
+                 "select av.id, av.{column} as sort_key "
+                 "from appendedvisitors av "
+                 "where av.store_id = :store_id "
+                 "and av.{column} like :{param} escape '" + LIKE_ESCAPE + "' "
+                 "order by av.{column}, av.id "
+                 "limit :branch_limit) b_{column}")
+
+# field -> (indexed column, bind parameter)
+SEARCH_FIELDS = {
+    'last_name': ('last_name', 'prefix'),
+    'email': ('email', 'prefix'),
+    'home_phone': ('home_phone_digits', 'digits'),
+    'cell_phone': ('cell_phone_digits', 'digits'),
+}
+
+
+def escape_like(value):
+    """
+    Escape the LIKE wildcards in user input
+    :param value:
+    :return: str
+    """
+    return value.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2).replace('%', LIKE_ESCAPE + '%').replace(
+        '_', LIKE_ESCAPE + '_')
+
+
+def search_fields(query):
+    """
+    Pick the fields worth searching for the query
+    :param query:
+    :return: list field names
+    """
+    digits = re.sub(r'\D', '', query)
+
+    if '@' in query:
+        return ['email']
+    if digits and not re.search(r'[A-Za-z]', query):
+        return ['home_phone', 'cell_phone']
+    return ['last_name', 'email']
+
+
+def search_leads(store_pk_id, query, page=1, per_page=SEARCH_PER_PAGE, session=db_session):
+    """
+    Search the store's appended visitors and leads
+    :param store_pk_id:
+    :param query: last name, email or phone prefix
+    :param page:
+    :param per_page:
+    :param session:
+    :return: tuple (list rows, bool has_next)
+    """
+    query = (query or '').strip()
+    if len(query) < SEARCH_MIN_LENGTH:
+        return [], False
+
+    page = max(int(page), 1)
+    offset = (page - 1) * per_page
+
+    branches = []
+    for field in search_fields(query):
+        column, param = SEARCH_FIELDS[field]
+        branches.append(SEARCH_BRANCH.format(column=column, param=param))
+
+    stmt = text("select av.id, av.visitor as visitor_id, v.campaign_id, av.first_name, av.last_name, av.email, "
+                "av.home_phone, av.cell_phone, av.created_date, c.name as campaign_name, "
+                "(select min(l.id) from leads l where l.appended_visitor_id = av.id) as lead_id "
+                "from (select id, min(sort_key) as sort_key "
+                "from (" + " union all ".join(branches) + ") m "
+                "group by id) u "
+                "join appendedvisitors av on av.id = u.id "
+                "join visitors v on v.id = av.visitor "
+                "join campaigns c on c.id = v.campaign_id "
+                "order by u.sort_key, u.id "
+                "limit :limit offset :offset")
+
+    rows = session.execute(stmt, {
+        'store_id': store_pk_id,
+        'prefix': escape_like(query) + '%',
+        'digits': escape_like(re.sub(r'\D', '', query)) + '%',
+        'branch_limit': offset + per_page + 1,
+        'limit': per_page + 1,
+        'offset': offset
+    }).fetchall()
+
+    return rows[:per_page], len(rows) > per_page
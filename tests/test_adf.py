@@ -0,0 +1,89 @@
+from models import Store, Campaign, Visitor, AppendedVisitor, Lead
+import adf
+import contextlib
+import datetime
+
+
+class FakeApp(object):
+    config = {'MAIL_DEFAULT_SENDER': 'earl@example.com'}
+
+    @contextlib.contextmanager
+    def app_context(self):
+        yield self
+
+
+class FakeMail(object):
+    """
+    Flask-Mail stand-in, sends to failing addresses raise
+    """
+
+    def __init__(self, failing=()):
+        self.app = FakeApp()
+        self.failing = set(failing)
+        self.sent = []
+
+    @contextlib.contextmanager
+    def connect(self):
+        yield self
+
+    def send(self, msg):
+        if self.failing.intersection(msg.recipients):
+            raise IOError('SMTP refused')
+        self.sent.append(msg)
+
+
+def add_store_lead(session, store_id, adf_email):
+    now = datetime.datetime.now()
+    if not session.query(Store).get(store_id):
+        session.add(Store(id=store_id, client_id='s{}'.format(store_id), name='Store {}'.format(store_id),
+                          address1='1 Main St', city='Orlando', state='FL', zip_code='32801',
+                          notification_email='n@example.com', reporting_email='r@example.com',
+                          phone_number='4075550100', adf_email=adf_email))
+        session.add(Campaign(id=store_id, store_id=store_id, name='Campaign {}'.format(store_id),
+                             job_number=store_id, type=1, status='ACTIVE', start_date=now, end_date=now,
+                             client_id='test', rvm_campaign_id=store_id, send_adf=1))
+        session.flush()
+
+    visitor = Visitor(campaign_id=store_id)
+    session.add(visitor)
+    session.flush()
+    appended = AppendedVisitor(visitor=visitor.id, first_name='Lead', last_name=str(visitor.id))
+    session.add(appended)
+    session.flush()
+    lead = Lead(appended_visitor_id=appended.id, rvm_sent=0, lead_optout=0, sent_adf=0)
+    session.add(lead)
+    session.commit()
+    return lead.id
+
+
+def test_failing_store_does_not_block_the_others(session):
+    bad = [add_store_lead(session, 1, 'down@example.com') for i in range(2)]
+    good = [add_store_lead(session, 2, 'adf@example.com') for i in range(3)]
+    blank = add_store_lead(session, 3, ' ')
+
+    mail = FakeMail(failing=['down@example.com'])
+    totals = adf.ADFDelivery(mail, session=session, batch_size=2, concurrency=2).run()
+
+    assert totals['sent'] == 3
+    assert totals['failed'] == 2
+
+    leads = dict((lead.id, lead) for lead in session.query(Lead))
+    assert all(leads[lead_id].sent_adf for lead_id in good)
+    assert not any(leads[lead_id].sent_adf for lead_id in bad)
+    assert leads[bad[0]].adf_email_validation_message == 'SMTP refused'
+    assert not leads[blank].sent_adf
+    assert leads[blank].adf_email_validation_message is None
+
+
+def test_failed_leads_are_retried_on_the_next_run(session):
+    lead_id = add_store_lead(session, 1, 'down@example.com')
+    mail = FakeMail(failing=['down@example.com'])
+    delivery = adf.ADFDelivery(mail, session=session)
+
+    assert delivery.run()['failed'] == 1
+
+    mail.failing.clear()
+    assert delivery.run()['sent'] == 1
+    lead = session.query(Lead).get(lead_id)
+    assert lead.sent_adf
+    assert lead.adf_email_validation_message is None
@@ -0,0 +1,62 @@
+from models import Lead
+from pixel import BatchBuffer
+import datetime
+import emailevents
+import pytest
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = emailevents.EventStore(uri='mongomock://localhost', database='earl_test')
+    monkeypatch.setattr(emailevents, 'event_buffer', BatchBuffer(store))
+    yield store
+    store.get_collection().database.client.drop_database('earl_test')
+
+
+def add_leads(session, count):
+    leads = [Lead(appended_visitor_id=i + 1, rvm_sent=0, lead_optout=0) for i in range(count)]
+    session.add_all(leads)
+    session.commit()
+    return [lead.id for lead in leads]
+
+
+def test_recorded_events_roll_up_onto_the_leads(session, store):
+    first, second, idle = add_leads(session, 3)
+
+    for lead_id, kind in [(first, emailevents.EVENT_OPEN), (first, emailevents.EVENT_OPEN),
+                          (first, emailevents.EVENT_CLICK), (second, emailevents.EVENT_OPEN)]:
+        emailevents.record_event(lead_id, kind, '10.0.0.1', 'mail/1.0', url='https://example.com/')
+    emailevents.event_buffer.flush_now()
+
+    assert emailevents.rollup(store=store, session=session, chunk_size=1) == 2
+
+    session.expire_all()
+    leads = dict((lead.id, lead) for lead in session.query(Lead))
+    assert (leads[first].email_opens, leads[first].email_clicks) == (2, 1)
+    assert isinstance(leads[first].email_clicked_date, datetime.datetime)
+    assert (leads[second].email_opens, leads[second].email_clicks) == (1, 0)
+    assert leads[idle].email_opens in (None, 0)
+
+    # totals are absolute, a later open of the same lead recounts it
+    emailevents.record_event(second, emailevents.EVENT_OPEN, '10.0.0.1', 'mail/1.0')
+    emailevents.event_buffer.flush_now()
+    assert emailevents.rollup(store=store, session=session) == 2
+    session.expire_all()
+    assert session.query(Lead).get(second).email_opens == 2
+    assert session.query(Lead).get(first).email_opens == 2
+
+
+def test_track_html_signs_links_and_adds_the_pixel():
+    html = ('<html><body><a href="https://dealer.example.com/offer?a=1&amp;b=2">Offer</a> '
+            '<a href="mailto:sales@example.com">Mail</a></body></html>')
+
+    tracked = emailevents.track_html(42, html, base_url='https://earl.example.com/')
+
+    click = tracked.split('href="https://earl.example.com/t/c/')[1].split('"')[0]
+    assert emailevents.load_token(click, emailevents.EVENT_CLICK) == (42, 'https://dealer.example.com/offer?a=1&b=2')
+    assert 'href="mailto:sales@example.com"' in tracked
+
+    pixel = tracked.split('src="https://earl.example.com/t/o/')[1].split('.gif"')[0]
+    assert emailevents.load_token(pixel, emailevents.EVENT_OPEN) == (42, None)
+    assert tracked.endswith('</body></html>')
+    assert emailevents.load_token(pixel, emailevents.EVENT_CLICK) is None
@@ -0,0 +1,46 @@
+from models import Campaign, Visitor
+import datetime
+import geoip
+import maxminddb
+import pytest
+
+RECORDS = {
+    '8.8.8.8': {'country': {'iso_code': 'US', 'names': {'en': 'United States'}},
+                'city': {'names': {'en': 'Mountain View'}},
+                'location': {'latitude': 37.4, 'longitude': -122.1, 'metro_code': 807,
+                             'time_zone': 'America/Los_Angeles'}}
+}
+
+
+class FakeReader(object):
+
+    def get(self, ip):
+        return RECORDS.get(ip)
+
+
+@pytest.fixture
+def enricher(session, monkeypatch):
+    monkeypatch.setattr(maxminddb, 'open_database', lambda path, mode: FakeReader())
+    now = datetime.datetime.now()
+    session.add(Campaign(id=1, store_id=1, name='Campaign 1', job_number=1, type=1, status='ACTIVE',
+                         start_date=now, end_date=now, client_id='test', rvm_campaign_id=1))
+    session.commit()
+    return geoip.GeoIPEnricher(session=session)
+
+
+def test_enriches_visitors_the_work_queue_already_processed(session, enricher):
+    visitors = [Visitor(campaign_id=1, ip='8.8.8.8', processed=True),
+                Visitor(campaign_id=1, ip='10.0.0.1', processed=False),
+                Visitor(campaign_id=1, ip=None, processed=True),
+                Visitor(campaign_id=1, ip='8.8.8.8', processed=True, country_code='CA')]
+    session.add_all(visitors)
+    session.commit()
+
+    stats = enricher.run(batch_size=2)
+    assert stats['enriched'] == 3
+
+    session.expire_all()
+    codes = [session.query(Visitor).get(visitor.id).country_code for visitor in visitors]
+    assert codes == ['US', geoip.GEOIP_UNKNOWN, geoip.GEOIP_UNKNOWN, 'CA']
+    assert session.query(Visitor).get(visitors[0].id).city == 'Mountain View'
+    assert enricher.run()['enriched'] == 0
@@ -0,0 +1,42 @@
+from models import Campaign, Visitor
+from pixel import BatchBuffer, Hit, HitWriter
+import datetime
+
+
+def add_campaign(session, campaign_id=1, store_id=7):
+    now = datetime.datetime.now()
+    session.add(Campaign(id=campaign_id, store_id=store_id, name='Campaign {}'.format(campaign_id),
+                         job_number=campaign_id, type=1, status='ACTIVE', start_date=now, end_date=now,
+                         client_id='test', rvm_campaign_id=campaign_id))
+    session.commit()
+
+
+def test_hits_coalesce_and_add_onto_the_lowest_legacy_row(session):
+    add_campaign(session)
+    earlier = datetime.datetime(2018, 1, 1)
+    # PixelTracker rows: a duplicate pair and a NULL open hash
+    legacy = [Visitor(campaign_id=1, store_id=7, ip='10.0.0.1', open_hash='a', num_visits=2, last_visit=earlier),
+              Visitor(campaign_id=1, store_id=7, ip='10.0.0.1', open_hash='a', num_visits=1, last_visit=earlier,
+                      appended=True),
+              Visitor(campaign_id=1, store_id=7, ip='10.0.0.2', open_hash=None, num_visits=1, last_visit=earlier)]
+    session.add_all(legacy)
+    session.commit()
+    first, appended, no_hash = [visitor.id for visitor in legacy]
+
+    now = datetime.datetime(2018, 6, 1)
+    buffer = BatchBuffer(HitWriter(session.get_bind()))
+    for hit in [Hit(1, '10.0.0.1', 'ua', 'a', 'c', 's', now), Hit(1, '10.0.0.1', 'ua', 'a', 'c', 's', now),
+                Hit(1, '10.0.0.2', 'ua', '', 'c', 's', now), Hit(1, '10.0.0.3', 'ua', 'b', 'c', 's', now),
+                Hit(1, '10.0.0.3', 'ua', 'b', 'c', 's', now), Hit(2, '10.0.0.4', 'ua', '', 'c', 's', now)]:
+        buffer.items.append(hit)
+    buffer.flush_now()
+
+    session.expire_all()
+    visitors = dict((visitor.id, visitor) for visitor in session.query(Visitor))
+    assert len(visitors) == 4
+    assert (visitors[first].num_visits, visitors[first].last_visit) == (4, now)
+    assert (visitors[appended].num_visits, visitors[appended].appended) == (1, True)
+    assert visitors[no_hash].num_visits == 2
+
+    new = [visitor for visitor in visitors.values() if visitor.ip == '10.0.0.3']
+    assert [(visitor.num_visits, visitor.store_id) for visitor in new] == [(2, 7)]
@@ -0,0 +1,52 @@
+from flask import Flask
+from flask_login import LoginManager, UserMixin
+import os
+import profiler
+import time
+
+
+class Admin(UserMixin):
+    id = 1
+    is_admin = True
+
+
+def make_app(directory, slow_seconds=0):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    login_manager = LoginManager(app)
+    login_manager.request_loader(lambda request: Admin() if request.args.get('admin') else None)
+
+    @app.route('/work')
+    def work():
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            sum(range(1000))
+        return 'ok'
+
+    return app, profiler.Profiler(app, directory=directory, slow_seconds=slow_seconds)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_explicit_capture_is_stack_sampled_with_slow_sampling_off(tmp_path):
+    app, request_profiler = make_app(str(tmp_path))
+    client = app.test_client()
+
+    assert client.get('/work?_profile=1').headers.get('X-Earl-Profile-Capture') is None
+    assert request_profiler.watchdog is None
+
+    name = client.get('/work?_profile=1&admin=1').headers['X-Earl-Profile-Capture']
+    folded = read(os.path.join(str(tmp_path), name + '.folded'))
+    assert 'work (test_profiler.py' in folded
+    assert os.path.getsize(os.path.join(str(tmp_path), name + '.prof')) > 0
+
+
+def test_slow_requests_are_sampled_once_enabled(tmp_path):
+    app, request_profiler = make_app(str(tmp_path), slow_seconds=0.05)
+
+    name = app.test_client().get('/work').headers['X-Earl-Profile-Capture']
+    assert read(os.path.join(str(tmp_path), name + '.folded'))
+    assert not os.path.exists(os.path.join(str(tmp_path), name + '.prof'))
@@ -0,0 +1,112 @@
+from flask import Flask
+from models import Campaign, RecapDelivery, Store
+from retention import RetentionPurger
+from test_retention import add_archived_campaign
+import datetime
+import pytest
+import recap
+
+DAY = datetime.datetime(2017, 3, 1)
+
+
+def add_campaign(session, campaign_id=2):
+    session.add(Campaign(id=campaign_id, store_id=1, name='Campaign {}'.format(campaign_id), job_number=campaign_id,
+                         type=1, status='ACTIVE', start_date=DAY, end_date=DAY, client_id='test',
+                         rvm_campaign_id=campaign_id, archived=0))
+    session.commit()
+
+
+def fake_query(rows):
+    # the raw recap SQL relies on SQLAlchemy 1.2 textual columns
+    def query_daily_recap(campaign_pk_id, start_date, end_date, session):
+        return [recap.cache.row_type(*row) for row in rows]
+    return query_daily_recap
+
+
+def recap_row(last_name):
+    return [DAY, 'Ada', last_name] + [None] * (len(recap.RECAP_COLUMNS) - 3)
+
+
+def test_closed_days_of_live_campaigns_are_cached(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(recap.cache, 'directory', str(tmp_path))
+    monkeypatch.setattr(recap, 'query_daily_recap', fake_query([recap_row('Lovelace')]))
+    add_campaign(session)
+    start_date, end_date = recap.day_range(DAY)
+
+    assert [row.last_name for row in recap.get_daily_recap(2, start_date, end_date, session)] == ['Lovelace']
+    assert [path.name for path in tmp_path.iterdir()] == ['2_20170301.recap.z']
+
+    monkeypatch.setattr(recap, 'query_daily_recap', fake_query([]))
+    assert [row.last_name for row in recap.get_daily_recap(2, start_date, end_date, session)] == ['Lovelace']
+
+
+def test_archived_campaigns_bypass_and_drop_the_cache(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(recap.cache, 'directory', str(tmp_path))
+    monkeypatch.setattr(recap, 'query_daily_recap', fake_query([recap_row('Lovelace')]))
+    add_campaign(session)
+    start_date, end_date = recap.day_range(DAY)
+    recap.get_daily_recap(2, start_date, end_date, session)
+
+    session.query(Campaign).get(2).archived = 1
+    session.commit()
+    monkeypatch.setattr(recap, 'query_daily_recap', fake_query([recap_row(None)]))
+
+    # the anonymized rows, not the copy cached while the campaign was live
+    assert [row.last_name for row in recap.get_daily_recap(2, start_date, end_date, session)] == [None]
+    assert list(tmp_path.iterdir()) == []
+
+    # purged, then unarchived again
+    add_archived_campaign(session, 3, visitors=0)
+    RetentionPurger(session, pause=0, lag=lambda: 0.0).run()
+    session.query(Campaign).get(3).archived = 0
+    session.commit()
+    assert recap.cacheable(3, session) is False
+    assert recap.cacheable(99, session) is False
+
+
+def add_store(session, store_id, reporting_email):
+    session.add(Store(id=store_id, client_id='store{}'.format(store_id), name='Store {}'.format(store_id),
+                      address1='1 Main St', city='Orlando', state='FL', zip_code='32801', status='Active',
+                      notification_email='n@example.com', reporting_email=reporting_email,
+                      phone_number='4075550100', archived=0))
+    session.commit()
+
+
+class FakeMail(object):
+
+    def __init__(self, error=None):
+        self.app = Flask(__name__)
+        self.app.config['MAIL_DEFAULT_SENDER'] = 'earl@example.com'
+        self.error = error
+        self.sent = []
+
+    def send(self, msg):
+        if self.error:
+            raise self.error
+        self.sent.append(msg)
+
+
+def test_recap_stores_need_a_reporting_email(session):
+    add_store(session, 1, 'gm@example.com')
+    add_store(session, 2, '')
+
+    assert recap.get_recap_stores(session) == [1]
+
+
+def test_a_sent_recap_is_not_raised_for_a_failed_delivery_record(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(recap.cache, 'directory', str(tmp_path))
+    monkeypatch.setattr(recap, 'query_daily_recap', fake_query([recap_row('Lovelace')]))
+    add_store(session, 1, 'gm@example.com')
+    add_campaign(session)
+
+    with pytest.raises(RuntimeError):
+        recap.send_store_recap(FakeMail(RuntimeError('smtp down')), 1, DAY, session)
+    assert [delivery.status for delivery in session.query(RecapDelivery)] == ['FAILED']
+
+    def commit():
+        raise RuntimeError('db gone')
+
+    mail = FakeMail()
+    monkeypatch.setattr(session, 'commit', commit)
+    delivery = recap.send_store_recap(mail, 1, DAY, session)
+    assert (delivery.status, len(mail.sent)) == ('SENT', 1)
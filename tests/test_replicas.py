@@ -0,0 +1,65 @@
+from models import Base, StoreDashboard
+from replicas import ReplicaRouter
+from sqlalchemy import create_engine
+import datetime
+import pytest
+
+NOW = datetime.datetime(2018, 6, 1, 12, 0, 0)
+
+
+def add_dashboard(session, last_update):
+    session.add(StoreDashboard(store_id=1, last_update=last_update))
+    session.commit()
+
+
+def make_replica(tmp_path, name, last_update):
+    uri = 'sqlite:///{}'.format(tmp_path / name)
+    engine = create_engine(uri)
+    Base.metadata.create_all(engine)
+    engine.execute(StoreDashboard.__table__.insert().values(store_id=1, last_update=last_update))
+    engine.dispose()
+    return uri
+
+
+@pytest.fixture
+def primary(session):
+    add_dashboard(session, NOW)
+    return session
+
+
+def test_round_robin_over_fresh_replicas(primary, tmp_path):
+    uris = [make_replica(tmp_path, 'a.db', NOW), make_replica(tmp_path, 'b.db', NOW - datetime.timedelta(seconds=5))]
+    router = ReplicaRouter(uris, primary=primary, max_lag=60)
+
+    picked = [router.get_session() for i in range(4)]
+
+    assert picked == [router.sessions[0], router.sessions[1], router.sessions[0], router.sessions[1]]
+    assert router.lag(1) == 5.0
+    router.remove()
+
+
+def test_lagging_replicas_fall_back_to_the_primary(primary, tmp_path):
+    uris = [make_replica(tmp_path, 'a.db', NOW - datetime.timedelta(minutes=10)),
+            make_replica(tmp_path, 'b.db', NOW)]
+    router = ReplicaRouter(uris, primary=primary, max_lag=60)
+
+    # the stale replica is skipped, the fresh one takes every read
+    assert [router.get_session() for i in range(3)] == [router.sessions[1]] * 3
+
+    add_dashboard(primary, NOW + datetime.timedelta(minutes=5))
+    router.checked.clear()
+    assert router.get_session() is primary
+    router.remove()
+
+
+def test_unreachable_replica_is_skipped(primary, tmp_path):
+    missing = 'sqlite:///{}'.format(tmp_path / 'missing' / 'replica.db')
+    router = ReplicaRouter([missing, make_replica(tmp_path, 'b.db', NOW)], primary=primary, max_lag=60)
+
+    assert router.lag(0) is None
+    assert [router.get_session() for i in range(2)] == [router.sessions[1]] * 2
+    router.remove()
+
+    router = ReplicaRouter([missing], primary=primary, max_lag=60)
+    assert router.get_session() is primary
+    router.remove()
@@ -0,0 +1,43 @@
+from models import Campaign, Visitor, AppendedVisitor, Lead, RetentionCheckpoint
+from retention import RetentionPurger, STATUS_DONE
+import datetime
+
+
+def add_archived_campaign(session, campaign_id, visitors=3):
+    archived = datetime.datetime.now() - datetime.timedelta(days=400)
+    session.add(Campaign(id=campaign_id, store_id=1, name='Campaign {}'.format(campaign_id), job_number=campaign_id,
+                         type=1, status='INACTIVE', start_date=archived, end_date=archived, client_id='test',
+                         rvm_campaign_id=campaign_id, archived=1, archived_date=archived))
+    session.flush()
+    for i in range(visitors):
+        visitor = Visitor(campaign_id=campaign_id)
+        session.add(visitor)
+        session.flush()
+        appended = AppendedVisitor(visitor=visitor.id, first_name='Lead', email='lead{}@example.com'.format(i))
+        session.add(appended)
+        session.flush()
+        session.add(Lead(appended_visitor_id=appended.id, rvm_sent=0, lead_optout=0))
+    session.commit()
+
+
+def test_purge_deletes_in_chunks(session):
+    add_archived_campaign(session, 1)
+
+    stats = RetentionPurger(session, chunk_size=2, pause=0, lag=lambda: 0.0).run()
+
+    assert stats['status'] == STATUS_DONE
+    assert (stats['campaigns'], stats['visitors'], stats['appended'], stats['leads']) == (1, 3, 3, 3)
+    assert session.query(Visitor).count() == 0
+    assert session.query(RetentionCheckpoint).one().finished_date is not None
+
+
+def test_throttled_purge_resumes(session):
+    add_archived_campaign(session, 1)
+
+    stats = RetentionPurger(session, mode='anonymize', chunk_size=2, pause=0, lag=lambda: 999.0).run()
+    assert stats['status'] == 'throttled'
+
+    stats = RetentionPurger(session, mode='anonymize', chunk_size=2, pause=0, lag=lambda: 0.0).run()
+    assert stats['status'] == STATUS_DONE
+    assert session.query(AppendedVisitor).filter(AppendedVisitor.email != None).count() == 0  # noqa: E711
+    assert session.query(Visitor).count() == 3
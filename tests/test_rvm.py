@@ -0,0 +1,77 @@
+from models import Campaign, Visitor, AppendedVisitor, Lead
+import datetime
+import rvm
+
+VALID_PHONE = '(212) 555-{:04d}'
+VALID_E164 = '+1212555{:04d}'
+
+
+def add_campaign(session, campaign_id=1, rvm_limit=100):
+    now = datetime.datetime.now()
+    session.add(Campaign(id=campaign_id, store_id=1, name='Campaign {}'.format(campaign_id), job_number=campaign_id,
+                         type=1, status='ACTIVE', start_date=now, end_date=now, client_id='test',
+                         rvm_campaign_id=100 + campaign_id, rvm_send_count=0, rvm_limit=rvm_limit, archived=0,
+                         send_rvm=1))
+    session.commit()
+
+
+def add_lead(session, campaign_id, phone):
+    visitor = Visitor(campaign_id=campaign_id)
+    session.add(visitor)
+    session.flush()
+    appended = AppendedVisitor(visitor=visitor.id, cell_phone=phone)
+    session.add(appended)
+    session.flush()
+    lead = Lead(appended_visitor_id=appended.id, rvm_sent=0, lead_optout=0)
+    session.add(lead)
+    session.commit()
+    return lead.id
+
+
+def test_invalid_batch_does_not_stop_the_campaign(session):
+    add_campaign(session)
+    invalid = [add_lead(session, 1, 'n/a') for i in range(2)]
+    valid = [add_lead(session, 1, VALID_PHONE.format(i)) for i in range(3)]
+
+    client = rvm.FakeRVMClient()
+    stats = rvm.RVMScheduler(client, session=session, batch_size=2, concurrency=2).dispatch_campaign(1)
+
+    assert stats['sent'] == 3
+    assert sorted(lead_id for campaign_id, phone, lead_id in client.sent) == valid
+    assert set(row.rvm_status for row in session.query(Lead).filter(Lead.id.in_(invalid))) == {'INVALID'}
+    assert session.query(Campaign).get(1).rvm_send_count == 3
+
+
+def test_rvm_limit_and_failed_sends_release_slots(session):
+    add_campaign(session, rvm_limit=3)
+    for i in range(5):
+        add_lead(session, 1, VALID_PHONE.format(i))
+
+    client = rvm.FakeRVMClient(fail_phones=[VALID_E164.format(0)])
+    stats = rvm.RVMScheduler(client, session=session, batch_size=10, concurrency=2).dispatch_campaign(1)
+
+    # the failed send gives its slot back, so a fourth lead goes out
+    assert stats['sent'] == 3
+    assert stats['failed'] == 1
+    assert session.query(Campaign).get(1).rvm_send_count == 3
+
+
+def test_reclaim_expired_releases_queued_leads(session):
+    add_campaign(session)
+    lead_ids = [add_lead(session, 1, VALID_PHONE.format(i)) for i in range(2)]
+
+    scheduler = rvm.RVMScheduler(rvm.FakeRVMClient(), session=session)
+    rvm_campaign_id, leads, claimed = scheduler.claim_batch(1)
+    assert claimed == 2
+    assert session.query(Campaign).get(1).rvm_send_count == 2
+
+    # the worker died before record_results
+    assert scheduler.reclaim_expired() == 0
+    later = datetime.datetime.now() + datetime.timedelta(seconds=rvm.RVM_LEASE_SECONDS + 1)
+    assert scheduler.reclaim_expired(now=later) == 2
+
+    session.expire_all()
+    assert session.query(Campaign).get(1).rvm_send_count == 0
+    assert [lead.rvm_status for lead in session.query(Lead).filter(Lead.id.in_(lead_ids))] == [None, None]
+
+    assert scheduler.dispatch_campaign(1)['sent'] == 2
@@ -0,0 +1,78 @@
+from models import Campaign, Visitor, AppendedVisitor
+from pixel import Hit, HitWriter
+from scoring import LeadScorer
+import datetime
+
+
+def add_campaign(session, campaign_id=1):
+    now = datetime.datetime.now()
+    session.add(Campaign(id=campaign_id, store_id=1, name='Campaign {}'.format(campaign_id), job_number=campaign_id,
+                         type=1, status='ACTIVE', start_date=now, end_date=now, client_id='test',
+                         rvm_campaign_id=campaign_id))
+    session.commit()
+
+
+def add_visitor(session, ip, last_visit, credit_range='750-799'):
+    visitor = Visitor(campaign_id=1, store_id=1, ip=ip, open_hash='', num_visits=1, last_visit=last_visit)
+    session.add(visitor)
+    session.flush()
+    session.add(AppendedVisitor(visitor=visitor.id, credit_range=credit_range, car_year=2010))
+    session.commit()
+    return visitor.id
+
+
+def test_refresh_only_scores_marked_visitors(session):
+    add_campaign(session)
+    now = datetime.datetime.now()
+    visitor_id = add_visitor(session, '10.0.0.1', now)
+    add_visitor(session, '10.0.0.2', now)
+
+    scorer = LeadScorer(session)
+    assert scorer.refresh()['scored'] == 2
+    assert scorer.refresh()['scored'] == 0
+
+    # a repeat visit through the pixel upsert marks the visitor again
+    HitWriter(session.get_bind())([Hit(1, '10.0.0.1', 'ua', '', '', '', now)])
+    session.expire_all()
+    assert session.query(Visitor).get(visitor_id).score_updated is None
+
+    assert scorer.refresh()['scored'] == 1
+    assert session.query(Visitor).get(visitor_id).num_visits == 2
+
+
+def test_sweep_marks_only_recent_visitors_with_old_scores(session):
+    add_campaign(session)
+    now = datetime.datetime.now()
+    recent = add_visitor(session, '10.0.0.1', now - datetime.timedelta(days=3))
+    dormant = add_visitor(session, '10.0.0.2', now - datetime.timedelta(days=200))
+
+    scorer = LeadScorer(session)
+    scorer.refresh()
+    assert scorer.sweep() == 0
+
+    later = now + datetime.timedelta(hours=scorer.max_age_hours + 1)
+    assert scorer.sweep(now=later) == 1
+
+    session.expire_all()
+    assert session.query(Visitor).get(recent).score_updated is None
+    assert session.query(Visitor).get(dormant).score_updated is not None
+
+
+def test_sweep_walks_the_ids_in_chunks(session, monkeypatch):
+    add_campaign(session)
+    now = datetime.datetime.now()
+    recent = [add_visitor(session, '10.0.0.{}'.format(i), now - datetime.timedelta(days=i)) for i in range(1, 6)]
+    dormant = add_visitor(session, '10.0.1.1', now - datetime.timedelta(days=200))
+
+    scorer = LeadScorer(session, sweep_chunk_size=2, sweep_pause=0)
+    scorer.refresh()
+
+    commits = []
+    commit = session.commit
+    monkeypatch.setattr(session, 'commit', lambda: commits.append(1) or commit())
+    assert scorer.sweep(now=now + datetime.timedelta(hours=scorer.max_age_hours + 1)) == 5
+    assert len(commits) == 3
+
+    session.expire_all()
+    assert [session.query(Visitor).get(visitor_id).score_updated for visitor_id in recent] == [None] * 5
+    assert session.query(Visitor).get(dormant).score_updated is not None
@@ -0,0 +1,67 @@
+from models import Campaign, Visitor, AppendedVisitor, Lead
+from search import search_leads
+import datetime
+
+
+def add_campaign(session, campaign_id, store_id):
+    now = datetime.datetime.now()
+    session.add(Campaign(id=campaign_id, store_id=store_id, name='Campaign {}'.format(campaign_id),
+                         job_number=campaign_id, type=1, status='ACTIVE', start_date=now, end_date=now,
+                         client_id='test', rvm_campaign_id=campaign_id))
+    session.commit()
+
+
+def add_appended(session, campaign_id, store_id, last_name, email, phone=None, leads=0):
+    visitor = Visitor(campaign_id=campaign_id, store_id=store_id)
+    session.add(visitor)
+    session.flush()
+    appended = AppendedVisitor(visitor=visitor.id, store_id=store_id, first_name='First', last_name=last_name,
+                               email=email, home_phone=phone, home_phone_digits=phone, cell_phone_digits=None)
+    session.add(appended)
+    session.flush()
+    for i in range(leads):
+        session.add(Lead(appended_visitor_id=appended.id, rvm_sent=0, lead_optout=0))
+    session.commit()
+    return appended.id
+
+
+def test_pages_are_ordered_by_the_matched_value_without_duplicates(session):
+    add_campaign(session, 1, store_id=1)
+    add_campaign(session, 2, store_id=2)
+    # the email branch finds these, their last names sort before every "sm" name
+    for i in range(4):
+        add_appended(session, 1, 1, 'Adams', 'Sm{}@example.com'.format(i))
+    for i in range(4):
+        add_appended(session, 1, 1, 'Smith{}'.format(i), 'x{}@example.com'.format(i))
+    both = add_appended(session, 1, 1, 'Smart', 'Smart@example.com', leads=2)
+    add_appended(session, 2, 2, 'Smith', 'other-store@example.com')
+
+    pages = []
+    page = 1
+    while True:
+        rows, has_next = search_leads(1, 'sm', page=page, per_page=3, session=session)
+        pages.append([(row.last_name, row.email) for row in rows])
+        if not has_next:
+            break
+        page += 1
+
+    found = [row for rows in pages for row in rows]
+    assert [len(rows) for rows in pages] == [3, 3, 3]
+    assert len(found) == 9 == len(set(found))
+    assert found[:4] == [('Adams', 'Sm{}@example.com'.format(i)) for i in range(4)]
+    assert found[4] == ('Smart', 'Smart@example.com')
+    assert found[5:] == [('Smith{}'.format(i), 'x{}@example.com'.format(i)) for i in range(4)]
+
+    rows, has_next = search_leads(1, 'smart', session=session)
+    assert [(row.id, row.lead_id is not None) for row in rows] == [(both, True)]
+
+
+def test_like_wildcards_and_phone_digits(session):
+    add_campaign(session, 1, store_id=1)
+    add_appended(session, 1, 1, 'O_Neil', 'a@example.com')
+    add_appended(session, 1, 1, 'Oxneil', 'b@example.com')
+    add_appended(session, 1, 1, 'Moore', 'c@example.com', phone='4075550100')
+
+    assert [row.last_name for row in search_leads(1, 'o_n', session=session)[0]] == ['O_Neil']
+    assert search_leads(1, 'o%', session=session)[0] == []
+    assert [row.last_name for row in search_leads(1, '(407) 555', session=session)[0]] == ['Moore']
@@ -0,0 +1,45 @@
+from models import Campaign, PixelTracker, Visitor
+import datetime
+import trackers
+
+
+def add_tracker(session, tracker_id, capacity):
+    session.add(PixelTracker(id=tracker_id, name='pt{}'.format(tracker_id), ip_addr='10.0.1.{}'.format(tracker_id),
+                             fqdn='pt{}.example.com'.format(tracker_id), capacity=capacity, active=1))
+    session.commit()
+
+
+def add_campaign(session, campaign_id, tracker_id=None, visitors=0):
+    now = datetime.datetime.now()
+    session.add(Campaign(id=campaign_id, store_id=1, name='Campaign {}'.format(campaign_id), job_number=campaign_id,
+                         type=1, status='ACTIVE', start_date=now, end_date=now, client_id='test',
+                         rvm_campaign_id=campaign_id, pixeltrackers_id=tracker_id, archived=0))
+    session.add_all([Visitor(campaign_id=campaign_id, store_id=1, created_date=now) for i in range(visitors)])
+    session.commit()
+
+
+def test_assign_uses_cached_weights_and_saved_assignments(session, monkeypatch):
+    monkeypatch.setattr(trackers, 'weight_cache', trackers.WeightCache(max_age=3600))
+    monkeypatch.setattr(trackers, 'TRACKER_VISITS_PER_SLOT', 2)
+    add_tracker(session, 1, 10)
+    add_tracker(session, 2, 8)
+    add_campaign(session, 1, tracker_id=1, visitors=4)
+
+    counts = []
+    count = trackers.weight_cache.count
+    monkeypatch.setattr(trackers.weight_cache, 'count', lambda session: counts.append(1) or count(session))
+
+    # campaign 1 weighs 3 slots, each new campaign goes where the most slots are free
+    add_campaign(session, 2)
+    add_campaign(session, 3)
+    add_campaign(session, 4)
+    assert [trackers.assign_campaign(campaign_id, session=session) for campaign_id in (2, 3, 4)] == [2, 1, 2]
+    assert trackers.assign_campaign(2, session=session) == 2
+    assert len(counts) == 1
+
+    session.expire_all()
+    assert [tracker.total_campaigns for tracker in session.query(PixelTracker).order_by(PixelTracker.id)] == [2, 2]
+
+    report = dict((row['id'], row['load']) for row in trackers.utilization(session=session))
+    assert report == {1: 4.0, 2: 2.0}
+    assert len(counts) == 1
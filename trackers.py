@@ -0,0 +1,322 @@
+"""
+PixelTracker assignment and load balancing
+
+Each tracker has `capacity` campaign slots.  A campaign uses one slot
+plus one more for every TRACKER_VISITS_PER_SLOT visitors it received in
+the last TRACKER_VOLUME_WINDOW_DAYS days.  Trackers are kept in a heap
+ordered by headroom, so each placement is O(log n).
+
+Counting the visitor volume is the expensive part, so campaign weights
+are cached per process and recounted every TRACKER_WEIGHT_REFRESH_SECONDS;
+a campaign the cache has not seen yet weighs one slot.  The heap itself
+is rebuilt from the current assignments, which is cheap.  Assignments
+and rebalances lock the active tracker rows first, so concurrent writers
+queue up and each one places against the assignments the last one saved.
+"""
+from database import db_session
+from models import Campaign, PixelTracker
+from sqlalchemy import text
+import config
+import datetime
+import heapq
+import threading
+import time
+
+TRACKER_VOLUME_WINDOW_DAYS = getattr(config, 'TRACKER_VOLUME_WINDOW_DAYS', 7)
+TRACKER_VISITS_PER_SLOT = getattr(config, 'TRACKER_VISITS_PER_SLOT', 1000)
+TRACKER_REBALANCE_THRESHOLD = getattr(config, 'TRACKER_REBALANCE_THRESHOLD', 0.9)
+TRACKER_WEIGHT_REFRESH_SECONDS = getattr(config, 'TRACKER_WEIGHT_REFRESH_SECONDS', 600)
+
+
+def campaign_weight(recent_visitors):
+    """
+    Slots used by a campaign
+    :param recent_visitors:
+    :return: float
+    """
+    return 1.0 + float(recent_visitors or 0) / TRACKER_VISITS_PER_SLOT
+
+
+class TrackerBalancer(object):
+    """
+    Heap of trackers by headroom, stale entries are skipped lazily
+    """
+
+    def __init__(self, capacities):
+        self.capacity = dict(capacities)
+        self.load = dict((tracker_id, 0.0) for tracker_id in self.capacity)
+        self.campaigns = dict((tracker_id, {}) for tracker_id in self.capacity)
+        self.version = dict((tracker_id, 0) for tracker_id in self.capacity)
+        self.heap = []
+        for tracker_id in self.capacity:
+            self._push(tracker_id)
+
+    def headroom(self, tracker_id):
+        return self.capacity[tracker_id] - self.load[tracker_id]
+
+    def utilization(self, tracker_id):
+        if not self.capacity[tracker_id]:
+            return 0.0
+        return self.load[tracker_id] / self.capacity[tracker_id]
+
+    def _push(self, tracker_id):
+        self.version[tracker_id] += 1
+        heapq.heappush(self.heap, (-self.headroom(tracker_id), tracker_id, self.version[tracker_id]))
+
+    def best(self):
+        """
+        Get the tracker with the most headroom
+        :return: tracker id or None
+        """
+        while self.heap:
+            neg_headroom, tracker_id, version = self.heap[0]
+            if version == self.version[tracker_id]:
+                return tracker_id
+            heapq.heappop(self.heap)
+        return None
+
+    def add(self, tracker_id, campaign_id, weight):
+        self.load[tracker_id] += weight
+        self.campaigns[tracker_id][campaign_id] = weight
+        self._push(tracker_id)
+
+    def remove(self, tracker_id, campaign_id):
+        weight = self.campaigns[tracker_id].pop(campaign_id)
+        self.load[tracker_id] -= weight
+        self._push(tracker_id)
+        return weight
+
+    def place(self, campaign_id, weight):
+        """
+        Put the campaign on the tracker with the most headroom
+        :param campaign_id:
+        :param weight:
+        :return: tracker id or None
+        """
+        tracker_id = self.best()
+        if tracker_id is not None:
+            self.add(tracker_id, campaign_id, weight)
+        return tracker_id
+
+    def rebalance(self, threshold=TRACKER_REBALANCE_THRESHOLD):
+        """
+        Move campaigns off trackers above the utilization threshold,
+        largest first, onto the trackers with the most headroom.  Only
+        moves that leave the destination no busier than the source are
+        made.
+        :param threshold:
+        :return: list of (campaign_id, from_tracker_id, to_tracker_id)
+        """
+        moves = []
+
+        for source_id in sorted(self.capacity, key=self.utilization, reverse=True):
+            if self.utilization(source_id) <= threshold:
+                break
+
+            for campaign_id, weight in sorted(self.campaigns[source_id].items(), key=lambda item: -item[1]):
+                if self.utilization(source_id) <= threshold:
+                    break
+
+                target_id = self.best()
+                if target_id is None or target_id == source_id:
+                    break
+
+                # never push the target past where the source ends up
+                target_after = (self.load[target_id] + weight) / (self.capacity[target_id] or 1)
+                source_after = (self.load[source_id] - weight) / (self.capacity[source_id] or 1)
+                if target_after > source_after:
+                    continue
+
+                self.remove(source_id, campaign_id)
+                self.add(target_id, campaign_id, weight)
+                moves.append((campaign_id, source_id, target_id))
+
+        return moves
+
+    def report(self, names=None):
+        """
+        Per tracker utilization
+        :param names: optional tracker id -> name
+        :return: list of dicts
+        """
+        names = names or {}
+        return [{
+            'id': tracker_id,
+            'name': names.get(tracker_id),
+            'capacity': self.capacity[tracker_id],
+            'campaigns': len(self.campaigns[tracker_id]),
+            'load': round(self.load[tracker_id], 2),
+            'headroom': round(self.headroom(tracker_id), 2),
+            'utilization': round(self.utilization(tracker_id), 4)
+        } for tracker_id in sorted(self.capacity)]
+
+
+class WeightCache(object):
+    """
+    Campaign weights by recent visitor volume, recounted when stale
+    """
+
+    def __init__(self, max_age=TRACKER_WEIGHT_REFRESH_SECONDS):
+        self.max_age = max_age
+        self.weights = {}
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def get(self, session=db_session):
+        """
+        Current campaign weights, recounted if older than max_age
+        :param session:
+        :return: dict campaign id -> weight
+        """
+        with self.lock:
+            if self.loaded is None or time.time() - self.loaded >= self.max_age:
+                self.weights = self.count(session)
+                self.loaded = time.time()
+            return self.weights
+
+    def count(self, session=db_session):
+        """
+        Weigh every active campaign by its recent visitor volume
+        :param session:
+        :return: dict campaign id -> weight
+        """
+        since = datetime.datetime.now() - datetime.timedelta(days=TRACKER_VOLUME_WINDOW_DAYS)
+        stmt = text("select c.id, count(v.id) as recent_visitors "
+                    "from campaigns c "
+                    "left join visitors v on v.campaign_id = c.id and v.created_date >= :since "
+                    "where c.status = 'ACTIVE' "
+                    "and c.archived = 0 "
+                    "group by c.id")
+
+        return dict((row.id, campaign_weight(row.recent_visitors)) for row in session.execute(stmt, {'since': since}))
+
+
+weight_cache = WeightCache()
+
+
+def load_balancer(session=db_session, lock=False):
+    """
+    Build the balancer from the active trackers, the current assignment
+    of every active campaign and the cached campaign weights
+    :param session:
+    :param lock: lock the active tracker rows until the session commits
+    :return: tuple (TrackerBalancer, dict tracker names, dict campaign weights)
+    """
+    cached = weight_cache.get(session)
+
+    query = session.query(PixelTracker).filter(PixelTracker.active == 1).order_by(PixelTracker.id)
+    if lock:
+        query = query.with_for_update()
+    trackers = query.all()
+    balancer = TrackerBalancer((tracker.id, tracker.capacity) for tracker in trackers)
+    names = dict((tracker.id, tracker.name) for tracker in trackers)
+
+    # a locking read sees the latest committed assignments, not the
+    # transaction's snapshot
+    query = session.query(Campaign.id, Campaign.pixeltrackers_id).filter(
+        Campaign.status == 'ACTIVE', Campaign.archived == 0)
+    if lock:
+        query = query.with_for_update()
+
+    weights = {}
+    for campaign_id, tracker_id in query:
+        weights[campaign_id] = cached.get(campaign_id, campaign_weight(0))
+        if tracker_id in balancer.capacity:
+            balancer.add(tracker_id, campaign_id, weights[campaign_id])
+
+    return balancer, names, weights
+
+
+def save_assignments(balancer, moves, session=db_session):
+    """
+    Persist campaign moves and the tracker campaign counts
+    :param balancer:
+    :param moves: list of (campaign_id, from_tracker_id, to_tracker_id)
+    :param session:
+    :return: None
+    """
+    try:
+        if moves:
+            session.execute(
+                text("update campaigns set pixeltrackers_id = :tracker_id where id = :id"),
+                [{'id': campaign_id, 'tracker_id': target_id} for campaign_id, source_id, target_id in moves]
+            )
+
+        session.execute(
+            text("update pixeltrackers set total_campaigns = :total where id = :id"),
+            [{'id': tracker_id, 'total': len(campaigns)} for tracker_id, campaigns in balancer.campaigns.items()]
+        )
+        session.commit()
+
+    except Exception:
+        session.rollback()
+        raise
+
+
+def assign_campaign(campaign_pk_id, session=db_session):
+    """
+    Place a campaign on the tracker with the most headroom
+    :param campaign_pk_id:
+    :param session:
+    :return: tracker id or None
+    """
+    try:
+        balancer, names, weights = load_balancer(session, lock=True)
+
+        campaign = session.query(Campaign).filter(
+            Campaign.id == campaign_pk_id).with_for_update().populate_existing().one()
+    except Exception:
+        session.rollback()
+        raise
+
+    current_id = campaign.pixeltrackers_id
+    weight = weights.get(campaign.id, campaign_weight(0))
+
+    if current_id in balancer.capacity and campaign.id in balancer.campaigns[current_id]:
+        session.commit()
+        return current_id
+
+    tracker_id = balancer.place(campaign.id, weight)
+    if tracker_id is None:
+        session.commit()
+        return None
+
+    save_assignments(balancer, [(campaign.id, current_id, tracker_id)], session)
+    return tracker_id
+
+
+def rebalance(threshold=TRACKER_REBALANCE_THRESHOLD, session=db_session):
+    """
+    Rebalance campaigns across the active trackers
+    :param threshold:
+    :param session:
+    :return: tuple (list moves, list utilization)
+    """
+    try:
+        balancer, names, weights = load_balancer(session, lock=True)
+    except Exception:
+        session.rollback()
+        raise
+
+    # active campaigns on missing or inactive trackers get placed first
+    assigned = set(campaign_id for campaigns in balancer.campaigns.values() for campaign_id in campaigns)
+    moves = []
+    for campaign_id in sorted(set(weights) - assigned, key=lambda campaign_id: -weights[campaign_id]):
+        tracker_id = balancer.place(campaign_id, weights[campaign_id])
+        if tracker_id is not None:
+            moves.append((campaign_id, None, tracker_id))
+
+    moves.extend(balancer.rebalance(threshold))
+    save_assignments(balancer, moves, session)
+
+    return moves, balancer.report(names)
+
+
+def utilization(session=db_session):
+    """
+    Per tracker utilization
+    :param session:
+    :return: list of dicts
+    """
+    balancer, names, weights = load_balancer(session)
+    return balancer.report(names)
@@ -0,0 +1,216 @@
+"""
+Visitor processing work queue
+
+The visitors table doubles as a work queue: `locked` and `status` hold
+the lease, `retry_counter` and `last_retry` drive exponential backoff.
+Workers claim batches with SELECT ... FOR UPDATE SKIP LOCKED so they
+never wait on each other's rows; SQLite (tests) falls back to a guarded
+update.
+"""
+from database import db_session
+from models import Visitor
+from sqlalchemy import and_, or_, func
+from werkzeug.utils import import_string
+import config
+import datetime
+
+VISITOR_BATCH_SIZE = getattr(config, 'VISITOR_BATCH_SIZE', 200)
+VISITOR_LEASE_SECONDS = getattr(config, 'VISITOR_LEASE_SECONDS', 300)
+VISITOR_RETRY_BASE_SECONDS = getattr(config, 'VISITOR_RETRY_BASE_SECONDS', 30)
+VISITOR_MAX_RETRIES = getattr(config, 'VISITOR_MAX_RETRIES', 8)
+
+STATUS_LEASED = 'LEASED'
+STATUS_RETRY = 'RETRY'
+STATUS_FAILED = 'FAILED'
+STATUS_DONE = 'DONE'
+
+
+def retry_due(now, base_seconds=VISITOR_RETRY_BASE_SECONDS, max_retries=VISITOR_MAX_RETRIES):
+    """
+    Build the backoff filter: a visitor that has failed n times is due
+    again base_seconds * 2 ** (n - 1) after its last retry.  Expanded
+    into one clause per retry count so it stays portable and indexable.
+    :param now:
+    :param base_seconds:
+    :param max_retries:
+    :return: clause
+    """
+    clauses = [Visitor.retry_counter == None, Visitor.retry_counter == 0]  # noqa: E711
+
+    for attempt in range(1, max_retries):
+        cutoff = now - datetime.timedelta(seconds=base_seconds * 2 ** (attempt - 1))
+        clauses.append(and_(Visitor.retry_counter == attempt, Visitor.last_retry <= cutoff))
+
+    return or_(*clauses)
+
+
+class VisitorQueue(object):
+    """
+    Lease visitors to parallel workers
+    """
+
+    def __init__(self, session=db_session, lease_seconds=VISITOR_LEASE_SECONDS, max_retries=VISITOR_MAX_RETRIES,
+                 retry_base_seconds=VISITOR_RETRY_BASE_SECONDS):
+        self.session = session
+        self.lease_seconds = lease_seconds
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+
+    def claim(self, batch_size=VISITOR_BATCH_SIZE):
+        """
+        Lease the next batch of due visitors
+        :param batch_size:
+        :return: list visitor ids
+        """
+        now = datetime.datetime.now()
+
+        query = self.session.query(Visitor.id).filter(
+            Visitor.processed == 0,
+            Visitor.locked == 0,
+            or_(Visitor.status == None, Visitor.status != STATUS_FAILED),  # noqa: E711
+            retry_due(now, self.retry_base_seconds, self.max_retries)
+        ).order_by(Visitor.id.asc()).limit(batch_size)
+
+        # FOR UPDATE renders nothing on SQLite, the guarded update below covers it
+        stmt = query.with_for_update().statement.suffix_with('SKIP LOCKED', dialect='mysql')
+
+        try:
+            rows = self.session.execute(stmt).fetchall()
+
+            ids = [row.id for row in rows]
+            if not ids:
+                self.session.commit()
+                return []
+
+            result = self.session.execute(
+                Visitor.__table__.update().where(and_(
+                    Visitor.id.in_(ids),
+                    Visitor.locked == 0
+                )).values(locked=1, status=STATUS_LEASED, last_retry=now)
+            )
+
+            if result.rowcount != len(ids):
+                # fallback path only, another worker took some of the rows
+                ids = [row.id for row in self.session.query(Visitor.id).filter(
+                    Visitor.id.in_(ids),
+                    Visitor.status == STATUS_LEASED,
+                    Visitor.last_retry == now
+                ).all()]
+
+            self.session.commit()
+            return ids
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def complete(self, ids):
+        """
+        Mark leased visitors as processed, processing appends them so
+        their lead score is due again
+        :param ids:
+        :return: None
+        """
+        if not ids:
+            return
+
+        self._execute(
+            Visitor.__table__.update().where(Visitor.id.in_(ids)).values(
+                processed=1, locked=0, status=STATUS_DONE, score_updated=None
+            )
+        )
+
+    def fail(self, ids):
+        """
+        Release leased visitors for a later retry, or give up
+        after max_retries attempts
+        :param ids:
+        :return: None
+        """
+        if not ids:
+            return
+
+        table = Visitor.__table__
+        try:
+            self.session.execute(
+                table.update().where(table.c.id.in_(ids)).values(
+                    locked=0,
+                    retry_counter=func.coalesce(table.c.retry_counter, 0) + 1,
+                    last_retry=datetime.datetime.now(),
+                    status=STATUS_RETRY
+                )
+            )
+            # separate statement, MySQL would see the incremented counter in the same SET
+            self.session.execute(
+                table.update().where(and_(
+                    table.c.id.in_(ids),
+                    table.c.retry_counter >= self.max_retries
+                )).values(status=STATUS_FAILED)
+            )
+            self.session.commit()
+
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def reclaim_expired(self):
+        """
+        Release leases whose worker died or timed out
+        :return: int reclaimed count
+        """
+        expired = datetime.datetime.now() - datetime.timedelta(seconds=self.lease_seconds)
+
+        ids = [row.id for row in self.session.query(Visitor.id).filter(
+            Visitor.locked == 1,
+            Visitor.status == STATUS_LEASED,
+            Visitor.last_retry <= expired
+        ).all()]
+
+        self.fail(ids)
+        return len(ids)
+
+    def _execute(self, stmt, params=None):
+        try:
+            result = self.session.execute(stmt, params or {})
+            self.session.commit()
+            return result
+        except Exception:
+            self.session.rollback()
+            raise
+
+
+def get_processor():
+    """
+    Load the configured visitor processor.  A processor takes a list
+    of visitor ids and returns the ids that failed.
+    :return: callable or None
+    """
+    processor = getattr(config, 'VISITOR_PROCESSOR', None)
+    if not processor:
+        return None
+    return import_string(processor)
+
+
+def process_batch(processor, queue=None, batch_size=VISITOR_BATCH_SIZE):
+    """
+    Claim and process one batch of visitors
+    :param processor:
+    :param queue:
+    :param batch_size:
+    :return: dict counts
+    """
+    queue = queue or VisitorQueue()
+    ids = queue.claim(batch_size)
+    if not ids:
+        return {'claimed': 0, 'processed': 0, 'failed': 0}
+
+    try:
+        failed = set(processor(ids) or [])
+    except Exception:
+        queue.fail(ids)
+        raise
+
+    queue.complete([visitor_id for visitor_id in ids if visitor_id not in failed])
+    queue.fail(list(failed))
+
+    return {'claimed': len(ids), 'processed': len(ids) - len(failed), 'failed': len(failed)}
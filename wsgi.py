@@ -3,6 +3,15 @@ activate_this = '/var/www/html/EARL-Dealer-FrontEnd/.env/bin/activate_this.py'
 execfile(activate_this, dict(__file__=activate_this))
 
 import os
+
+# cooperative serving mode, patch before anything else touches sockets or threads
+# and swap mysqlclient for the pure python (green-safe) PyMySQL driver
+if os.environ.get('EARL_GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+    import pymysql
+    pymysql.install_as_MySQLdb()
+
 import sys
 import logging
 logging.basicConfig(stream=sys.stderr)
@@ -10,3 +19,22 @@ sys.path.insert(0, '/var/www/html/EARL-Dealer-FrontEnd/')
 
 from app import app as application
 application.secret_key = os.urandom(10)
+
+
+def serve_gevent(port=8880, concurrency=1000):
+    """
+    Serve the app from a single gevent process:
+    EARL_GEVENT=1 python wsgi.py
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(('0.0.0.0', port), application, spawn=Pool(concurrency))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve_gevent(
+        port=int(os.environ.get('EARL_PORT', 8880)),
+        concurrency=int(os.environ.get('EARL_CONCURRENCY', 1000))
+    )